@@ -0,0 +1,138 @@
+""" Batch search: runs many GDC / ENCODE searches in one process, so that the GDC manifest,
+category index and ENCODE term tables are loaded once and HTTP connections are reused
+(atlas_http_utils.get_session), instead of one bioshed process per search.
+
+$ python atlas_batch.py searches.txt --output batch_results
+
+searches.txt has one search per line: the database (gdc, tcga or encode) followed by the
+search terms, as typed after "bioshed search <database>". Blank lines and lines starting
+with '#' are skipped.
+
+    gdc breast cancer --assay rnaseq
+    encode --tissue heart --assay chip-seq
+
+Output folder:
+    query_<n>_<database>.txt    results of search n (same format as search_gdc.txt / search_encode.txt)
+    query_<n>_<database>.log    what search n printed
+    batch_files.txt             all files found, without duplicates: database, file, url, queries (search numbers)
+"""
+import os, sys, ast, csv, argparse, contextlib
+SCRIPT_DIR = str(os.path.dirname(os.path.realpath(__file__)))
+sys.path.append(SCRIPT_DIR)
+sys.path.append(os.path.join(SCRIPT_DIR, 'bioshed_utils'))
+import atlas_utils
+import atlas_encode_utils
+import atlas_tcga_utils
+
+DATABASES = {'gdc': 'gdc', 'tcga': 'gdc', 'encode': 'encode'}
+BATCH_FILES_FILE = 'batch_files.txt'
+
+
+def read_batch_file( batch_file ):
+    """ Reads a file of searches (see module docstring).
+    ---
+    searches: list of (database, search terms)
+    """
+    searches = []
+    with open(batch_file,'r') as f:
+        for r in f:
+            r = r.strip()
+            if r == '' or r.startswith('#'):
+                continue
+            database, _, searchterms = r.partition(' ')
+            if database.lower() not in DATABASES:
+                print('WARNING: skipping search with unknown database "{}": {}'.format(database, r))
+                continue
+            searches.append((DATABASES[database.lower()], searchterms.strip()))
+    return searches
+
+
+def search_batch( args ):
+    """ Entrypoint for a batch search.
+
+    batchfile: file of searches, one per line (see module docstring)
+    output: output folder (default: current folder)
+    ---
+    summary: list of {"query": n, "database": ..., "searchterms": ..., "results_file": ..., "rows": ...}
+    (out): query_<n>_<database>.txt result files and a combined file list (batch_files.txt)
+    """
+    outdir = os.path.abspath(args['output']) if 'output' in args and args['output'] != '' else os.getcwd()
+    os.makedirs(outdir, exist_ok=True)
+    searches = read_batch_file( args['batchfile'] )
+    summary = []
+    files = {}  # (database, file): {"url": ..., "queries": [...]}
+    gdc_search_file = atlas_tcga_utils.DEFAULT_SEARCH_FILE
+    encode_search_file = atlas_encode_utils.DEFAULT_SEARCH_FILE
+    # searches run in this process (not sent to a search daemon), sharing what it has loaded
+    serving = atlas_utils._daemon['serving']
+    atlas_utils._daemon['serving'] = True
+    try:
+        for n, (database, searchterms) in enumerate(searches):
+            results_file = os.path.join(outdir, 'query_{}_{}.txt'.format(str(n), database))
+            atlas_tcga_utils.DEFAULT_SEARCH_FILE = results_file
+            atlas_encode_utils.DEFAULT_SEARCH_FILE = results_file
+            with atlas_utils.span('search_batch.query', query=n, database=database):
+                with open(results_file[:-len('.txt')]+'.log','w') as flog, contextlib.redirect_stdout(flog):
+                    if database == 'gdc':
+                        df = atlas_tcga_utils.search_gdc( dict(searchterms=searchterms))
+                    else:
+                        df = atlas_encode_utils.search_encode( dict(searchterms=searchterms))
+            if database == 'encode' and isinstance(df, int) and df > 0:
+                # streamed search (--stream): the table is only in the results file
+                df = atlas_encode_utils.pd.read_csv(results_file, sep='\t', comment='#', converters={'file': ast.literal_eval})
+            rows = len(df) if hasattr(df, 'to_csv') else 0
+            if database == 'gdc' and rows > 0:
+                for file_id in df['id']:
+                    add_batch_file( files, 'gdc', str(file_id), atlas_tcga_utils.BASE_HTTPS_DIR + str(file_id), n )
+            elif database == 'encode' and rows > 0:
+                # file locations saved by the search, when available
+                records = atlas_encode_utils.read_encode_file_records( results_file, list(df['experiment']) )
+                locations = {record['@id']: atlas_encode_utils.get_file_location( record, False ) for e_url in records for record in records[e_url]}
+                for experiment_files in df['file']:
+                    for file_id in experiment_files:
+                        add_batch_file( files, 'encode', file_id, locations.get(file_id) or atlas_encode_utils.ENCODE_URL + file_id, n )
+            summary.append(dict(query=n, database=database, searchterms=searchterms, results_file=results_file if rows > 0 else '', rows=rows))
+            print('[{}] {} {}: {} results'.format(str(n), database, searchterms, str(rows)))
+    finally:
+        atlas_utils._daemon['serving'] = serving
+        atlas_tcga_utils.DEFAULT_SEARCH_FILE = gdc_search_file
+        atlas_encode_utils.DEFAULT_SEARCH_FILE = encode_search_file
+
+    with open(os.path.join(outdir, BATCH_FILES_FILE),'w', newline='') as fout:
+        writer = csv.writer(fout, delimiter='\t', lineterminator='\n')
+        writer.writerow(['database', 'file', 'url', 'queries'])
+        for (database, file_id), info in files.items():
+            writer.writerow([database, file_id, info['url'], ','.join(map(str, info['queries']))])
+    print('{} searches, {} distinct files. File list written to {}.'.format(str(len(searches)), str(len(files)), os.path.join(outdir, BATCH_FILES_FILE)))
+    return summary
+
+
+def add_batch_file( files, database, file_id, url, query ):
+    """ Adds a file found by a search to the combined file list (once per file).
+
+    >>> files = {}
+    >>> add_batch_file(files, 'gdc', 'f1', 'https://api.gdc.cancer.gov/data/f1', 0)
+    >>> add_batch_file(files, 'gdc', 'f1', 'https://api.gdc.cancer.gov/data/f1', 3)
+    >>> files
+    {('gdc', 'f1'): {'url': 'https://api.gdc.cancer.gov/data/f1', 'queries': [0, 3]}}
+    """
+    key = (database, file_id)
+    if key not in files:
+        files[key] = dict(url=url, queries=[])
+    if query not in files[key]['queries']:
+        files[key]['queries'].append(query)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run many BioShed Atlas searches (GDC / ENCODE) in one process.')
+    parser.add_argument('batchfile', help='file with one search per line: <gdc|tcga|encode> <search terms>')
+    parser.add_argument('--output', default='', help='output folder (default: current folder)')
+    parser.add_argument('--profile', nargs='?', const=atlas_utils.DEFAULT_PROFILE_FILE, default=None, help='write a JSON trace of the batch')
+    a = parser.parse_args()
+    search_batch( dict(batchfile=a.batchfile, output=a.output) )
+    if a.profile is not None:
+        atlas_utils.write_profile( a.profile )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,354 @@
+""" Benchmarks for the search and download hot paths, run against synthetic data and a
+local stand-in for the ENCODE and GDC servers, so results are reproducible and need no network.
+
+$ python atlas_benchmark.py
+$ python atlas_benchmark.py --rows 1000000 --experiments 2000 --latency 0.05 --output benchmark_results.json
+
+Each scenario is timed over --repeat runs (min and median seconds), then run once more
+under tracemalloc for peak Python memory. The number of requests made to the stand-in
+server is recorded too. Results are written as JSON:
+
+{"started": ..., "python": ..., "platform": ..., "params": {...},
+ "results": [{"scenario": "get_manifest_rows", "seconds_min": ..., "seconds_median": ...,
+              "peak_memory_bytes": ..., "requests": ..., ...}, ...]}
+"""
+import os, sys, io, gc, ast, json, time, hashlib, shutil, argparse, platform, tempfile, threading, tracemalloc, statistics, contextlib
+import http.server
+from urllib.parse import urlparse, parse_qs
+SCRIPT_DIR = str(os.path.dirname(os.path.realpath(__file__)))
+sys.path.append(SCRIPT_DIR)
+sys.path.append(os.path.join(SCRIPT_DIR, 'bioshed_utils'))
+import atlas_http_utils
+import atlas_encode_utils
+import atlas_tcga_utils
+
+DEFAULT_PARAMS = dict(rows=10000, experiments=200, files_per_experiment=2, file_size=64*1024, latency=0.01,
+                      download_count=20, repeat=3, workers=atlas_http_utils.DEFAULT_WORKERS)
+SCENARIOS = ['get_manifest_rows_cold', 'get_manifest_rows', 'encode_search_url', 'get_full_info_from_encode_json',
+             'download_encode', 'download_encode_lookup', 'download_gdc']
+ASSAYS = ['transcriptome-rnaseq', 'WGS-whole-genome-seq', 'WES-WXS-whole-exome-seq', 'methylation-array', 'single-cell-rnaseq', 'targeted-dnaseq']
+CELLTYPES = ['heart', 'liver', 'K562', 'HepG2', 'MCF-7', 'brain']
+
+
+def make_gdc_manifest( nrows, out_file, file_size=DEFAULT_PARAMS['file_size'], seed=0 ):
+    """ Writes a synthetic gzipped GDC manifest (same columns as combine_all) with values
+    drawn from files/gdc/categories-all-gdc.txt. About 1 in 5 assay and tissue cells are multi-valued.
+
+    nrows: number of rows (files)
+    out_file: manifest file to write (.txt.gz)
+    file_size: size of the files served by the stand-in server (for the md5 and size columns)
+    seed: random seed
+    ---
+    out_file
+    """
+    import numpy as np
+    import pandas as pd
+    rng = np.random.default_rng(seed)
+    categories = {}
+    with open(os.path.join(SCRIPT_DIR, 'files', 'gdc', 'categories-all-gdc.txt'),'r') as f:
+        for r in f:
+            rt = r.strip().split('\t')
+            categories[rt[0]] = np.array(sorted(set(ast.literal_eval(rt[1]))), dtype=object)
+    def _values( category, multi ):
+        values = categories[category][rng.integers(0, len(categories[category]), nrows)]
+        if multi and len(categories[category]) > 1:
+            second = categories[category][rng.integers(0, len(categories[category]), nrows)]
+            joined = rng.random(nrows) < 0.2
+            values = np.where(joined & (second != values), values + '_' + second, values)
+        return values
+    df = pd.DataFrame({'id': ['{:08x}-0000-4000-8000-{:012x}'.format(i, i) for i in range(nrows)],
+                       'filename': ['file{}.txt'.format(str(i)) for i in range(nrows)],
+                       'md5': served_file_md5( file_size ),
+                       'size': int(file_size),
+                       'project': _values('project', False),
+                       'assay': _values('assay', True),
+                       'tissue': _values('tissue', True),
+                       'disease': _values('disease', False),
+                       'species': 'human',
+                       'platform': _values('platform', False),
+                       'filetype': _values('filetype', False)})
+    df.to_csv(out_file, sep='\t', index=False, compression='gzip')
+    return out_file
+
+
+def served_file_md5( file_size ):
+    """ md5 of the content served for every data file by the stand-in server. """
+    return hashlib.md5(b'\0' * int(file_size)).hexdigest()
+
+
+def make_experiment( i, base_url, params ):
+    """ ENCODE-shaped experiment JSON for the stand-in server. """
+    files = []
+    for j in range(int(params['files_per_experiment'])):
+        accession = 'ENCFF{:06d}{:02d}'.format(i, j)
+        file_format = 'fastq' if j % 2 == 0 else 'bam'
+        files.append({'@id': '/files/{}/'.format(accession), 'file_type': file_format, 'file_format': file_format,
+                      'output_type': 'reads' if file_format == 'fastq' else 'alignments', 'file_size': int(params['file_size']),
+                      'md5sum': served_file_md5( params['file_size'] ),
+                      'cloud_metadata': {'url': '{}/files/{}.{}'.format(base_url, accession, file_format)}})
+    return {'@id': '/experiments/ENCSR{:06d}/'.format(i), '@type': ['Experiment'],
+            'assay_term_name': ASSAYS[i % len(ASSAYS)], 'assay_title': ASSAYS[i % len(ASSAYS)],
+            'biosample_ontology': {'term_name': CELLTYPES[i % len(CELLTYPES)], 'classification': 'tissue'},
+            'biosample_summary': 'Homo sapiens {} tissue'.format(CELLTYPES[i % len(CELLTYPES)]),
+            'dbxrefs': ['GEO:GSM{}'.format(str(1000000+i))], 'description': 'synthetic experiment ' * 20,
+            'files': files}
+
+
+def start_server( params ):
+    """ Starts a local HTTP server standing in for ENCODE and the GDC data API, on a free port.
+
+    /search/?type=Experiment&...&limit=N&from=M     ENCODE search (paged; field= is ignored)
+    /search/?type=File&dataset=/experiments/X/      files of an experiment
+    /experiments/X/                                 experiment object
+    /files/<name>, /data/<id>                       data files (file_size bytes, HEAD and Range: bytes=N- supported)
+
+    JSON responses have an ETag, and are answered with 304 Not Modified when If-None-Match matches it.
+
+    Every request waits params['latency'] seconds before answering.
+    ---
+    server: ThreadingHTTPServer (server.url is its base URL, server.requests counts requests,
+            server.params are the params it serves - they can be changed while it runs)
+    """
+    class StandInHandler( http.server.BaseHTTPRequestHandler ):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message( self, *args ):
+            pass
+
+        def _send( self, status, body, content_type, headers={} ):
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            for header, value in headers.items():
+                self.send_header(header, value)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            if self.command != 'HEAD':
+                self.wfile.write(body)
+
+        def do_HEAD( self ):
+            self.do_GET()
+
+        def do_GET( self ):
+            server.requests += 1
+            time.sleep(float(params['latency']))
+            url = urlparse(self.path)
+            query = parse_qs(url.query)
+            num_experiments = int(params['experiments'])
+            if url.path.startswith('/files/') or url.path.startswith('/data/'):
+                file_size = int(params['file_size'])
+                offset = int(self.headers['Range'][len('bytes='):].rstrip('-')) if self.headers.get('Range', '').startswith('bytes=') else 0
+                if offset >= file_size > 0:
+                    return self._send(416, b'', 'application/octet-stream', {'Content-Range': 'bytes */{}'.format(str(file_size))})
+                elif offset > 0:
+                    return self._send(206, b'\0' * (file_size - offset), 'application/octet-stream',
+                                      {'Content-Range': 'bytes {}-{}/{}'.format(str(offset), str(file_size-1), str(file_size))})
+                return self._send(200, b'\0' * file_size, 'application/octet-stream')
+            elif url.path.startswith('/search') and query.get('type', [''])[0] == 'File':
+                i = int(query['dataset'][0].strip('/').split('ENCSR')[-1])
+                body = {'@graph': make_experiment( i, server.url, params )['files']}
+            elif url.path.startswith('/search'):
+                start = int(query.get('from', ['0'])[0])
+                limit = query.get('limit', ['25'])[0]
+                end = num_experiments if limit == 'all' else min(num_experiments, start + int(limit))
+                body = {'total': num_experiments, '@graph': [make_experiment( i, server.url, params ) for i in range(start, end)]}
+            elif url.path.startswith('/experiments/ENCSR'):
+                body = make_experiment( int(url.path.strip('/').split('ENCSR')[-1]), server.url, params )
+            else:
+                return self._send(404, b'{}', 'application/json')
+            body = json.dumps(body).encode()
+            etag = '"{}"'.format(hashlib.md5(body).hexdigest())
+            if self.headers.get('If-None-Match', '') == etag:
+                return self._send(304, b'', 'application/json', {'ETag': etag})
+            self._send(200, body, 'application/json', {'ETag': etag})
+
+    class StandInServer( http.server.ThreadingHTTPServer ):
+        def handle_error( self, request, client_address ):
+            # clients closing kept-alive connections are not errors
+            if not isinstance(sys.exc_info()[1], ConnectionError):
+                super().handle_error(request, client_address)
+
+    server = StandInServer(('127.0.0.1', 0), StandInHandler)
+    server.daemon_threads = True
+    server.requests = 0
+    server.params = params
+    server.url = 'http://127.0.0.1:{}'.format(str(server.server_port))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def start_stand_in( params, workdir ):
+    """ Starts the stand-in server (see start_server) and points the atlas modules at it, so that
+    searches and downloads run on synthetic data, without network:
+    - ENCODE requests go to the server, and GDC data files are downloaded from it
+    - the GDC manifest is a synthetic one with params['rows'] rows (see make_gdc_manifest)
+    - search results files and the HTTP response cache are written to workdir
+    ---
+    server: see start_server - server.manifest_file is the synthetic GDC manifest, and
+            server.stop() shuts the server down and restores the modules' settings
+    """
+    manifest_file = os.path.join(workdir, 'manifest-all-gdc.txt.gz')
+    make_gdc_manifest( int(params['rows']), manifest_file, file_size=params['file_size'] )
+    server = start_server( params )
+    settings = [(atlas_encode_utils, 'ENCODE_URL', server.url),
+                (atlas_encode_utils, 'DEFAULT_SEARCH_FILE', os.path.join(workdir, 'search_encode.txt')),
+                (atlas_tcga_utils, 'BASE_HTTPS_DIR', server.url + '/data/'),
+                (atlas_tcga_utils, 'DEFAULT_SEARCH_FILE', os.path.join(workdir, 'search_gdc.txt')),
+                (atlas_tcga_utils, 'DEFAULT_MANIFEST_FILE', manifest_file),
+                (atlas_http_utils, 'CACHE_DIR', os.path.join(workdir, 'http_cache'))]
+    saved = [(module, name, getattr(module, name)) for module, name, value in settings]
+    for module, name, value in settings:
+        setattr(module, name, value)
+
+    def stop():
+        server.shutdown()
+        for module, name, value in saved:
+            setattr(module, name, value)
+    server.stop = stop
+    server.manifest_file = manifest_file
+    return server
+
+
+def run_scenario( name, func, server, repeat, setup=None ):
+    """ Times func() over repeat runs, then runs it once more under tracemalloc for peak memory.
+    setup() is called (untimed) before every run. Output printed by func is discarded.
+    ---
+    result: {"scenario", "seconds_min", "seconds_median", "peak_memory_bytes", "requests" (per run)}
+    """
+    seconds = []
+    requests_before = server.requests
+    for k in range(int(repeat)+1):
+        if setup is not None:
+            setup()
+        gc.collect()
+        if k == int(repeat):
+            tracemalloc.start()
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            func()
+        if k < int(repeat):
+            seconds.append(time.perf_counter() - start)
+        else:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+    result = dict(scenario=name, seconds_min=min(seconds), seconds_median=statistics.median(seconds),
+                  peak_memory_bytes=peak, requests=(server.requests - requests_before) // (int(repeat)+1))
+    print('{:<34} {:>9.4f}s (median {:.4f}s)  peak {:>10}  requests {}'.format(name, result['seconds_min'], result['seconds_median'],
+                                                                              atlas_http_utils.format_bytes(peak), str(result['requests'])))
+    return result
+
+
+def run_benchmarks( params, scenarios=SCENARIOS, workdir=None ):
+    """ Runs the benchmark scenarios.
+
+    params: see DEFAULT_PARAMS
+    scenarios: names of scenarios to run (see SCENARIOS)
+    workdir: folder for synthetic data and outputs (default: a temporary folder, removed afterwards)
+    ---
+    report: {"started", "python", "platform", "params", "results": [...]}
+    """
+    report = dict(started=time.strftime('%Y-%m-%dT%H:%M:%S'), python=platform.python_version(), platform=platform.platform(),
+                  params=params, results=[])
+    cwd = os.getcwd()
+    tmpdir = workdir if workdir is not None else tempfile.mkdtemp(prefix='atlas_benchmark_')
+    os.makedirs(tmpdir, exist_ok=True)
+    print('Generating synthetic GDC manifest ({} rows)...'.format(str(params['rows'])))
+    server = start_stand_in( params, tmpdir )
+    try:
+        os.chdir(tmpdir)
+        outdir = os.path.join(tmpdir, 'downloads')
+        os.makedirs(outdir, exist_ok=True)
+        workers = str(params['workers'])
+        repeat = params['repeat']
+
+        manifest_file = server.manifest_file
+        gdc_query = dict(assay='rnaseq', tissue='breast')
+        search_url = '/search/?type=Experiment&searchTerm=benchmark'
+
+        def _remove_store():
+            atlas_tcga_utils._manifest_cache.clear()
+            for f in [atlas_tcga_utils.manifest_store_file( manifest_file ), atlas_tcga_utils.manifest_store_file( manifest_file )[:-len('.arrow')]+'.index.npz']:
+                if os.path.exists(f):
+                    os.remove(f)
+        def _clean_downloads():
+            shutil.rmtree(outdir, ignore_errors=True)
+            os.makedirs(outdir)
+        def _write_search_gdc():
+            import pandas as pd
+            _clean_downloads()
+            df = pd.read_csv(manifest_file, sep='\t', nrows=int(params['download_count']))
+            with open(atlas_tcga_utils.DEFAULT_SEARCH_FILE,'w') as fout:
+                fout.write('# bioshed search gdc benchmark\n')
+            df.index.name = 'index'
+            df.to_csv(atlas_tcga_utils.DEFAULT_SEARCH_FILE, sep='\t', mode='a')
+        num_download_experiments = max(1, int(params['download_count']) // max(1, int(params['files_per_experiment'])))
+        encode_search_files = [atlas_encode_utils.DEFAULT_SEARCH_FILE, atlas_encode_utils.encode_files_file( atlas_encode_utils.DEFAULT_SEARCH_FILE )]
+        saved_search = {}
+        def _write_search_encode():
+            # search once, keep the first experiments, then restore the same search files before each run
+            _clean_downloads()
+            if saved_search == {}:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    atlas_encode_utils.encode_search_url( dict(url=search_url, searchtype='full', returntype='full', cache='False'))
+                with open(encode_search_files[0],'r') as f:
+                    saved_search[encode_search_files[0]] = f.readlines()[0:2+num_download_experiments]
+                with open(encode_search_files[1],'r') as f:
+                    saved_search[encode_search_files[1]] = f.readlines()
+            for search_file in encode_search_files:
+                with open(search_file,'w') as fout:
+                    fout.writelines(saved_search[search_file])
+        def _write_search_encode_lookup():
+            _write_search_encode()
+            os.remove(encode_search_files[1])
+
+        results_raw = {}
+        def _fetch_raw():
+            results_raw['json'] = atlas_encode_utils.encode_search_url( dict(url=search_url, returntype='raw', cache='False'))
+
+        runs = {
+            'get_manifest_rows_cold': (lambda: atlas_tcga_utils.get_manifest_rows( dict(gdc_query), 'benchmark', manifest_file ), _remove_store),
+            'get_manifest_rows': (lambda: atlas_tcga_utils.get_manifest_rows( dict(gdc_query), 'benchmark', manifest_file ), None),
+            'encode_search_url': (lambda: atlas_encode_utils.encode_search_url( dict(url=search_url, searchtype='full', returntype='full', cache='False')), None),
+            'get_full_info_from_encode_json': (lambda: atlas_encode_utils.get_full_info_from_encode_json( dict(results=results_raw['json'], sortby='full', search_string=search_url)), None),
+            'download_encode': (lambda: atlas_encode_utils.download_encode( dict(downloadstr='--output {} --workers {}'.format(outdir, workers))), _write_search_encode),
+            'download_encode_lookup': (lambda: atlas_encode_utils.download_encode( dict(downloadstr='--output {} --workers {}'.format(outdir, workers))), _write_search_encode_lookup),
+            'download_gdc': (lambda: atlas_tcga_utils.download_gdc( dict(downloadstr='--output {} --workers {}'.format(outdir, workers))), _write_search_gdc),
+        }
+        for name in scenarios:
+            if name == 'get_full_info_from_encode_json':
+                # parse a response fetched beforehand, so only the JSON to table conversion is timed
+                with contextlib.redirect_stdout(io.StringIO()):
+                    _fetch_raw()
+            func, setup = runs[name]
+            report['results'].append(run_scenario( name, func, server, repeat, setup=setup ))
+    finally:
+        os.chdir(cwd)
+        server.stop()
+        if workdir is None:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark BioShed Atlas search and download paths against synthetic data and a local stand-in server.')
+    parser.add_argument('--rows', type=int, default=DEFAULT_PARAMS['rows'], help='rows in the synthetic GDC manifest (e.g. 1e4 to 1e7)')
+    parser.add_argument('--experiments', type=int, default=DEFAULT_PARAMS['experiments'], help='experiments returned by the ENCODE stand-in search')
+    parser.add_argument('--files-per-experiment', type=int, default=DEFAULT_PARAMS['files_per_experiment'])
+    parser.add_argument('--file-size', type=int, default=DEFAULT_PARAMS['file_size'], help='bytes served per data file')
+    parser.add_argument('--latency', type=float, default=DEFAULT_PARAMS['latency'], help='seconds the stand-in server waits before each response')
+    parser.add_argument('--download-count', type=int, default=DEFAULT_PARAMS['download_count'], help='files downloaded per download scenario')
+    parser.add_argument('--workers', type=int, default=DEFAULT_PARAMS['workers'])
+    parser.add_argument('--repeat', type=int, default=DEFAULT_PARAMS['repeat'], help='timed runs per scenario')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help='comma-separated scenarios to run')
+    parser.add_argument('--workdir', default=None, help='keep synthetic data and outputs in this folder')
+    parser.add_argument('--output', default='benchmark_results.json', help='JSON results file')
+    a = parser.parse_args()
+    params = dict(rows=a.rows, experiments=a.experiments, files_per_experiment=a.files_per_experiment, file_size=a.file_size,
+                  latency=a.latency, download_count=a.download_count, workers=a.workers, repeat=a.repeat)
+    report = run_benchmarks( params, scenarios=[s for s in a.scenarios.split(',') if s != ''], workdir=a.workdir )
+    with open(a.output,'w') as fout:
+        json.dump(report, fout, indent=2)
+    print('Results written to {}'.format(a.output))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,209 @@
+""" Search daemon: keeps the GDC manifest (store and index), the GDC category file and the
+ENCODE search term tables loaded in one long-running process, and answers searches for the
+bioshed CLI, so that a search does not pay for process start, imports and loading each time.
+
+$ python atlas_daemon.py start
+$ python atlas_daemon.py status
+$ python atlas_daemon.py stop
+
+While the daemon is running, "bioshed search gdc/encode ..." and "bioshed download gdc/encode --list ..."
+are sent to it automatically (see atlas_utils.served) - output files are written to the folder
+the command was run from, as usual. Downloads themselves always run in the calling process.
+
+The daemon only listens on 127.0.0.1, and only answers requests carrying the token written to
+its state file (atlas_utils.DAEMON_STATE_FILE, readable by the current user only).
+"""
+import os, sys, io, json, time, secrets, argparse, threading, traceback, contextlib
+import http.server
+SCRIPT_DIR = str(os.path.dirname(os.path.realpath(__file__)))
+sys.path.append(SCRIPT_DIR)
+sys.path.append(os.path.join(SCRIPT_DIR, 'bioshed_utils'))
+import atlas_utils
+import atlas_encode_utils
+import atlas_tcga_utils
+
+# entry points the daemon answers (see atlas_utils.served)
+COMMANDS = {'search_gdc': atlas_tcga_utils.search_gdc,
+            'download_gdc': atlas_tcga_utils.download_gdc,
+            'search_encode': atlas_encode_utils.search_encode,
+            'download_encode': atlas_encode_utils.download_encode}
+
+
+def preload():
+    """ Loads everything searches need: quick_utils, the GDC manifest store and index,
+    the GDC category index (only used without FTS5 - see atlas_tcga_utils.convert_general_terms)
+    and the ENCODE search term tables.
+    """
+    atlas_tcga_utils.quick_utils.format_type
+    if not atlas_utils.text_index_available():
+        atlas_tcga_utils.load_category_index( atlas_tcga_utils.DEFAULT_CATEGORIES_FILE )
+    if os.path.exists(atlas_tcga_utils.DEFAULT_MANIFEST_FILE):
+        atlas_tcga_utils.load_manifest( atlas_tcga_utils.DEFAULT_MANIFEST_FILE )
+    atlas_encode_utils.load_search_terms()
+
+
+def run_command( request ):
+    """ Runs one request in this process, from the caller's folder, capturing what it prints.
+    Requests are handled one at a time (the working folder and stdout are process-wide).
+
+    request: {"command": one of COMMANDS, "args": entry point args, "cwd": caller's folder}
+    ---
+    response: {"output": printed text, "result": JSON-serializable result} or {"error": ...}
+    """
+    if request.get('command') not in COMMANDS or not os.path.isdir(str(request.get('cwd', ''))):
+        return dict(error='invalid request')
+    cwd = os.getcwd()
+    search_file = atlas_encode_utils.DEFAULT_SEARCH_FILE
+    output = io.StringIO()
+    try:
+        os.chdir(request['cwd'])
+        atlas_encode_utils.DEFAULT_SEARCH_FILE = os.path.join(request['cwd'], 'search_encode.txt')
+        atlas_utils.reset_profile()
+        with contextlib.redirect_stdout(output):
+            result = COMMANDS[request['command']]( request['args'] )
+        return dict(output=output.getvalue(), result=get_json_result( result, request['command'] ))
+    except Exception:
+        return dict(error=traceback.format_exc().strip().split('\n')[-1])
+    finally:
+        os.chdir(cwd)
+        atlas_encode_utils.DEFAULT_SEARCH_FILE = search_file
+
+
+def get_json_result( result, command ):
+    """ Converts the result of an entry point for sending back to the CLI. Search tables
+    are summarized by the file they were written to and their number of rows.
+    """
+    if hasattr(result, 'to_csv'):
+        results_file = atlas_encode_utils.DEFAULT_SEARCH_FILE if command.endswith('encode') else os.path.abspath(atlas_tcga_utils.DEFAULT_SEARCH_FILE)
+        return dict(results_file=results_file, rows=len(result))
+    try:
+        json.dumps(result)
+        return result
+    except (TypeError, ValueError):
+        return str(result)
+
+
+def start( port=0 ):
+    """ Starts the daemon in the foreground (until "atlas_daemon.py stop" or Ctrl-C).
+    port: localhost port to listen on (default: any free port)
+
+    Started in another process, with its state file in a temporary home folder:
+    >>> import subprocess, tempfile, urllib.request, urllib.error
+    >>> home = tempfile.mkdtemp()
+    >>> state_file = atlas_utils.DAEMON_STATE_FILE
+    >>> atlas_utils.DAEMON_STATE_FILE = os.path.join(home, '.bioshed', 'atlas_daemon.json')
+    >>> daemon = subprocess.Popen([sys.executable, os.path.join(SCRIPT_DIR, 'atlas_daemon.py'), 'start'],
+    ...                           env=dict(os.environ, HOME=home, PYTHONUNBUFFERED='1'), stdout=subprocess.PIPE, text=True)
+    >>> for line in daemon.stdout:
+    ...     if line.startswith('Search daemon listening'):
+    ...         break
+    >>> atlas_utils.daemon_request( {}, '/status' )['requests']
+    0
+    >>> atlas_utils.daemon_request( dict(command='no_such_command', args={}, cwd=home) )
+    {'error': 'invalid request'}
+    >>> atlas_utils.daemon_request( {}, '/status' )['requests']
+    1
+
+    Requests without the token from the state file are refused:
+    >>> with open(atlas_utils.DAEMON_STATE_FILE) as f:
+    ...     port = json.load(f)['port']
+    >>> try:
+    ...     urllib.request.urlopen(urllib.request.Request('http://127.0.0.1:{}/status'.format(port), data=b'{}'))
+    ... except urllib.error.HTTPError as e:
+    ...     print(e.code)
+    403
+    >>> atlas_utils.daemon_request( {}, '/stop' )
+    {'stopping': True}
+    >>> daemon.communicate()[0], daemon.returncode, os.path.exists(atlas_utils.DAEMON_STATE_FILE)
+    ('Search daemon stopped.\\n', 0, False)
+    >>> atlas_utils.DAEMON_STATE_FILE = state_file
+    """
+    if atlas_utils.daemon_request( {}, '/status' ) is not None:
+        print('The search daemon is already running.')
+        return
+    start_time = time.perf_counter()
+    print('Loading GDC manifest, categories and ENCODE search terms...')
+    preload()
+    print('Loaded in {:.1f}s'.format(time.perf_counter() - start_time))
+    token = secrets.token_hex(16)
+    stats = dict(started=time.time(), requests=0)
+
+    class DaemonHandler( http.server.BaseHTTPRequestHandler ):
+        def log_message( self, *args ):
+            pass
+
+        def do_POST( self ):
+            if not secrets.compare_digest(self.headers.get('X-Atlas-Token', ''), token):
+                return self._send(403, dict(error='forbidden'))
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            if self.path == '/run':
+                stats['requests'] += 1
+                self._send(200, run_command( request ))
+            elif self.path == '/status':
+                self._send(200, dict(pid=os.getpid(), uptime=time.time()-stats['started'], requests=stats['requests'], script_dir=SCRIPT_DIR))
+            elif self.path == '/stop':
+                self._send(200, dict(stopping=True))
+                threading.Thread(target=server.shutdown, daemon=True).start()
+            else:
+                self._send(404, dict(error='not found'))
+
+        def _send( self, status, body ):
+            body = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = http.server.HTTPServer(('127.0.0.1', int(port)), DaemonHandler)
+    atlas_utils._daemon['serving'] = True
+    write_state( dict(port=server.server_port, token=token, pid=os.getpid(), script_dir=SCRIPT_DIR) )
+    print('Search daemon listening on 127.0.0.1:{} (pid {})'.format(str(server.server_port), str(os.getpid())))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        remove_state( os.getpid() )
+        print('Search daemon stopped.')
+
+
+def write_state( state ):
+    """ Writes the daemon state file (atlas_utils.DAEMON_STATE_FILE), readable by the current user only. """
+    os.makedirs(os.path.dirname(atlas_utils.DAEMON_STATE_FILE), exist_ok=True)
+    tmp_file = '{}.{}.tmp'.format(atlas_utils.DAEMON_STATE_FILE, str(os.getpid()))
+    with os.fdopen(os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as fout:
+        json.dump(state, fout)
+    os.replace(tmp_file, atlas_utils.DAEMON_STATE_FILE)
+
+
+def remove_state( pid ):
+    """ Removes the daemon state file, if it was written by process pid. """
+    try:
+        with open(atlas_utils.DAEMON_STATE_FILE,'r') as f:
+            if json.load(f).get('pid') == pid:
+                os.remove(atlas_utils.DAEMON_STATE_FILE)
+    except (OSError, ValueError):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description='BioShed Atlas search daemon: keeps search data loaded and answers bioshed searches.')
+    parser.add_argument('action', choices=['start', 'stop', 'status'])
+    parser.add_argument('--port', type=int, default=0, help='localhost port to listen on (default: any free port)')
+    a = parser.parse_args()
+    if a.action == 'start':
+        start( a.port )
+        return
+    response = atlas_utils.daemon_request( {}, '/'+a.action )
+    if response is None:
+        print('The search daemon is not running.')
+    elif a.action == 'status':
+        print('Search daemon running (pid {}), up {:.0f}s, {} requests answered.'.format(str(response['pid']), response['uptime'], str(response['requests'])))
+    else:
+        print('Search daemon stopping.')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,337 @@
+""" Local mirror of ENCODE experiment and file metadata (SQLite), so that ENCODE searches
+run offline: only the sync job talks to encodeproject.org.
+
+$ python atlas_encode_mirror.py sync            (first sync downloads all experiments, later syncs only new/changed ones
+                                                 and remove experiments no longer listed by ENCODE)
+$ python atlas_encode_mirror.py sync --full     (download everything again)
+$ python atlas_encode_mirror.py status
+
+While the mirror exists, "bioshed search encode ..." searches it instead of ENCODE
+(add --online to search ENCODE itself). Search terms are resolved exactly as for an
+online search (search term tables, see atlas_encode_utils.convert_to_search_string), and
+the resulting ENCODE query string is evaluated on the mirror:
+    - each field=value parameter must match one of the experiment's values for that field
+      (repeated fields: any of the values), as ENCODE does
+    - searchTerm words must all match the experiment's text (accession, assay, biosample,
+      description, field values) in a full-text index (SQLite FTS5, hyphen-aware - see
+      atlas_utils.text_match_query), and results are ranked best match first (bm25)
+Searches using a field that is not mirrored fall back to ENCODE.
+
+Mirror file (MIRROR_FILE):
+    experiments(id, date_released, date_modified, json)         json: experiment object with SEARCH_FIELDS
+    experiments_text(id, text)                                   full-text index (FTS5) of the experiment's text
+    facets(experiment, field, value)                             one row per value of each mirrored field
+    meta(key, value)                                             fields mirrored, sync dates, ENCODE URL
+"""
+import os, sys, json, time, argparse, sqlite3, contextlib
+from urllib.parse import parse_qsl, quote
+SCRIPT_DIR = str(os.path.dirname(os.path.realpath(__file__)))
+sys.path.append(SCRIPT_DIR)
+import atlas_utils
+import atlas_encode_utils
+
+MIRROR_FILE = os.path.join(os.path.expanduser('~'), '.bioshed', 'encode_mirror.sqlite')
+# mirrors of an older format are downloaded again by the next sync (and not searched until then)
+MIRROR_FORMAT = '2'
+MIRROR_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS experiments (id TEXT PRIMARY KEY, date_released TEXT, date_modified TEXT, json TEXT);
+    CREATE VIRTUAL TABLE IF NOT EXISTS experiments_text USING fts5(id UNINDEXED, text, tokenize='{}');
+    CREATE TABLE IF NOT EXISTS facets (experiment TEXT, field TEXT, value TEXT);
+    CREATE INDEX IF NOT EXISTS facets_field_value ON facets (field, value);
+    CREATE INDEX IF NOT EXISTS facets_experiment ON facets (experiment);
+    CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+""".format(atlas_utils.TEXT_TOKENIZER)
+# experiments released or modified on or after the last sync are fetched again (see sync_encode_mirror)
+SYNC_DATE_FIELDS = ['date_released', 'date_modified']
+# experiment fields kept in the text matched by searchTerm (besides mirrored field values)
+TEXT_FIELDS = ['@id', 'accession', 'assay_term_name', 'biosample_ontology.term_name', 'biosample_summary', 'description', 'dbxrefs']
+# experiment JSON kept in the mirror: the fields a search result needs (see atlas_encode_utils.get_encode_table)
+SEARCH_KEYS = sorted(set(f.split('.')[0] for f in atlas_encode_utils.SEARCH_FIELDS))
+# query string parameters that are not field filters
+QUERY_OPTIONS = ['type', 'searchTerm', 'limit', 'from', 'field', 'format', 'frame']
+
+
+def get_mirror_fields():
+    """ Returns the fields used by the search term tables (files/search_encode_<category>.txt links),
+    which are the fields the mirror indexes.
+    """
+    fields = set()
+    for table in atlas_encode_utils.load_search_terms().values():
+        for link in table['links'].values():
+            fields.update(k for k, v in parse_query( link ) if k not in QUERY_OPTIONS)
+    return sorted(fields)
+
+
+def parse_query( query_string ):
+    """ Splits an ENCODE search query string into (parameter, value) pairs. Some search term
+    links carry a path before the '?' (search/?type=..., /?type=...), also inside combined query strings.
+
+    >>> parse_query('?type=Experiment&assay_title=TF%20ChIP-seq&search/?type=Experiment&searchTerm=Leukemia%20Acute')
+    [('type', 'Experiment'), ('assay_title', 'TF ChIP-seq'), ('type', 'Experiment'), ('searchTerm', 'Leukemia Acute')]
+    """
+    return [(k.split('?')[-1], v) for k, v in parse_qsl(str(query_string).lstrip('?'))]
+
+
+def get_field_values( obj, field ):
+    """ Returns the values of a dotted field of an ENCODE object, following lists and embedded objects.
+
+    >>> get_field_values({"replicates": [{"library": {"biosample": {"disease_term_name": ["a", "b"]}}}, {"library": {}}]}, 'replicates.library.biosample.disease_term_name')
+    ['a', 'b']
+    >>> get_field_values({"files": [{"file_type": "bam"}, {"file_type": "fastq"}, {"file_type": "bam"}]}, 'files.file_type')
+    ['bam', 'fastq']
+    """
+    values = [obj]
+    for key in field.split('.'):
+        nested = []
+        for v in values:
+            v = v.get(key) if isinstance(v, dict) else None
+            if isinstance(v, list):
+                nested += v
+            elif v is not None:
+                nested.append(v)
+        values = nested
+    unique = []
+    for v in values:
+        if not isinstance(v, (dict, list)) and str(v) not in unique:
+            unique.append(str(v))
+    return unique
+
+
+def open_mirror( mirror_file=None ):
+    """ Opens (and creates, if needed) the mirror database.
+    mirror_file: default MIRROR_FILE
+    ---
+    conn: sqlite3 connection
+    """
+    mirror_file = mirror_file if mirror_file is not None else MIRROR_FILE
+    os.makedirs(os.path.dirname(os.path.abspath(mirror_file)), exist_ok=True)
+    conn = sqlite3.connect(mirror_file)
+    if conn.execute("SELECT name FROM sqlite_master WHERE name = 'meta'").fetchone() is None:
+        conn.executescript(MIRROR_SCHEMA)
+    return conn
+
+
+def get_mirror_meta( conn ):
+    """ Returns the mirror metadata: {"format", "encode_url", "fields" (JSON list), "synced" (time of last sync),
+    "<date field>" (latest date seen, for each of SYNC_DATE_FIELDS), ...}
+    """
+    return dict(conn.execute('SELECT key, value FROM meta').fetchall())
+
+
+def mirror_exists( mirror_file=None ):
+    """ True if the mirror has been synced at least once. """
+    mirror_file = mirror_file if mirror_file is not None else MIRROR_FILE
+    if not os.path.exists(mirror_file):
+        return False
+    try:
+        with contextlib.closing( sqlite3.connect(mirror_file) ) as conn:
+            return conn.execute("SELECT value FROM meta WHERE key='synced'").fetchone() is not None
+    except sqlite3.Error:
+        return False
+
+
+@atlas_utils.profiled('sync_encode_mirror')
+def sync_encode_mirror( args ):
+    """ Entrypoint for syncing the ENCODE mirror.
+    $ python atlas_encode_mirror.py sync [--full]
+
+    full: 'True' to download all experiments again, 'False' (default) to only fetch experiments
+          released or modified since the last sync (SYNC_DATE_FIELDS)
+    mirror_file: default MIRROR_FILE
+    pagesize: experiments per request (default atlas_encode_utils.DEFAULT_PAGE_SIZE)
+    profile: trace file to write (see atlas_utils.profiled), or None
+    ---
+    num_experiments: number of experiments added or updated
+
+    Experiments are fetched page by page (atlas_encode_utils.iter_encode_search), requesting
+    only SEARCH_FIELDS, the mirrored fields and the text fields, and written as they arrive.
+    An incremental sync then removes the experiments that ENCODE no longer lists (deleted or
+    replaced upstream) - see remove_missing_experiments.
+
+    Against the benchmark's stand-in server:
+    >>> import io, tempfile, atlas_benchmark
+    >>> server = atlas_benchmark.start_server( dict(atlas_benchmark.DEFAULT_PARAMS, latency=0, experiments=5) )
+    >>> atlas_encode_utils.ENCODE_URL, encode_url = server.url, atlas_encode_utils.ENCODE_URL
+    >>> mirror_file = os.path.join(tempfile.mkdtemp(), 'mirror.sqlite')
+    >>> with contextlib.redirect_stdout(io.StringIO()):
+    ...     num_experiments = sync_encode_mirror( dict(mirror_file=mirror_file) )
+    >>> num_experiments
+    5
+    >>> server.params['experiments'] = 3
+    >>> with contextlib.redirect_stdout(io.StringIO()) as out:
+    ...     num_experiments = sync_encode_mirror( dict(mirror_file=mirror_file) )
+    >>> print(out.getvalue().splitlines()[-1])  # doctest: +ELLIPSIS
+    ENCODE mirror synced in ...s: 3 experiments added or updated, 2 removed, 3 in total.
+    >>> atlas_encode_utils.ENCODE_URL = encode_url
+    >>> server.shutdown()
+    """
+    full = args['full'] if 'full' in args else 'False'
+    pagesize = int(args['pagesize']) if 'pagesize' in args and args['pagesize'] != '' else atlas_encode_utils.DEFAULT_PAGE_SIZE
+    start_time = time.time()
+    with contextlib.closing( open_mirror( args['mirror_file'] if 'mirror_file' in args else None ) ) as conn:
+        meta = get_mirror_meta( conn )
+        fields = get_mirror_fields()
+        if full == 'True' or meta.get('format') != MIRROR_FORMAT or meta.get('encode_url') != atlas_encode_utils.ENCODE_URL \
+           or meta.get('fields') != json.dumps(fields) or 'synced' not in meta:
+            print('Downloading all ENCODE experiments to {}'.format(conn.execute('PRAGMA database_list').fetchone()[2]))
+            conn.executescript('DROP TABLE IF EXISTS experiments; DROP TABLE IF EXISTS experiments_text; DROP TABLE IF EXISTS facets; DROP TABLE IF EXISTS meta;' + MIRROR_SCHEMA)
+            queries = ['']
+            full = 'True'
+        else:
+            # experiments released or modified on or after the latest dates seen (same-day changes are fetched again)
+            queries = ['&advancedQuery={}'.format(quote('{}:[{} TO *]'.format(d, meta[d][0:10]))) for d in SYNC_DATE_FIELDS if meta.get(d, '') != '']
+            if len(queries) == 0:
+                queries = ['']
+        field_string = atlas_encode_utils.get_field_string( sorted(set(atlas_encode_utils.SEARCH_FIELDS + fields + TEXT_FIELDS + SYNC_DATE_FIELDS)) )
+        latest = {d: meta.get(d, '') for d in SYNC_DATE_FIELDS}
+        num_experiments = 0
+        for query in queries:
+            url = '/search/?type=Experiment{}{}'.format(query, field_string)
+            batch = []
+            for fullexpt in atlas_encode_utils.iter_encode_search( dict(url=url, pagesize=pagesize, cache='False', fields='False') ):
+                if "@id" not in fullexpt:
+                    continue
+                batch.append(fullexpt)
+                for d in SYNC_DATE_FIELDS:
+                    latest[d] = max(latest[d], str(fullexpt.get(d, '')))
+                if len(batch) >= pagesize:
+                    num_experiments += write_mirror_experiments( conn, batch, fields )
+                    batch = []
+            num_experiments += write_mirror_experiments( conn, batch, fields )
+        num_removed = remove_missing_experiments( conn ) if full != 'True' else 0
+        with conn:
+            conn.executemany('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+                             [('format', MIRROR_FORMAT), ('encode_url', atlas_encode_utils.ENCODE_URL), ('fields', json.dumps(fields)),
+                              ('synced', time.strftime('%Y-%m-%d %H:%M:%S'))] + list(latest.items()))
+        total = conn.execute('SELECT COUNT(*) FROM experiments').fetchone()[0]
+    print('ENCODE mirror synced in {:.1f}s: {} experiments added or updated, {} removed, {} in total.'.format(time.time()-start_time, str(num_experiments), str(num_removed), str(total)))
+    return num_experiments
+
+
+def remove_missing_experiments( conn ):
+    """ Removes the experiments that ENCODE no longer lists (deleted or replaced upstream) from the mirror.
+    The ids of all listed experiments are fetched in one request. If the response is not
+    complete, nothing is removed (the next sync tries again).
+    ---
+    num_removed: number of experiments removed
+    """
+    url = '{}/search/?type=Experiment{}&limit=all'.format(atlas_encode_utils.ENCODE_URL, atlas_encode_utils.get_field_string( ['@id'] ))
+    try:
+        page = atlas_encode_utils.encode_get_json( url, 'False' )
+    except Exception as e:
+        print('WARNING: could not list ENCODE experiments, none removed from the mirror: {}'.format(str(e)))
+        return 0
+    listed = set(str(e["@id"]) for e in page.get("@graph", []) if "@id" in e)
+    if "total" not in page or len(listed) < int(page["total"]):
+        print('WARNING: incomplete list of ENCODE experiments, none removed from the mirror')
+        return 0
+    ids = [(i,) for (i,) in conn.execute('SELECT id FROM experiments').fetchall() if i not in listed]
+    with atlas_utils.span('mirror.remove', experiments=len(ids)), conn:
+        conn.executemany('DELETE FROM facets WHERE experiment = ?', ids)
+        conn.executemany('DELETE FROM experiments_text WHERE id = ?', ids)
+        conn.executemany('DELETE FROM experiments WHERE id = ?', ids)
+    return len(ids)
+
+
+def write_mirror_experiments( conn, experiments, fields ):
+    """ Adds or replaces experiments (ENCODE JSON objects) in the mirror, in one transaction.
+    ---
+    num_experiments: number of experiments written
+    """
+    if len(experiments) == 0:
+        return 0
+    with atlas_utils.span('mirror.write', experiments=len(experiments)), conn:
+        ids = [(str(e["@id"]),) for e in experiments]
+        conn.executemany('DELETE FROM facets WHERE experiment = ?', ids)
+        conn.executemany('DELETE FROM experiments_text WHERE id = ?', ids)
+        conn.executemany('INSERT OR REPLACE INTO experiments (id, date_released, date_modified, json) VALUES (?, ?, ?, ?)',
+                         [(str(e["@id"]), str(e.get('date_released', '')), str(e.get('date_modified', '')),
+                           json.dumps({k: e[k] for k in SEARCH_KEYS if k in e}))
+                          for e in experiments])
+        conn.executemany('INSERT INTO experiments_text (id, text) VALUES (?, ?)',
+                         [(str(e["@id"]), atlas_utils.text_index_terms( [v for f in TEXT_FIELDS + fields for v in get_field_values( e, f )] ))
+                          for e in experiments])
+        conn.executemany('INSERT INTO facets (experiment, field, value) VALUES (?, ?, ?)',
+                         [(str(e["@id"]), f, v) for e in experiments for f in fields for v in get_field_values( e, f )])
+    return len(experiments)
+
+
+@atlas_utils.traced('search_encode_mirror')
+def search_encode_mirror( query_string, mirror_file=None ):
+    """ Evaluates an ENCODE search query string (as built by search_encode) on the mirror.
+
+    query_string: ?type=Experiment&field=value&...&searchTerm=...
+    mirror_file: default MIRROR_FILE
+    ---
+    results: ENCODE-shaped search JSON {"@graph": [experiments]}, best searchTerm match first -
+             None if the query uses a field that is not mirrored, searches other objects than
+             experiments (type=Biosample), or the mirror has an older format
+
+    >>> import tempfile
+    >>> mirror_file = os.path.join(tempfile.mkdtemp(), 'mirror.sqlite')
+    >>> with contextlib.closing( open_mirror( mirror_file ) ) as conn:
+    ...     write_mirror_experiments( conn, [{"@id": "/experiments/E1/", "assay_title": "ATAC-seq", "description": "heart sample"},
+    ...                                      {"@id": "/experiments/E2/", "assay_title": "DNase-seq", "description": "liver sample, heart donor"}], ['assay_title'] )
+    ...     conn.executemany("INSERT INTO meta VALUES (?, ?)", [('fields', '["assay_title"]'), ('format', MIRROR_FORMAT)]).close()
+    ...     conn.commit()
+    2
+    >>> [e["@id"] for e in search_encode_mirror( '?type=Experiment&assay_title=ATAC-seq&assay_title=DNase-seq', mirror_file )["@graph"]]
+    ['/experiments/E1/', '/experiments/E2/']
+    >>> [e["@id"] for e in search_encode_mirror( '?type=Experiment&assay_title=DNase-seq&searchTerm=heart+liver', mirror_file )["@graph"]]
+    ['/experiments/E2/']
+    >>> [e["@id"] for e in search_encode_mirror( '?type=Experiment&searchTerm=dnase', mirror_file )["@graph"]]
+    ['/experiments/E2/']
+    >>> search_encode_mirror( '?type=Experiment&target.label=CTCF', mirror_file ) is None
+    True
+    """
+    params = parse_query( query_string )
+    with contextlib.closing( open_mirror( mirror_file ) ) as conn:
+        meta = get_mirror_meta( conn )
+        if meta.get('format') != MIRROR_FORMAT:
+            return None
+        mirrored = json.loads(meta.get('fields', '[]'))
+        filters = {}    # field: [values] - any value of a field, all fields
+        words = []
+        for k, v in params:
+            if k == 'searchTerm':
+                words += atlas_utils.text_words( v )
+            elif (k not in QUERY_OPTIONS and k not in mirrored) or (k == 'type' and v != 'Experiment'):
+                return None
+            elif k not in QUERY_OPTIONS:
+                filters.setdefault(k, []).append(v)
+        if len(words) > 0:
+            sql = 'SELECT experiments.json FROM experiments_text JOIN experiments ON experiments.id = experiments_text.id WHERE experiments_text MATCH ?'
+            sql_args = [atlas_utils.text_match_query( ' '.join(words) )]
+            order = ' ORDER BY bm25(experiments_text)'
+        else:
+            sql = 'SELECT json FROM experiments WHERE 1'
+            sql_args = []
+            order = ' ORDER BY experiments.rowid'
+        for field, values in filters.items():
+            sql += ' AND experiments.id IN (SELECT experiment FROM facets WHERE field = ? AND value IN ({}))'.format(','.join('?'*len(values)))
+            sql_args += [field] + values
+        with atlas_utils.span('mirror.query', filters=len(filters), words=len(words)):
+            graph = [json.loads(r[0]) for r in conn.execute(sql + order, sql_args)]
+    return {"@graph": graph, "total": len(graph)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local mirror of ENCODE experiment metadata, for offline BioShed ENCODE searches.')
+    parser.add_argument('action', choices=['sync', 'status'])
+    parser.add_argument('--full', action='store_true', help='download all experiments again instead of only new or changed ones')
+    parser.add_argument('--mirror', default=MIRROR_FILE, help='mirror file (default {})'.format(MIRROR_FILE))
+    parser.add_argument('--profile', nargs='?', const=atlas_utils.DEFAULT_PROFILE_FILE, default=None, help='write a JSON trace of the sync')
+    a = parser.parse_args()
+    if a.action == 'sync':
+        sync_encode_mirror( dict(full=str(a.full), mirror_file=a.mirror, profile=a.profile) )
+    elif not mirror_exists( a.mirror ):
+        print('No ENCODE mirror at {}. Type "python atlas_encode_mirror.py sync" to create it.'.format(a.mirror))
+    else:
+        with contextlib.closing( open_mirror( a.mirror ) ) as conn:
+            meta = get_mirror_meta( conn )
+            total = conn.execute('SELECT COUNT(*) FROM experiments').fetchone()[0]
+        print('ENCODE mirror {}: {} experiments from {}, last synced {}.'.format(a.mirror, str(total), meta.get('encode_url', ''), meta.get('synced', '')))
+
+
+if __name__ == '__main__':
+    main()
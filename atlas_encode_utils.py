@@ -1,14 +1,40 @@
-import sys, os, json
-import pandas as pd
+import sys, os, re, json, csv, hashlib
 SCRIPT_DIR = str(os.path.dirname(os.path.realpath(__file__)))
 sys.path.append(os.path.join(SCRIPT_DIR))
 import atlas_utils
+import atlas_http_utils
 sys.path.append('bioshed_utils/')
-import quick_utils
-import aws_s3_utils
+# heavy dependencies are only imported when first used (keeps --help and term listing fast)
+pd = atlas_utils.lazy_import('pandas')
+quick_utils = atlas_utils.lazy_import('quick_utils')
+aws_s3_utils = atlas_utils.lazy_import('aws_s3_utils')
+atlas_encode_mirror = atlas_utils.lazy_import('atlas_encode_mirror')
 
+ENCODE_URL = 'https://www.encodeproject.org'
 DEFAULT_SEARCH_FILE = os.path.join(os.getcwd(),"search_encode.txt")
+DEFAULT_PAGE_SIZE = 1000
+# search term tables (files/search_encode_<category>.txt) compiled into one lookup file - see compile_search_terms()
+SEARCH_TERMS_FILE = os.path.join(SCRIPT_DIR, 'files', 'search_encode_terms.json')
+# recompiled here at runtime if the tables no longer match SEARCH_TERMS_FILE (the install folder may be read-only)
+SEARCH_TERMS_CACHE_FILE = os.path.join(os.path.expanduser('~'), '.bioshed', 'cache', 'search_encode_terms.json')
+_search_terms = {}  # compiled search terms, loaded once per process by load_search_terms() (full-text index: find_ranked_search_terms())
+# search options that are not search categories
+SEARCH_OPTIONS = ['stream', 'pagesize', 'profile', 'online']
+# per-file fields kept in the search results file records (see get_encode_file_records)
+FILE_RECORD_FIELDS = ['@id', 'file_type', 'file_format', 'output_type', 'file_size', 'md5sum', 's3_uri']
+# fields requested from ENCODE for each kind of query, instead of full embedded objects (see encode_search_url)
+SEARCH_FIELDS = ['@id', 'assay_term_name', 'biosample_ontology.term_name', 'biosample_summary', 'dbxrefs'] + \
+                ['files.{}'.format(f) for f in FILE_RECORD_FIELDS] + ['files.cloud_metadata.url', 'files.platform']
+# columns of the search results table (search_encode.txt), see get_full_info_from_encode_json
+SEARCH_TABLE_COLUMNS = ['experiment', 'assay', 'celltype', 'species', 'accession', 'file']
+# columns of get_encode_table - the results can be grouped by any of them (see get_full_info_from_encode_json)
+TABLE_COLUMNS = SEARCH_TABLE_COLUMNS + ['platform']
+# columns of get_encode_table holding a list per experiment - grouping by them gives one group per list item
+LIST_COLUMNS = ['accession', 'file', 'platform']
+FILE_FIELDS = FILE_RECORD_FIELDS + ['cloud_metadata.url']
 
+@atlas_utils.served('search_encode')
+@atlas_utils.profiled('search_encode')
 def search_encode( args ):
     """ Entrypoint for an ENCODE search.
     $ bioshed search encode <searchterms>
@@ -20,12 +46,22 @@ def search_encode( args ):
     ---
     results: data frame of results
 
-    >>> search_encode( dict(searchterms='breast cancer rna-seq'))
-    ''
-    >>> search_encode( dict(searchterms='--tissue heart --assay chip-seq'))
-    ''
-    >>> search_encode( dict(searchterms='--assay single cell --tissue heart'))
-    ''
+    Against the benchmark's stand-in server (atlas_benchmark.start_stand_in), which answers every
+    search with the same experiments - the examples show the ENCODE query each search sends:
+    >>> import io, contextlib, tempfile, atlas_benchmark
+    >>> server = atlas_benchmark.start_stand_in( dict(atlas_benchmark.DEFAULT_PARAMS, latency=0, rows=10, experiments=3), tempfile.mkdtemp() )
+    >>> def search( searchterms ):
+    ...     with contextlib.redirect_stdout(io.StringIO()) as out:
+    ...         results = search_encode( dict(searchterms=searchterms + ' --online'))
+    ...     query = [line for line in out.getvalue().splitlines() if line.startswith('GET request: ')][0]
+    ...     return query[len('GET request: ' + server.url):].split('&limit=')[0], len(results)
+    >>> search('breast cancer rna-seq')
+    ('/search/?type=Experiment&searchTerm=breast+cancer+rna-seq', 3)
+    >>> search('--tissue heart --assay chip-seq')
+    ('/search/?type=Experiment&biosample_ontology.organ_slims=heart&&searchTerm=chip-seq', 3)
+    >>> search('--assay single cell --tissue heart')
+    ('/search/?type=Experiment&searchTerm=single+cell&&biosample_ontology.organ_slims=heart', 3)
+    >>> server.stop()
 
     Prints number of experiment datasets found and where results are output to (search_encode.txt).
     Outputs search results to search_encode.txt (tab-delimited text)
@@ -51,22 +87,58 @@ def search_encode( args ):
     For help with anything, type:
     $ bioshed search encode --help
     $ bioshed download encode --help
+
+    Large searches can be streamed page by page (no 50000-result limit, memory bounded by
+    the page size). Results are written to search_encode.txt as they arrive:
+
+    $ bioshed search encode --tissue heart --stream
+    $ bioshed search encode --tissue heart --stream --pagesize 500
+
+    To see where the time goes, --profile writes timings of the search steps (JSON trace,
+    see atlas_utils.write_profile) to bioshed_profile.json or the given file:
+
+    $ bioshed search encode --tissue heart --profile
+    $ bioshed search encode --tissue heart --profile search_profile.json
+
+    If a local mirror of ENCODE has been synced (see atlas_encode_mirror), searches run on it,
+    offline. --online searches ENCODE itself:
+
+    $ bioshed search encode --tissue heart --online
     """
     URL_BASE = 'https://encodeproject.org/search/'
     url_search_string = ''
     search_results = {}
     # dictionary of search terms: {"general": "...", "tissue": "...", "celltype": "..."...}
     search_dict = atlas_utils.parse_search_terms( args['searchterms'] ) if ('searchterms' in args and args['searchterms'] != '') else {}
+    stream = 'True' if ('stream' in search_dict or 'pagesize' in search_dict or ('stream' in args and args['stream'] == 'True')) else 'False'
+    pagesize = search_dict['pagesize'] if 'pagesize' in search_dict and search_dict['pagesize'] != '' else (args['pagesize'] if 'pagesize' in args else DEFAULT_PAGE_SIZE)
+    online = 'True' if ('online' in search_dict or ('online' in args and args['online'] == 'True')) else 'False'
+    for option in SEARCH_OPTIONS:
+        search_dict.pop(option, None)
     if search_dict == {} or 'help' in search_dict:
         print_encode_help()
     else:
         # start with search url base and build it according to search terms
         for category, terms in search_dict.items():
             url_search_string = combine_search_strings(url_search_string, convert_to_search_string( dict(terms=terms, category=category)))
-        if url_search_string != '' and '&searchTerm=&' not in url_search_string:
+        # category search terms matching the general words, best first (searched by category, they give more precise results)
+        matching_terms = find_ranked_search_terms( search_dict['general'], limit=5 ) if 'general' in search_dict else []
+        if len(matching_terms) > 0:
+            print('Search terms matching "{}": {}'.format(search_dict['general'], ', '.join('--{} {}'.format(c, term) for c, term in matching_terms)))
+        if url_search_string != '' and '&searchTerm=&' not in url_search_string and online == 'False' and atlas_encode_mirror.mirror_exists():
+            # offline search on the local mirror - None if the search is not covered by it
+            mirror_results = atlas_encode_mirror.search_encode_mirror( url_search_string )
+            if mirror_results is not None:
+                print('Searching the local ENCODE mirror (add --online to search ENCODE itself).')
+                return get_full_info_from_encode_json( dict(results=mirror_results, sortby='full', search_string='{}/search/{}'.format(ENCODE_URL, url_search_string)))
+            print('This search is not covered by the local ENCODE mirror - searching ENCODE.')
+        if url_search_string != '' and '&searchTerm=&' not in url_search_string and stream == 'True':
+            search_results = encode_search_stream( dict(url='/search/{}'.format(url_search_string), pagesize=pagesize))
+        elif url_search_string != '' and '&searchTerm=&' not in url_search_string:
             search_results = encode_search_url( dict(url='/search/{}'.format(url_search_string), searchtype='full', returntype='full'))
     return search_results
 
+@atlas_utils.traced('encode_search_url')
 def encode_search_url( args ):
     """ Searches ENCODE by a URL suffix.
     https://www.encodeproject.org/<URL_SUFFIX>
@@ -74,6 +146,8 @@ def encode_search_url( args ):
     url: url suffix to search
     searchtype: 'full' (full search), 'experiment' (search within an experiment), 'file' (search within a file)
     returntype: 'full' (default), 'raw', 'file', 'experiment', 'celltype', 'assay', 'platform',...
+    cache: 'True' (default) to go through the on-disk response cache (atlas_http_utils.get_json_cached), 'False' to always refetch
+    fields: 'True' (default) to only request the fields needed for the returntype, 'False' for full objects
     ---
     results:
 
@@ -84,25 +158,52 @@ def encode_search_url( args ):
         ex: returntype='file'
         FILE    EXPERIMENT  CELLTYPE    ASSAY   ACCESSION
         ... (one row per file)
-    [NOTE] search is limited to 50000 results
+    [NOTE] search is limited to 50000 results - see encode_search_stream() for larger searches
+    [NOTE] Unless returntype is 'raw', only the fields that are used are requested:
+      - full searches request SEARCH_FIELDS (&field=...)
+      - file lookups within an experiment become a File search on the experiment, requesting FILE_FIELDS
+      If a projected response is missing a required field (@id, or any file location for
+      file lookups), the query is repeated for full objects.
 
-    >>> encode_search_url(dict(url="experiments/ENCSR000BDC/", searchtype="experiment", returntype="raw"))
-    ''
-    >>> encode_search_url(dict(url="experiments/ENCSR000BDC/", searchtype="experiment", returntype="file"))
-    ''
+    Against the benchmark's stand-in server (atlas_benchmark.start_stand_in):
+    >>> import tempfile, atlas_benchmark
+    >>> server = atlas_benchmark.start_stand_in( dict(atlas_benchmark.DEFAULT_PARAMS, latency=0, rows=10, experiments=3), tempfile.mkdtemp() )
+    >>> experiment = encode_search_url(dict(url="experiments/ENCSR000001/", searchtype="experiment", returntype="raw"))  # doctest: +ELLIPSIS
+    GET request: http://127.0.0.1:.../experiments/ENCSR000001/
+    >>> experiment["assay_term_name"], len(experiment["files"])
+    ('WGS-whole-genome-seq', 2)
+    >>> files = encode_search_url(dict(url="experiments/ENCSR000001/", searchtype="experiment", returntype="file"))  # doctest: +ELLIPSIS
+    GET request: http://127.0.0.1:.../search/?type=File&dataset=/experiments/ENCSR000001/&limit=all&field=@id...
+    >>> [f.split('/')[-1] for f in files]
+    ['ENCFF00000100.fastq', 'ENCFF00000101.bam']
+    >>> server.stop()
     """
     returntype = args['returntype'] if 'returntype' in args else 'full'
     searchtype = args['searchtype'] if 'searchtype' in args else 'full'
+    cache = args['cache'] if 'cache' in args else 'True'
+    fields = args['fields'] if 'fields' in args else 'True'
     if 'url' not in args:
         print('ERROR: You need to specify a URL.')
         return {}
     elif str(args['url']).lstrip('/').startswith('search'):
-        search_url = 'https://www.encodeproject.org/{}&limit=50000'.format(str(args['url']).lstrip('/'))
+        search_url = '{}/{}&limit=50000'.format(ENCODE_URL, str(args['url']).lstrip('/'))
     else:
-        search_url = 'https://www.encodeproject.org/{}'.format(str(args['url']).lstrip('/'))
+        search_url = '{}/{}'.format(ENCODE_URL, str(args['url']).lstrip('/'))
 
-    print('GET request: {}'.format(search_url))
-    results_raw = quick_utils.get_request( dict(url=search_url, type='application/json'))
+    results_raw = None
+    if fields == 'True' and returntype.lower() != 'raw' and searchtype.lower() == 'full':
+        # full search: only request the table columns
+        results_raw = encode_get_json( search_url + get_field_string( SEARCH_FIELDS ), cache )
+        if "@graph" not in results_raw or any("@id" not in e for e in results_raw["@graph"]):
+            results_raw = None
+    elif fields == 'True' and returntype.lower() == 'file' and searchtype.lower() == 'experiment':
+        # files of an experiment: search for the experiment's files, only requesting download info
+        file_search_url = '{}/search/?type=File&dataset=/{}&limit=all{}'.format(ENCODE_URL, str(args['url']).strip('/')+'/', get_field_string( FILE_FIELDS ))
+        file_results = encode_get_json( file_search_url, cache )
+        if "@graph" in file_results and any(get_file_location( f, True ) != '' for f in file_results["@graph"]):
+            results_raw = {"@id": '/{}'.format(str(args['url']).strip('/')+'/'), "files": file_results["@graph"]}
+    if results_raw is None:
+        results_raw = encode_get_json( search_url, cache )
     if returntype.lower() == 'raw':
         return results_raw
     elif searchtype.lower() == 'full':
@@ -114,15 +215,183 @@ def encode_search_url( args ):
     else:
         return results_raw
 
+def encode_get_json( url, cache='True' ):
+    """ GET request for an ENCODE JSON page.
+    url: full URL
+    cache: 'True' (default) to go through the on-disk response cache, 'False' to always refetch
+    ---
+    results: decoded JSON
+    """
+    print('GET request: {}'.format(url))
+    if cache == 'True':
+        return atlas_http_utils.get_json_cached( url )
+    return atlas_http_utils.get_json( url )
+
+def get_field_string( fields ):
+    """ Returns the URL parameters requesting only the given fields of ENCODE objects.
+
+    >>> get_field_string(['@id', 'files.s3_uri'])
+    '&field=@id&field=files.s3_uri'
+    """
+    return ''.join(['&field={}'.format(f) for f in fields])
+
+def iter_encode_search( args ):
+    """ Generator over the experiments of an ENCODE search, fetched one page at a time.
+    Only one page of results is held in memory, and there is no limit on the number of results.
+
+    url: search url suffix (/search/?type=Experiment&...)
+    pagesize: number of results requested per page (default 1000)
+    cache: 'True' (default) to go through the on-disk response cache
+    fields: 'True' (default) to only request SEARCH_FIELDS, 'False' for full objects
+    ---
+    yields: experiment JSON objects (entries of "@graph"), in search order
+    """
+    pagesize = int(args['pagesize']) if 'pagesize' in args else DEFAULT_PAGE_SIZE
+    cache = args['cache'] if 'cache' in args else 'True'
+    fields = args['fields'] if 'fields' in args else 'True'
+    search_url = '{}/{}'.format(ENCODE_URL, str(args['url']).lstrip('/'))
+    start = 0
+    while True:
+        page_url = '{}&limit={}&from={}'.format(search_url, str(pagesize), str(start))
+        page = encode_get_json( page_url + (get_field_string( SEARCH_FIELDS ) if fields == 'True' else ''), cache )
+        if fields == 'True' and ("@graph" not in page or any("@id" not in e for e in page["@graph"])):
+            page = encode_get_json( page_url, cache )
+        graph = page["@graph"] if "@graph" in page else []
+        for fullexpt in graph:
+            yield fullexpt
+        start += len(graph)
+        if len(graph) < pagesize or ("total" in page and start >= int(page["total"])):
+            break
+
+@atlas_utils.traced('encode_search_stream')
+def encode_search_stream( args ):
+    """ Streaming version of a full ENCODE search (encode_search_url with searchtype='full').
+    Rows are written to search_encode.txt as pages of results arrive, in the same
+    format as get_full_info_from_encode_json.
+
+    url: search url suffix (/search/?type=Experiment&...)
+    pagesize: number of results requested per page (default 1000)
+    ---
+    num_experiments: number of experiments written
+    """
+    url = args['url']
+    columns = ['experiment', 'assay', 'celltype', 'species', 'accession', 'file']
+    assays = set()
+    celltypes = set()
+    num_experiments = 0
+    num_files = 0
+    with open(DEFAULT_SEARCH_FILE,'w', newline='') as fout, open(encode_files_file( DEFAULT_SEARCH_FILE ),'w') as fout_files:
+        fout.write('# bioshed search encode {}/{}\n'.format(ENCODE_URL, str(url).lstrip('/')))
+        writer = csv.writer(fout, delimiter='\t', lineterminator='\n')
+        writer.writerow(['index'] + columns)
+        for fullexpt in iter_encode_search( args ):
+            if "@id" in fullexpt:
+                row = get_encode_row( fullexpt )
+                writer.writerow([num_experiments] + [row[c] for c in columns])
+                for record in get_encode_file_records( fullexpt ):
+                    fout_files.write(json.dumps(record)+'\n')
+                num_experiments += 1
+                num_files += len(row['file'])
+                assays.add(row['assay'])
+                celltypes.add(row['celltype'])
+    print('Number of experiment datasets found: {}'.format(str(num_experiments)))
+    print('Number of assays found: {}'.format(str(len(assays))))
+    print('Number of cell types found: {}'.format(str(len(celltypes))))
+    print('Number of total files found: {}'.format(str(num_files)))
+    print('Search results written to {}.'.format(DEFAULT_SEARCH_FILE.split('/')[-1]))
+    print('Type "bioshed download encode" to download data files or "bioshed download encode --list" for file info before downloading.')
+    return num_experiments
+
+def get_encode_row( fullexpt ):
+    """ Gets a row of the search results table from a single experiment of an ENCODE search JSON.
+    fullexpt: experiment JSON object (entry of "@graph")
+    ---
+    row: {"experiment": ..., "assay": ..., "celltype": ..., "species": ..., "accession": [...], "file": [...]}
+    """
+    return {"experiment": str(fullexpt["@id"]),
+            "assay": str(fullexpt["assay_term_name"]) if "assay_term_name" in fullexpt else '',
+            "celltype": str(fullexpt["biosample_ontology"]["term_name"]) if "biosample_ontology" in fullexpt and "term_name" in fullexpt["biosample_ontology"] else '',
+            "species": ' '.join(str(fullexpt["biosample_summary"]).split(' ')[0:2]) if "biosample_summary" in fullexpt else '',
+            "accession": list(fullexpt["dbxrefs"]) if "dbxrefs" in fullexpt else [],
+            "file": list(map(lambda f: f["@id"], fullexpt["files"])) if "files" in fullexpt else []}
+
+def encode_files_file( search_file ):
+    """ Returns the file records file that goes with a search results file.
+
+    >>> encode_files_file('search_encode.txt')
+    'search_encode.files.jsonl'
+    """
+    return (search_file[:-4] if search_file.endswith('.txt') else search_file) + '.files.jsonl'
+
+def get_encode_file_records( fullexpt ):
+    """ Gets download info for each file of an experiment from an ENCODE search JSON.
+    fullexpt: experiment JSON object (entry of "@graph")
+    ---
+    records: list of {"experiment": ..., "@id": ..., "file_type": ..., "file_size": ..., "md5sum": ..., "s3_uri": ..., "cloud_metadata": {"url": ...}}
+             (only fields present in the search JSON are included - see FILE_RECORD_FIELDS)
+
+    These are written to search_encode.files.jsonl (one JSON record per line), so that
+    download_encode can get file locations without further ENCODE requests.
+    """
+    records = []
+    for f in (fullexpt["files"] if "files" in fullexpt else []):
+        if isinstance(f, dict) and "@id" in f:
+            record = {"experiment": str(fullexpt["@id"])}
+            for field in FILE_RECORD_FIELDS:
+                if field in f:
+                    record[field] = f[field]
+            if "cloud_metadata" in f and "url" in f["cloud_metadata"]:
+                record["cloud_metadata"] = {"url": f["cloud_metadata"]["url"]}
+            records.append(record)
+    return records
+
+def read_encode_file_records( search_file, experiment_urls ):
+    """ Reads file records saved with a search results file, for the given experiments.
+    search_file: search results file (search_encode.txt)
+    experiment_urls: experiments to get file records for
+    ---
+    file_records: {experiment: [file record, ...]} - experiments without any file location are left out
+    """
+    file_records = {}
+    records_file = encode_files_file( search_file )
+    if not os.path.exists(records_file):
+        return file_records
+    wanted = set(experiment_urls)
+    with open(records_file,'r') as f:
+        for r in f:
+            record = json.loads(r)
+            if record["experiment"] in wanted:
+                file_records.setdefault(record["experiment"], []).append(record)
+    for e_url in list(file_records.keys()):
+        if all(get_file_location( record, True ) == '' for record in file_records[e_url]):
+            file_records.pop(e_url)
+    return file_records
+
+def get_file_location( f, aws ):
+    """ Gets the location to download a file from, from its ENCODE file JSON or file record.
+    f: file JSON object / file record
+    aws: True if AWS is set up (S3 URIs are then preferred over HTTPS URLs)
+    ---
+    location: S3 URI or HTTPS URL ('' if none is known)
+    """
+    if "s3_uri" in f and f["s3_uri"] and aws:
+        return f["s3_uri"]
+    elif "cloud_metadata" in f and "url" in f["cloud_metadata"]:
+        return f["cloud_metadata"]["url"]
+    return ''
+
+@atlas_utils.traced('get_full_info_from_encode_json')
 def get_full_info_from_encode_json( args ):
     """ Get experiments with full info from an ENCODE search JSON.
     results: results_raw
-    sortby: which column to sort by - full/experiment (default), file, assay, etc...
+    sortby: which column to sort by - full/experiment (default), or any other column of get_encode_table:
+            assay, celltype, species, accession, file, platform
     returntype: JSON or dataframe (default)
     search_string: original search string
     ---
     fullinfo: JSON or dataframe
     DEFAULT_SEARCH_FILE (outfile): table
+    search_encode.files.jsonl (outfile): download info for each file (see get_encode_file_records)
 
     https://www.encodeproject.org/search/?type=Experiment&searchTerm=breast+cancer
     FOR EACH EXPERIMENT:
@@ -143,58 +412,87 @@ def get_full_info_from_encode_json( args ):
     returntype = args['returntype'] if 'returntype' in args else 'pandas'
     search_string = args['search_string'] if 'search_string' in args else ''
 
+    if sortby not in ['full'] + TABLE_COLUMNS:
+        print('ERROR: cannot sort ENCODE results by {}. Choose one of: full, {}'.format(sortby, ', '.join(TABLE_COLUMNS)))
+        return {}
+    df = get_encode_table( results["@graph"] if "@graph" in results else [], SEARCH_TABLE_COLUMNS + ([sortby] if sortby not in ['full'] + SEARCH_TABLE_COLUMNS else []) )
     if sortby in ['full', 'experiment']:
-        tbl = {"experiment": [], "assay": [], "celltype": [], "species": [], "accession": [], "file": []}
-        for fullexpt in results["@graph"]:
-            if "@id" in fullexpt:
-                tbl['experiment'].append(str(fullexpt["@id"]))
-                tbl['assay'].append(str(fullexpt["assay_term_name"]) if "assay_term_name" in fullexpt else '')
-                tbl['celltype'].append(str(fullexpt["biosample_ontology"]["term_name"]) if "biosample_ontology" in fullexpt and "term_name" in fullexpt["biosample_ontology"] else '')
-                tbl['species'].append(' '.join(str(fullexpt["biosample_summary"]).split(' ')[0:2]) if "biosample_summary" in fullexpt else '')
-                tbl['accession'].append(list(fullexpt["dbxrefs"]) if "dbxrefs" in fullexpt else [])
-                tbl['file'].append(list(map(lambda f: f["@id"], fullexpt["files"])) if "files" in fullexpt else [])
-        print('Number of experiment datasets found: {}'.format(str(len(tbl['experiment']))))
-        print('Number of assays found: {}'.format(str(len(list(set(tbl['assay']))))))
-        print('Number of cell types found: {}'.format(str(len(list(set(tbl['celltype']))))))
-        print('Number of total files found: {}'.format(str(sum([len(e) for e in tbl['file']]))))
-    elif sortby == 'assay':
-        # create joined table for gathering info
-        jtbl = {}  # key is assay
-        for fullexpt in results["@graph"]:
-            if "@id" in fullexpt and "assay_term_name" in fullexpt:
-                assay = fullexpt["assay_term_name"]
-                if assay not in jtbl:
-                    jtbl[assay] = {"experiment": [], "celltype": [], "species": [], "accession": [], "file": []}
-                jtbl[assay]["experiment"].append(str(fullexpt["@id"]))
-                if "biosample_ontology" in fullexpt and "term_name" in fullexpt["biosample_ontology"]:
-                    jtbl[assay]['celltype'].append(str(fullexpt["biosample_ontology"]["term_name"]))
-                if "biosample_summary" in fullexpt:
-                    jtbl[assay]['species'].append(' '.join(str(fullexpt["biosample_summary"]).split(' ')[0:2]))
-                if "dbxrefs" in fullexpt:
-                    jtbl[assay]['accession'].append(list(fullexpt["dbxrefs"]))
-                if "files" in fullexpt:
-                    jtbl[assay]['file'].append(list(map(lambda f: f["@id"], fullexpt["files"])))
-        # create flat table for output
-        tbl = {"assay": [], "experiment": [], "celltype": [], "species": [], "accession": [], "file": []} # full table
-        for k, v in jtbl.items():
-            tbl["assay"].append(k)
-            tbl["experiment"].append(v["experiment"] if "experiment" in v else '')
-            tbl["celltype"].append(v["celltype"] if "celltype" in v else '')
-            tbl["species"].append(v["species"] if "species" in v else '')
-            tbl["accession"].append(v["accession"] if "accession" in v else [])
-            tbl["file"].append(v["file"] if "file" in v else [])
+        tbl_df = df[SEARCH_TABLE_COLUMNS]
+        print('Number of experiment datasets found: {}'.format(str(len(tbl_df))))
+        print('Number of assays found: {}'.format(str(tbl_df['assay'].nunique())))
+        print('Number of cell types found: {}'.format(str(tbl_df['celltype'].nunique())))
+        print('Number of total files found: {}'.format(str(int(tbl_df['file'].str.len().sum()))))
+    else:
+        # joined table: one row per value of the sortby column, with the other columns as lists
+        key_df = df.explode(sortby) if sortby in LIST_COLUMNS else df
+        key_df = key_df.loc[key_df[sortby].notna() & (key_df[sortby] != '')]
+        tbl_df = key_df[[sortby] + [c for c in SEARCH_TABLE_COLUMNS if c != sortby]].groupby(sortby, sort=False).agg(list).reset_index()
+        print('Number of {} values found: {}'.format(sortby, str(len(tbl_df))))
 
     if returntype in ['pandas', 'dataframe']:
         with open(DEFAULT_SEARCH_FILE,'w') as fout:
             fout.write('# bioshed search encode {}\n'.format(search_string))
-        tbl_df = pd.DataFrame(tbl)
         tbl_df.index.name = 'index'
         tbl_df.to_csv(DEFAULT_SEARCH_FILE, sep='\t', mode='a')
+        if sortby in ['full', 'experiment']:
+            with open(encode_files_file( DEFAULT_SEARCH_FILE ),'w') as fout:
+                for fullexpt in results["@graph"]:
+                    if "@id" in fullexpt:
+                        for record in get_encode_file_records( fullexpt ):
+                            fout.write(json.dumps(record)+'\n')
         print('Search results written to {}.'.format(DEFAULT_SEARCH_FILE.split('/')[-1]))
         print('Type "bioshed download encode" to download data files or "bioshed download encode --list" for file info before downloading.')
         return tbl_df
     else:
-        return tbl
+        return tbl_df.to_dict('list')
+
+def get_encode_table( graph, columns=TABLE_COLUMNS ):
+    """ Normalizes the experiments of an ENCODE search JSON into a table, one row per experiment.
+    graph: experiment JSON objects ("@graph" of a search JSON) - entries without "@id" are skipped
+    columns: columns to build (default all: experiment, assay, celltype, species, accession (list), file (list), platform (list))
+    ---
+    df: data frame with the requested columns
+
+    Values are the same as get_encode_row (platform: see get_file_platforms).
+    """
+    graph = [fullexpt for fullexpt in graph if "@id" in fullexpt]
+    tbl = {}
+    if "experiment" in columns:
+        tbl["experiment"] = [str(fullexpt["@id"]) for fullexpt in graph]
+    if "assay" in columns:
+        tbl["assay"] = [str(fullexpt.get("assay_term_name", '')) for fullexpt in graph]
+    if "celltype" in columns:
+        tbl["celltype"] = [str((fullexpt.get("biosample_ontology") or {}).get("term_name", '')) for fullexpt in graph]
+    if "species" in columns:
+        # first two words of the biosample summary ("Homo sapiens MCF-7" => "Homo sapiens")
+        tbl["species"] = [' '.join(str(fullexpt.get("biosample_summary", '')).split(' ', 2)[0:2]) for fullexpt in graph]
+    if "accession" in columns:
+        tbl["accession"] = [list(fullexpt.get("dbxrefs", [])) for fullexpt in graph]
+    if "file" in columns:
+        tbl["file"] = [[f["@id"] if isinstance(f, dict) else str(f) for f in fullexpt.get("files", [])] for fullexpt in graph]
+    if "platform" in columns:
+        tbl["platform"] = [get_file_platforms( fullexpt.get("files", []) ) for fullexpt in graph]
+    return pd.DataFrame(tbl, columns=[c for c in columns if c in tbl], dtype=object)
+
+def get_file_platforms( files ):
+    """ Gets the sequencing/array platforms of an experiment's files, in order of first appearance.
+    files: file objects of an experiment - "platform" is either an embedded object or a link
+    ---
+    platforms: list of platform names
+
+    >>> get_file_platforms([{"platform": {"term_name": "Illumina HiSeq 2000"}}, {"platform": "/platforms/OBI:0002001/"}, {}, "/files/ENCFF001/"])
+    ['Illumina HiSeq 2000', 'OBI:0002001']
+    """
+    platforms = []
+    for f in files:
+        platform = f["platform"] if isinstance(f, dict) and "platform" in f else ''
+        if isinstance(platform, dict):
+            platform = str(platform["term_name"]) if "term_name" in platform else ''
+        else:
+            platform = str(platform).strip('/').split('/')[-1]
+        if platform != '' and platform not in platforms:
+            platforms.append(platform)
+    return platforms
 
 def get_experiments_from_encode_json( args ):
     """ Get experiment IDs from an ENCODE search JSON.
@@ -218,7 +516,6 @@ def get_files_from_encode_json( args ):
     ---
     relevant_files: list of S3 file URIs
 
-    [TODO] for 'file' searchtype, can get HTTPS object link via 'cloud_metadata' key.
     [TODO] deal with JSON entries that don't have s3_uri (e.g., SRA files) - GET request: https://www.encodeproject.org/experiments/ENCSR860HAA/
     """
     results = args['results']
@@ -229,19 +526,17 @@ def get_files_from_encode_json( args ):
     if searchtype in ['experiment']:
         # original search was an experiment
         if "files" in results:
+            aws = quick_utils.cloud_initialized(dict(cloud='aws'))
             for f in results["files"]:
-                if cloud in ['s3','aws','amazon']:                    
-                    if "s3_uri" in f and quick_utils.cloud_initialized(dict(cloud='aws')):
-                        relevant_files.append(f["s3_uri"])
-                    elif "cloud_metadata" in f and "url" in f["cloud_metadata"]:
-                        relevant_files.append(f["cloud_metadata"]["url"])
+                if cloud in ['s3','aws','amazon'] and get_file_location( f, aws ) != '':
+                    relevant_files.append(get_file_location( f, aws ))
     elif searchtype in ['file']:
-        if "s3_uri" in results and quick_utils.cloud_initialized(dict(cloud='aws')):
-            relevant_files.append(results["s3_uri"])
-        elif "cloud_metadata" in f and "url" in f["cloud_metadata"]:
-            revelant_files.append(results["cloud_metadata"]["url"])        
+        if get_file_location( results, quick_utils.cloud_initialized(dict(cloud='aws')) ) != '':
+            relevant_files.append(get_file_location( results, quick_utils.cloud_initialized(dict(cloud='aws')) ))
     return relevant_files
 
+@atlas_utils.served('download_encode', condition=atlas_utils.list_only)
+@atlas_utils.profiled('download_encode')
 def download_encode( args ):
     """ Entrypoint for an ENCODE download.
     Assumes that search_encode() has already been run, so that a search_encode.txt file exists.
@@ -259,12 +554,36 @@ def download_encode( args ):
     --experiment <refine by experiment ID>
     --celltype <refine by cell type>
     --index <refine by index>
+    --workers <number of concurrent ENCODE metadata requests and file transfers (default 8)>
+    --profile <write timings of the download steps to a JSON trace (default bioshed_profile.json)>
+
+    Experiment metadata is fetched concurrently, rate-limited per host to ENCODE's
+    request limit (atlas_http_utils.HOST_MAX_REQUESTS_PER_SECOND).
+    HTTP files are downloaded concurrently, largest first (atlas_http_utils.download_http_all).
 
     [TODO] Clean up documentation and write tests
 
+    Against the benchmark's stand-in server (atlas_benchmark.start_stand_in), whose experiments
+    have a fastq and a bam file each - --filetype matches the file type, not the file path:
+    >>> import io, contextlib, tempfile, atlas_benchmark, atlas_encode_utils
+    >>> server = atlas_benchmark.start_stand_in( dict(atlas_benchmark.DEFAULT_PARAMS, latency=0, rows=10, experiments=3), tempfile.mkdtemp() )
+    >>> with contextlib.redirect_stdout(io.StringIO()):
+    ...     results = search_encode( dict(searchterms='breast cancer --online'))
+    >>> def list_files( downloadstr ):
+    ...     with contextlib.redirect_stdout(io.StringIO()) as out:
+    ...         download_encode( dict(downloadstr='--list --input {} {}'.format(atlas_encode_utils.DEFAULT_SEARCH_FILE, downloadstr)))
+    ...     return [line.split('\\t')[0] for line in out.getvalue().splitlines()[1:]]
+    >>> list_files('--filetype bam')
+    ['ENCFF00000001.bam', 'ENCFF00000101.bam', 'ENCFF00000201.bam']
+    >>> list_files('--filetype files')
+    []
+    >>> server.stop()
+
     [NOTE] Current format for search_encode.txt is:
     index	experiment	assay	celltype	species	accession	file
     0	/experiments/ENCSR718YPN/	single-nucleus ATAC-seq	heart left ventricle	Homo sapiens	[]	['/files/ENCFF804ONU/', '/files/ENCFF393IGF/',...]
+    with file locations, sizes and md5s in search_encode.files.jsonl. Experiments missing
+    from search_encode.files.jsonl are looked up on ENCODE.
 
     [NOTE] Use str.contains:  df2 = df.loc[df['celltype'].str.contains('heart', case=False)]
     [DONE] s3 file transfer function in aws_s3_utils
@@ -275,15 +594,18 @@ def download_encode( args ):
     infile = dd['input'] if 'input' in dd else 'search_encode.txt'
     outdir = dd['output'] if 'output' in dd else str(os.getcwd())
     filetype = dd['filetype'] if 'filetype' in dd else ''
-    assay = dd['filetype'] if 'filetype' in dd else ''
+    assay = dd['assay'] if 'assay' in dd else ''
     species = dd['species'] if 'species' in dd else ''
     experiment = dd['experiment'] if 'experiment' in dd else ''
     celltype = dd['celltype'] if 'celltype' in dd else ''
     index = dd['index'] if 'index' in dd else ''
     listonly = 'True' if 'list' in dd else ''
     updateonly = 'True' if 'update' in dd else ''
+    workers = int(dd['workers']) if 'workers' in dd and dd['workers'] != '' else atlas_http_utils.DEFAULT_WORKERS
     outfiles = []
     outfiles_info = {}
+    outfiles_records = {}   # file location: file record from the search (size, md5...)
+    outfiles_experiment = {}    # file location: experiment URL
     downloaded_files = []
     eids = []
     annotation_info = []
@@ -299,37 +621,61 @@ def download_encode( args ):
             if r[0] == '#':
                 original_search_command = r.strip()
         # get table
-        df = pd.read_csv(infile, sep='\t', comment='#')
-        if assay != '':
-            df = df.loc[df['assay'].str.contains(assay, case=False)]
-        if species != '':
-            df = df.loc[df['species'].str.contains(species, case=False)]
-        if experiment != '':
-            # if --experiment filter is specified
-            eids = list(map(lambda e: '/experiments/{}/'.format(e), quick_utils.format_type(experiment, 'list')))
-            # df = df.loc[df['experiment'].str.lower().contains(experiment, case=False)]
-        if celltype != '':
-            df = df.loc[df['celltype'].str.lower().contains(celltype, case=False)]
-        if index != '':
-            df = df.loc[df['index'].str.lower().contains(index, case=False)]
-
-        experiment_urls = list(df['experiment'])
+        with atlas_utils.span('download_encode.filter'):
+            df = pd.read_csv(infile, sep='\t', comment='#')
+            if assay != '':
+                df = df.loc[df['assay'].str.contains(assay, case=False)]
+            if species != '':
+                df = df.loc[df['species'].str.contains(species, case=False)]
+            if experiment != '':
+                # if --experiment filter is specified
+                eids = list(map(lambda e: '/experiments/{}/'.format(e), quick_utils.format_type(experiment, 'list')))
+                # df = df.loc[df['experiment'].str.lower().contains(experiment, case=False)]
+            if celltype != '':
+                df = df.loc[df['celltype'].str.contains(celltype, case=False)]
+            if index != '':
+                df = df.loc[df['index'].astype(str).str.contains(index, case=False)]
+
+        experiment_urls = list(filter(lambda e_url: len(eids)==0 or e_url in eids, list(df['experiment'])))
+        # get paths of all files for each experiment - from the file records saved by the search when
+        # available, otherwise from ENCODE (concurrent requests, results in experiment order)
+        with atlas_utils.span('download_encode.file_records'):
+            file_records = read_encode_file_records( infile, experiment_urls )
+        lookup_urls = list(filter(lambda e_url: e_url not in file_records, experiment_urls))
+        with atlas_utils.span('download_encode.lookup', experiments=len(lookup_urls)):
+            experiment_files = dict(zip(lookup_urls, atlas_http_utils.map_concurrent( lambda e_url: encode_search_url( dict(url=e_url, searchtype='experiment', returntype='file')),
+                                                                                       lookup_urls, workers=workers )))
+        aws = quick_utils.cloud_initialized(dict(cloud='aws')) if len(file_records) > 0 else False
+        # annotation of each experiment: values of INFO_COLUMNS, for every row of the experiment
+        experiment_info = {}
+        for values in zip(*[df[c] for c in INFO_COLUMNS]):
+            experiment_info.setdefault(values[0], []).extend(values)
+        experiment_info = {e_url: '; '.join(list(map(str, values))) for e_url, values in experiment_info.items()}
         for e_url in experiment_urls:
-            if len(eids)==0 or (len(eids)>0 and e_url in eids):
-                # get paths of all files for each experiment
-                outfiles_new = encode_search_url( dict(url=e_url, searchtype='experiment', returntype='file'))
-                outfiles += outfiles_new
-                for outfile in outfiles_new:
-                    outfiles_info[outfile] = '; '.join(list(map(str, df.loc[df['experiment']==e_url][INFO_COLUMNS].values.flatten().tolist())))
+            if e_url in file_records:
+                outfiles_new = []
+                for record in file_records[e_url]:
+                    location = get_file_location( record, aws )
+                    if location != '':
+                        outfiles_new.append(location)
+                        outfiles_records[location] = record
+            else:
+                outfiles_new = experiment_files[e_url]
+            outfiles += outfiles_new
+            for outfile in outfiles_new:
+                outfiles_info[outfile] = experiment_info[e_url]
+                outfiles_experiment[outfile] = e_url
 
         if filetype!='':
-            # if --filetype filter is specified
+            # if --filetype filter is specified: keep files whose file type (from the file record,
+            # or the file path for files looked up without a record) contains every file type
             ftypes = quick_utils.format_type(filetype, 'list')
-            for ftype in ftypes:
-                outfiles = list(filter(lambda f: ftype in f, outfiles))
-                removed_files = list(filter(lambda f: ftype not in f, outfiles))
-                for removed_file in removed_files:
-                    removed_info = outfiles_info.pop(removed_file, 'not found')
+            def filetype_matches( outfile ):
+                record = outfiles_records[outfile] if outfile in outfiles_records else {}
+                file_type = record['file_type'] if 'file_type' in record else outfile
+                return all(ftype in file_type for ftype in ftypes)
+            outfiles = list(filter(filetype_matches, outfiles))
+            outfiles_info = {outfile: outfiles_info[outfile] for outfile in outfiles}
 
         # gather annotation info
         annotation_info.append('FILE\tINFO (EXPT; ASSAY; CELLTYPE; SPECIES)')
@@ -344,20 +690,25 @@ def download_encode( args ):
             # download files
             if outdir.startswith('s3') and len(outfiles) > 0 and outfiles[0].startswith('s3'):
                 # s3-to-s3 file transfer
-                downloaded_files = aws_s3_utils.transfer_file_s3( dict(path=outfiles, outpath=outdir, overwrite='False' if updateonly=='True' else 'True'))
+                with atlas_utils.span('transfer_file_s3', files=len(outfiles)):
+                    downloaded_files = aws_s3_utils.transfer_file_s3( dict(path=outfiles, outpath=outdir, overwrite='False' if updateonly=='True' else 'True'))
             elif not outdir.startswith('s3') and len(outfiles) > 0 and outfiles[0].startswith('s3'):
                 # s3 download to local
-                downloaded_files = aws_s3_utils.download_file_s3( dict(path=outfiles, localdir=outdir, overwrite='False' if updateonly=='True' else 'True'))
+                with atlas_utils.span('download_file_s3', files=len(outfiles)):
+                    downloaded_files = aws_s3_utils.download_file_s3( dict(path=outfiles, localdir=outdir, overwrite='False' if updateonly=='True' else 'True'))
             elif not outdir.startswith('s3') and len(outfiles) > 0 and outfiles[0].startswith('http'):
                 # http download to local
-                for outfile in outfiles:
-                    print('Downloading {}'.format(outfile))                
-                    # get http(s) file    
-                    _response = quick_utils.get_request( dict(url=outfile))
-                    # write to local file
-                    open(os.path.join(outdir, quick_utils.get_file_only(outfile)), 'wb').write(_response.content)
-                    # save list of downloaded files
-                    downloaded_files.append(os.path.join(outdir, quick_utils.get_file_only(outfile)))
+                # a file listed by several experiments is downloaded once, and files with the
+                # same name from different experiments are saved as <experiment accession>_<name>
+                outfiles = list(dict.fromkeys(outfiles))
+                local_files = atlas_http_utils.unique_outfiles( [os.path.join(outdir, quick_utils.get_file_only(outfile)) for outfile in outfiles],
+                                                                [outfiles_experiment[outfile].strip('/').split('/')[-1] for outfile in outfiles] )
+                downloads = []
+                for outfile, local_file in zip(outfiles, local_files):
+                    record = outfiles_records[outfile] if outfile in outfiles_records else {}
+                    downloads.append(dict(url=outfile, outfile=local_file,
+                                          size=record['file_size'] if 'file_size' in record else None, md5=record['md5sum'] if 'md5sum' in record else ''))
+                downloaded_files = atlas_http_utils.download_http_all( downloads, workers=workers, overwrite='False' if updateonly=='True' else 'True' )
             
             # write out annotation info
             with open(ANNOTATION_INFO_FILE,'w') as fout:
@@ -414,6 +765,13 @@ def print_encode_help():
     print('To list search terms (example):\n')
     print('\t$ bioshed search encode --tissue')
     print('')
+    print('To stream very large searches page by page (no 50000-result limit):\n')
+    print('\t$ bioshed search encode --tissue heart --stream')
+    print('\t$ bioshed search encode --tissue heart --stream --pagesize 500\n')
+    print('To search offline, sync a local mirror of ENCODE once (later syncs only fetch new or changed experiments).')
+    print('Searches then use the mirror; add --online to search ENCODE itself:\n')
+    print('\t$ python atlas_encode_mirror.py sync')
+    print('\t$ bioshed search encode --tissue heart --online\n')
     print('BioShed will write SEARCH results to a file "search_encode.txt" in the current directory.\n')
 
     print('------------------------------------------------------------')
@@ -428,6 +786,9 @@ def print_encode_help():
     
     print('You can list the files before downloading them, by typing:\n')
     print('\t$ bioshed download encode --list\n')
+
+    print('You can set how many ENCODE requests and downloads run at once (default 8):\n')
+    print('\t$ bioshed download encode --workers 4\n')
     
     print('You can specify a different output directory, including an AWS S3 remote folder:\n')
     print('\t$ bioshed download encode --output s3://my/output/folder\n')
@@ -436,6 +797,14 @@ def print_encode_help():
     print('\t$ bioshed download encode --update\n')
 
     print('Successful download will also generate an associated annotation file "annotation_encode.txt".\n')
+
+    print('To record where the time goes in a search or download, add --profile (optionally followed by a file name).')
+    print('Timings of the search, request and download steps are written to "bioshed_profile.json" (JSON trace):\n')
+    print('\t$ bioshed download encode --profile\n')
+
+    print('To answer searches faster, keep the search data loaded in a background search daemon:\n')
+    print('\t$ python atlas_daemon.py start\n')
+    print('Searches (and download --list) use it automatically while it runs.\n')
     return
 
 def convert_to_search_string( args ):
@@ -452,25 +821,30 @@ def convert_to_search_string( args ):
     """
     terms = args['terms']
     category = args['category']
-    pre_search_file = 'files/search_encode_{}.txt'.format(str(category).lower())
+    search_terms = load_search_terms()
     search_string = ''
 
     try:
-        if os.path.exists(pre_search_file):
-            df = pd.read_csv(pre_search_file, sep='\t')
+        if str(category).lower() in search_terms:
+            table = search_terms[str(category).lower()]
             if category != '' and terms == '':
                 # special case: search encode --category where we list valid search terms.
-                unique_terms = list(set(list(df['ID'])))
                 print('Valid search terms for category {}'.format(category))
-                for unique_term in unique_terms:
+                for unique_term in table['ids']:
                     if unique_term != '.':
                         print('\t{}'.format(unique_term))
                 raise ValueError('Search not performed.')
-            elif 'link' in df.columns and 'ID' in df.columns:
-                pd_query = df[df['ID']==terms]['link'] # df.query('ID=={}'.format(terms))['link']
-                if len(pd_query) > 0:
-                    search_string = pd_query.values[0]
-        elif not os.path.exists(pre_search_file) and category not in ['general', ''] and terms == '':
+            elif terms in table['links']:
+                search_string = table['links'][terms]
+            elif terms.lower() in table['lower']:
+                search_string = table['links'][table['lower'][terms.lower()]]
+            else:
+                similar_terms = find_search_terms( category, terms )[0:10]
+                if similar_terms == []:
+                    similar_terms = [term for _, term in find_ranked_search_terms( terms, category )]
+                if similar_terms != []:
+                    print('{} is not a valid {} search term. Similar terms: {}'.format(terms, category, ', '.join(similar_terms)))
+        elif category not in ['general', ''] and terms == '':
             # incorrect category used
             raise ValueError('ERROR: Invalid search category {}. Type "bioshed search encode" to see valid search categories, or just search without categories.'.format(category))
 
@@ -481,6 +855,149 @@ def convert_to_search_string( args ):
         print(e)
         return ''
 
+def compile_search_terms( files_dir=os.path.join(SCRIPT_DIR, 'files'), out_file=SEARCH_TERMS_FILE ):
+    """ Compiles the search term tables files/search_encode_<category>.txt (ID, number_of_datasets, link)
+    into a single JSON lookup file, so that search terms can be resolved without parsing the tables.
+
+    files_dir: folder with the search term tables
+    out_file: compiled lookup file
+    ---
+    search_terms: {category: {"ids": [ID,...] (table order),
+                              "links": {ID: link},
+                              "lower": {lowercase ID: ID},
+                              "trie": prefix trie of lowercase IDs - nested {character: node}, "" holds the IDs ending at a node}}
+    (out): out_file, with "source" recording the sha1 of each table it was compiled from
+
+    Run compile_search_terms() after editing the tables, so that the shipped SEARCH_TERMS_FILE is up to date.
+
+    Rows without a header or with the dataset count and link run together (search_encode_disease.txt) are accepted.
+    """
+    search_terms = {}
+    for category, table_file in get_search_term_tables( files_dir ).items():
+        table = {"ids": [], "links": {}, "lower": {}, "trie": {}}
+        with open(table_file, 'r', newline='') as f:
+            for row in csv.reader(f, delimiter='\t', quoting=csv.QUOTE_NONE):
+                if len(row) == 0 or row[0] in ['ID', ''] or row[0] in table['links']:
+                    continue
+                term = row[0]
+                link = row[2] if len(row) > 2 and row[2] != '' else (row[1][row[1].index('?'):] if len(row) > 1 and '?' in row[1] else '')
+                table['ids'].append(term)
+                table['links'][term] = link
+                table['lower'].setdefault(term.lower(), term)
+                node = table['trie']
+                for c in term.lower():
+                    node = node.setdefault(c, {})
+                node.setdefault('', []).append(term)
+        search_terms[category] = table
+    try:
+        os.makedirs(os.path.dirname(out_file), exist_ok=True)
+        with open(out_file+'.tmp', 'w') as fout:
+            json.dump({"source": get_search_terms_source( files_dir ), "categories": search_terms}, fout)
+        os.replace(out_file+'.tmp', out_file)
+    except OSError as e:
+        print('WARNING: could not write {}: {}'.format(out_file, str(e)))
+    return search_terms
+
+def get_search_term_tables( files_dir=os.path.join(SCRIPT_DIR, 'files') ):
+    """ Returns the search term tables in a folder: {category: path to search_encode_<category>.txt}
+    """
+    return {f[len('search_encode_'):-len('.txt')]: os.path.join(files_dir, f) for f in sorted(os.listdir(files_dir)) if f.startswith('search_encode_') and f.endswith('.txt')}
+
+def get_search_terms_source( files_dir=os.path.join(SCRIPT_DIR, 'files') ):
+    """ Returns {category: sha1 of the table file}, used to tell whether the compiled search terms are up to date.
+
+    >>> import tempfile
+    >>> files_dir = tempfile.mkdtemp()
+    >>> with open(os.path.join(files_dir, 'search_encode_tissue.txt'), 'w') as fout:
+    ...     _ = fout.write('ID\\tnumber_of_datasets\\tlink\\nheart\\t10\\t?type=Experiment\\n')
+    >>> source = get_search_terms_source( files_dir )
+    >>> with open(os.path.join(files_dir, 'search_encode_tissue.txt'), 'w') as fout:
+    ...     _ = fout.write('ID\\tnumber_of_datasets\\tlink\\nliver\\t10\\t?type=Experiment\\n')
+    >>> get_search_terms_source( files_dir ) == source
+    False
+    """
+    sources = {}
+    for category, table_file in get_search_term_tables( files_dir ).items():
+        with open(table_file, 'rb') as f:
+            sources[category] = hashlib.sha1(f.read()).hexdigest()
+    return sources
+
+def load_search_terms():
+    """ Returns the compiled search terms (see compile_search_terms), loading them once per process.
+    The shipped lookup file (SEARCH_TERMS_FILE) is used if it was compiled from the current
+    search term tables. Otherwise the terms are recompiled into SEARCH_TERMS_CACHE_FILE.
+    """
+    if 'categories' not in _search_terms:
+        source = get_search_terms_source()
+        for terms_file in [SEARCH_TERMS_FILE, SEARCH_TERMS_CACHE_FILE]:
+            try:
+                with open(terms_file, 'r') as f:
+                    compiled = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if compiled.get('source') == source:
+                _search_terms['categories'] = compiled['categories']
+                break
+        else:
+            _search_terms['categories'] = compile_search_terms( out_file=SEARCH_TERMS_CACHE_FILE )
+    return _search_terms['categories']
+
+def find_search_terms( category, prefix ):
+    """ Returns the valid search terms of a category that start with prefix (case-insensitive), from the prefix trie.
+    category: search category (tissue, assay, assaytarget, ...)
+    prefix: start of a search term
+    ---
+    terms: list of search terms (sorted)
+    """
+    search_terms = load_search_terms()
+    if str(category).lower() not in search_terms:
+        return []
+    node = search_terms[str(category).lower()]['trie']
+    for c in prefix.lower():
+        if c not in node:
+            return []
+        node = node[c]
+    terms = []
+    nodes = [node]
+    while len(nodes) > 0:
+        node = nodes.pop()
+        for c, child in node.items():
+            if c == '':
+                terms += child
+            else:
+                nodes.append(child)
+    return sorted(terms)
+
+def find_ranked_search_terms( text, category=None, limit=10 ):
+    """ Full-text search of the search term tables: returns the search terms best matching free
+    text, best first (bm25). Terms matching more of the words rank higher, and hyphenated terms
+    match with or without hyphens ("chipseq" => ChIP-seq) - see atlas_utils.text_match_query.
+    The index (SQLite FTS5, in memory) is built on first use, once per process.
+
+    text: free text, e.g. "breast cancer rna-seq"
+    category: only search the terms of this category (default: all categories)
+    limit: maximum number of terms returned
+    ---
+    terms: list of (category, term) - [] if SQLite has no FTS5
+
+    >>> ('tissue', 'heart') in find_ranked_search_terms('heart')
+    True
+    >>> find_ranked_search_terms('histone chipseq', 'assay', 1)
+    [('assay', 'Histone ChIP-seq')]
+    """
+    if not atlas_utils.text_index_available() or atlas_utils.text_words( text ) == []:
+        return []
+    if 'text' not in _search_terms:
+        import sqlite3
+        conn = sqlite3.connect(':memory:', check_same_thread=False)
+        conn.execute("CREATE VIRTUAL TABLE terms USING fts5(text, category UNINDEXED, term UNINDEXED, tokenize='{}')".format(atlas_utils.TEXT_TOKENIZER))
+        conn.executemany('INSERT INTO terms (text, category, term) VALUES (?, ?, ?)',
+                         [(atlas_utils.text_index_terms( [term] ), c, term) for c, table in load_search_terms().items() for term in table['ids']])
+        _search_terms['text'] = conn
+    sql = 'SELECT category, term FROM terms WHERE terms MATCH ?' + (' AND category = ?' if category is not None else '') + ' ORDER BY bm25(terms) LIMIT ?'
+    sql_args = [atlas_utils.text_match_query( text, 'OR' )] + ([str(category).lower()] if category is not None else []) + [int(limit)]
+    return [tuple(r) for r in _search_terms['text'].execute(sql, sql_args).fetchall()]
+
 def combine_search_strings( ss1, ss2 ):
     """ Combine two search strings into a single ENCODE search string.
     This removes any redundant search terms.
@@ -518,12 +1035,21 @@ def search_encode_general( args ):
 
     https://www.encodeproject.org/search/?type=Experiment&searchTerm=breast+cancer
 
-    >>> search_encode( dict(tissue='breast cancer', returntype='full'))
-    ''
-    >>> search_encode( dict(tissue='breast cancer', returntype='experiment'))
-    ''
-    >>> search_encode( dict(tissue='breast cancer', returntype='assay'))
-    ''
+    Against the benchmark's stand-in server (atlas_benchmark.start_stand_in), which answers every
+    search with the same experiments:
+    >>> import io, contextlib, tempfile, atlas_benchmark
+    >>> server = atlas_benchmark.start_stand_in( dict(atlas_benchmark.DEFAULT_PARAMS, latency=0, rows=10, experiments=3), tempfile.mkdtemp() )
+    >>> with contextlib.redirect_stdout(io.StringIO()) as out:
+    ...     results = search_encode_general( dict(tissue='breast cancer', returntype='full'))
+    >>> out.getvalue().split('\\n')[0]  # doctest: +ELLIPSIS
+    'GET request: http://127.0.0.1:.../search/?type=Experiment&searchTerm=breast%20cancer&limit=50000&field=@id...'
+    >>> list(results['experiment'])
+    ['/experiments/ENCSR000000/', '/experiments/ENCSR000001/', '/experiments/ENCSR000002/']
+    >>> with contextlib.redirect_stdout(io.StringIO()):
+    ...     results = search_encode_general( dict(tissue='breast cancer', returntype='assay'))
+    >>> list(results['assay'])
+    ['transcriptome-rnaseq', 'WGS-whole-genome-seq', 'WES-WXS-whole-exome-seq']
+    >>> server.stop()
     """
     returntype = args['returntype'] if 'returntype' in args else 'full'
     search_args = ''
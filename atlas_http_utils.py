@@ -0,0 +1,640 @@
+import os, sys, json, time, random, hashlib, threading
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
+sys.path.append(str(os.path.dirname(os.path.realpath(__file__))))
+import atlas_utils
+
+# ENCODE asks clients to stay at or below 10 requests per second.
+ENCODE_MAX_REQUESTS_PER_SECOND = 10
+DEFAULT_WORKERS = 8
+
+# on-disk cache of JSON responses (see get_json_cached)
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.bioshed', 'cache', 'http')
+CACHE_TTL = 24*60*60                # seconds before a cached response is revalidated
+CACHE_MAX_BYTES = 1024*1024*1024    # least recently used responses are evicted beyond this
+CACHE_EVICT_TO = 0.9                # eviction frees space down to this fraction of the cap
+_cache_bytes = {}   # {cache_dir: estimated size in bytes}, kept per process by _write_cache_entry()
+_cache_lock = threading.Lock()
+
+# downloads are streamed to disk in chunks of this size
+DOWNLOAD_CHUNK_SIZE = 1024*1024
+# download scheduling (see download_http_all)
+MAX_CONNECTIONS_PER_HOST = 4
+DOWNLOAD_RETRIES = 3
+DOWNLOAD_BACKOFF = 2.0      # seconds before the first retry (on average), doubled for each following retry
+# connections kept open per host by the shared session (see get_session)
+SESSION_POOL_SIZE = 16
+_session = {}   # {"session": requests.Session}, created on first use by get_session()
+_session_lock = threading.Lock()
+# requests per second allowed to each host, shared by all threads (see http_request) - other hosts are not limited
+HOST_MAX_REQUESTS_PER_SECOND = {'www.encodeproject.org': ENCODE_MAX_REQUESTS_PER_SECOND}
+_host_limiters = {}
+# requests answered with one of these statuses (or failing to connect) are retried
+RETRY_STATUS = (408, 429, 500, 502, 503, 504)
+HTTP_RETRIES = 4
+HTTP_BACKOFF = 1.0          # seconds before the first retry (on average), doubled for each following retry
+HTTP_TIMEOUT = 60           # seconds to wait for a connection or for data
+
+class RateLimiter:
+    """ Thread-safe client-side rate limiter (token bucket): calls to acquire() are
+    spaced 1/rate seconds apart on average, across all threads sharing the limiter.
+
+    rate: maximum number of calls per second (0 or None = unlimited)
+    burst: number of calls allowed back to back after a pause (default 1: always spaced)
+    """
+    def __init__( self, rate, burst=1 ):
+        self.interval = 1.0/float(rate) if rate else 0.0
+        self.burst = max(1, int(burst))
+        self.next_time = 0.0
+        self.lock = threading.Lock()
+
+    def acquire( self ):
+        if self.interval == 0.0:
+            return
+        with self.lock:
+            now = time.monotonic()
+            start = max(self.next_time, now - (self.burst-1)*self.interval)
+            self.next_time = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+def map_concurrent( func, items, workers=DEFAULT_WORKERS, rate=None ):
+    """ Applies func to each item using a bounded pool of worker threads.
+    Intended for I/O-bound work such as HTTP requests.
+
+    func: function taking a single item
+    items: list of inputs
+    workers: maximum number of concurrent calls
+    rate: maximum number of calls started per second (default: unlimited)
+    ---
+    results: list of func(item), in the same order as items
+
+    >>> map_concurrent(lambda x: x*2, [3, 1, 2], workers=2)
+    [6, 2, 4]
+    """
+    limiter = RateLimiter( rate )
+    def _call( item ):
+        limiter.acquire()
+        return func( item )
+    if len(items) == 0:
+        return []
+    with ThreadPoolExecutor(max_workers=max(1, min(int(workers), len(items)))) as executor:
+        return list(executor.map(_call, items))
+
+
+def get_session():
+    """ Returns the HTTP session shared by this process (created on first use), so that
+    connections to ENCODE and GDC are kept open and reused across requests and threads.
+    ---
+    session: requests.Session
+    """
+    with _session_lock:
+        if 'session' not in _session:
+            import requests
+            session = requests.Session()
+            session.headers.update({'Accept-Encoding': 'gzip, deflate', 'Connection': 'keep-alive'})
+            adapter = requests.adapters.HTTPAdapter(pool_connections=SESSION_POOL_SIZE, pool_maxsize=SESSION_POOL_SIZE)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _session['session'] = session
+        return _session['session']
+
+
+def get_host_limiter( url ):
+    """ Returns the rate limiter shared by all requests to the host of url
+    (see HOST_MAX_REQUESTS_PER_SECOND).
+    """
+    host = urlparse(url).netloc
+    with _session_lock:
+        if host not in _host_limiters:
+            _host_limiters[host] = RateLimiter( HOST_MAX_REQUESTS_PER_SECOND.get(host) )
+        return _host_limiters[host]
+
+
+def retry_wait( attempt, backoff, retry_after='' ):
+    """ Seconds to wait before retry number attempt (1, 2, ...): backoff doubled for each
+    retry, with random jitter so that concurrent clients do not retry in step.
+    A Retry-After header value (in seconds) takes precedence.
+
+    >>> retry_wait(1, 0.0, '3')
+    3.0
+    >>> 0.5 <= retry_wait(2, 1.0) <= 3.0
+    True
+    """
+    if str(retry_after).strip().isdigit():
+        return float(retry_after)
+    return backoff * 2**(attempt-1) * random.uniform(0.5, 1.5)
+
+
+def http_request( method, url, headers=None, stream=False, retries=HTTP_RETRIES, backoff=HTTP_BACKOFF ):
+    """ HTTP request through the shared session (get_session): pooled keep-alive
+    connections, gzip transfer, a per-host rate limit (HOST_MAX_REQUESTS_PER_SECOND),
+    and jittered retries of responses in RETRY_STATUS and of connection errors.
+
+    method: 'GET', 'HEAD', ...
+    url: full URL
+    headers: request headers
+    stream: True to read the body as it arrives (response.iter_content) - close the response when done
+    retries: number of times a failed request is retried
+    backoff: seconds before the first retry, on average (doubled for each following retry)
+    ---
+    response: requests.Response (the last one, if all attempts failed with a status in RETRY_STATUS)
+
+    Raises requests.RequestException if the last attempt could not connect.
+    """
+    import requests
+    limiter = get_host_limiter( url )
+    response = None
+    for attempt in range(int(retries)+1):
+        if attempt > 0:
+            wait = retry_wait( attempt, backoff, response.headers.get('Retry-After', '') if response is not None else '' )
+            atlas_utils.count('http.retries')
+            time.sleep(wait)
+        limiter.acquire()
+        response = None
+        try:
+            atlas_utils.count('http.requests')
+            response = get_session().request(method, url, headers=headers, stream=stream, timeout=HTTP_TIMEOUT, allow_redirects=True)
+        except (requests.ConnectionError, requests.Timeout):
+            if attempt == int(retries):
+                raise
+            continue
+        if response.status_code not in RETRY_STATUS or attempt == int(retries):
+            return response
+        response.close()
+    return response
+
+
+def get_json( url ):
+    """ GET request for a JSON resource (no caching - see get_json_cached).
+    ---
+    results: decoded JSON
+    """
+    with atlas_utils.span('http.get', url=url) as attrs:
+        response = http_request( 'GET', url, headers={'accept': 'application/json'} )
+        attrs['status'] = response.status_code
+    with atlas_utils.span('json.decode', url=url):
+        return response.json()
+
+
+def get_json_cached( url, ttl=CACHE_TTL, cache_dir=None, max_bytes=CACHE_MAX_BYTES ):
+    """ GET request for a JSON resource, through a persistent on-disk cache keyed by URL.
+
+    url: full URL to GET
+    ttl: seconds a cached response is served without contacting the server
+    cache_dir: cache directory, one file per URL (default CACHE_DIR)
+    max_bytes: size cap of the cache directory - least recently used entries are evicted
+    ---
+    results: decoded JSON
+
+    - Fresh entries (younger than ttl) are served from disk with no request.
+    - Stale entries are revalidated with If-None-Match / If-Modified-Since when the
+      server sent an ETag / Last-Modified; a 304 response renews the entry.
+    - Only successful (200) responses are cached.
+
+    Against the benchmark's stand-in server (atlas_benchmark.start_server), which sends ETags:
+    >>> import tempfile, atlas_benchmark
+    >>> server = atlas_benchmark.start_server( dict(atlas_benchmark.DEFAULT_PARAMS, latency=0, experiments=3) )
+    >>> cache_dir = tempfile.mkdtemp()
+    >>> def cache_file( url ):
+    ...     return os.path.join(cache_dir, hashlib.sha256(url.encode()).hexdigest()+'.json')
+    >>> def revalidated():
+    ...     return atlas_utils.get_profile()['counters'].get('http.cache_revalidated', 0)
+    >>> url = server.url + '/experiments/ENCSR000001/'
+    >>> len(get_json_cached( url, cache_dir=cache_dir )['files']), server.requests
+    (2, 1)
+    >>> len(get_json_cached( url, cache_dir=cache_dir )['files']), server.requests
+    (2, 1)
+
+    Expired entries (ttl=0) are revalidated - unchanged (304), then changed (200):
+    >>> before = revalidated()
+    >>> len(get_json_cached( url, ttl=0, cache_dir=cache_dir )['files']), server.requests, revalidated() - before
+    (2, 2, 1)
+    >>> server.params['files_per_experiment'] = 1
+    >>> len(get_json_cached( url, ttl=0, cache_dir=cache_dir )['files']), server.requests, revalidated() - before
+    (1, 3, 1)
+
+    An entry missing fields is a miss:
+    >>> with open(cache_file( url ),'w') as f:
+    ...     json.dump({'url': url}, f)
+    >>> len(get_json_cached( url, cache_dir=cache_dir )['files']), server.requests
+    (1, 4)
+
+    Beyond max_bytes, the least recently used entries are evicted:
+    >>> cache_dir = tempfile.mkdtemp()
+    >>> urls = [server.url + '/experiments/ENCSR00000{}/'.format(i) for i in range(3)]
+    >>> entry = get_json_cached( urls[0], cache_dir=cache_dir )
+    >>> max_bytes = 2.5 * os.path.getsize(cache_file( urls[0] ))
+    >>> for u in [urls[1], urls[0], urls[2]]:
+    ...     entry = get_json_cached( u, cache_dir=cache_dir, max_bytes=max_bytes )
+    >>> [os.path.exists(cache_file( u )) for u in urls]
+    [True, False, True]
+    >>> server.shutdown()
+    """
+    cache_dir = cache_dir if cache_dir is not None else CACHE_DIR
+    cache_file = os.path.join(cache_dir, hashlib.sha256(url.encode()).hexdigest()+'.json')
+    entry = None
+    if os.path.exists(cache_file):
+        try:
+            with open(cache_file,'r') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            entry = None
+    if not isinstance(entry, dict) or entry.get('url') != url or 'body' not in entry or 'fetched' not in entry:
+        # missing, or not a cache entry for this URL
+        entry = None
+    elif time.time() - entry['fetched'] < ttl:
+        _touch( cache_file )
+        atlas_utils.count('http.cache_hits')
+        return entry['body']
+
+    headers = {'accept': 'application/json'}
+    if entry is not None and entry.get('etag', '') != '':
+        headers['If-None-Match'] = entry['etag']
+    if entry is not None and entry.get('last_modified', '') != '':
+        headers['If-Modified-Since'] = entry['last_modified']
+    with atlas_utils.span('http.get', url=url) as attrs:
+        response = http_request( 'GET', url, headers=headers )
+        attrs['status'] = response.status_code
+    if response.status_code == 304 and entry is not None:
+        atlas_utils.count('http.cache_revalidated')
+        entry['fetched'] = time.time()
+    elif response.status_code == 200:
+        with atlas_utils.span('json.decode', url=url):
+            body = response.json()
+        entry = dict(url=url, fetched=time.time(), etag=response.headers.get('ETag', ''),
+                     last_modified=response.headers.get('Last-Modified', ''), body=body)
+    else:
+        return response.json()
+    _write_cache_entry( cache_file, entry, cache_dir, max_bytes )
+    return entry['body']
+
+
+def _touch( path ):
+    """ Marks a cache file as recently used (mtime drives LRU eviction). """
+    try:
+        os.utime(path, None)
+    except OSError:
+        pass
+
+
+def _write_cache_entry( cache_file, entry, cache_dir, max_bytes ):
+    """ Atomically writes a cache entry, then evicts least recently used entries beyond max_bytes.
+
+    The size of the cache directory is scanned once per process, then kept up to date as
+    entries are written, so the directory is only scanned again when the total goes over
+    max_bytes. Eviction then frees space down to CACHE_EVICT_TO of max_bytes. Entries written
+    by other processes are counted at the next scan.
+    """
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        old_size = os.path.getsize(cache_file) if os.path.exists(cache_file) else 0
+        tmp_file = '{}.{}.{}.tmp'.format(cache_file, str(os.getpid()), str(threading.get_ident()))
+        with open(tmp_file,'w') as fout:
+            json.dump(entry, fout)
+        new_size = os.path.getsize(tmp_file)
+        os.replace(tmp_file, cache_file)
+    except OSError as e:
+        print('WARNING: could not write to cache {}: {}'.format(cache_dir, str(e)))
+        return
+    with _cache_lock:
+        if cache_dir not in _cache_bytes:
+            _cache_bytes[cache_dir] = sum(size for _, size, _ in _scan_cache( cache_dir ))
+        else:
+            _cache_bytes[cache_dir] += new_size - old_size
+        if _cache_bytes[cache_dir] <= max_bytes:
+            return
+        entries = _scan_cache( cache_dir )
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_bytes <= max_bytes * CACHE_EVICT_TO:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total_bytes -= size
+        _cache_bytes[cache_dir] = total_bytes
+
+
+def _scan_cache( cache_dir ):
+    """ Returns (mtime, size, path) for each entry of a cache directory. """
+    entries = []
+    for dentry in os.scandir(cache_dir):
+        if dentry.name.endswith('.json'):
+            try:
+                st = dentry.stat()
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, dentry.path))
+    return entries
+
+
+def download_http( url, outfile, chunk_size=DOWNLOAD_CHUNK_SIZE, size=None, md5='' ):
+    """ Downloads an HTTP(S) file to disk, streaming it in fixed-size chunks so that
+    memory use does not depend on file size. Prints size, time and throughput.
+
+    The file is written to <outfile>.part and renamed when complete. If a .part file
+    is left over from an interrupted download, only the missing bytes are requested
+    (HTTP Range); servers that ignore the range restart the file from the beginning.
+    The request goes through http_request (file bytes are not gzip-encoded in transfer,
+    so that ranges and md5 checksums refer to the file itself).
+
+    A .part file that is already complete (the server answers the range with 416) is
+    renamed into place if it has the size and md5 expected, and downloaded again otherwise.
+
+    url: file URL
+    outfile: local file to write
+    chunk_size: bytes read and written at a time
+    size: expected file size in bytes, if known
+    md5: expected md5, if known
+    ---
+    outfile: local file written, or '' if the download failed
+
+    Against the benchmark's stand-in server (1000-byte files of zeros):
+    >>> import io, contextlib, tempfile, atlas_benchmark
+    >>> server = atlas_benchmark.start_server( dict(atlas_benchmark.DEFAULT_PARAMS, latency=0, file_size=1000) )
+    >>> url, outfile = server.url + '/files/a.bin', os.path.join(tempfile.mkdtemp(), 'a.bin')
+    >>> with open(outfile + '.part', 'wb') as fout:
+    ...     _ = fout.write(bytes(400))
+    >>> download_http( url, outfile ) == outfile  # doctest: +ELLIPSIS
+    Resuming ... from 400 B
+    Downloaded ... (600 B in ...)
+    True
+    >>> os.path.getsize(outfile), os.path.exists(outfile + '.part')
+    (1000, False)
+
+    A complete .part file is kept if its md5 matches, and downloaded again otherwise:
+    >>> os.replace(outfile, outfile + '.part')
+    >>> with contextlib.redirect_stdout(io.StringIO()) as out:
+    ...     downloaded = download_http( url, outfile, md5=atlas_benchmark.served_file_md5( 1000 ) )
+    >>> downloaded == outfile, out.getvalue().strip().endswith('was already downloaded')
+    (True, True)
+    >>> os.replace(outfile, outfile + '.part')
+    >>> download_http( url, outfile, md5='0'*32 ) == outfile  # doctest: +ELLIPSIS
+    Downloaded ... (1000 B in ...)
+    True
+    >>> server.shutdown()
+    """
+    return _download_http( url, outfile, chunk_size, size, md5 )[0]
+
+
+def _download_http( url, outfile, chunk_size=DOWNLOAD_CHUNK_SIZE, size=None, md5='' ):
+    """ download_http, also telling whether a failed download is worth retrying:
+    only transfers interrupted after the server started sending the file are. Failing
+    to connect and statuses in RETRY_STATUS were already retried by http_request,
+    and other error statuses (404, 403, ...) will not change.
+    ---
+    outfile: local file written, or '' if the download failed
+    retry: True if the download failed and can be resumed
+    """
+    import requests
+    part_file = outfile + '.part'
+    offset = os.path.getsize(part_file) if os.path.exists(part_file) else 0
+    start = time.monotonic()
+    nbytes = 0
+    receiving = False
+    try:
+        headers = {'Accept-Encoding': 'identity'}
+        if offset > 0:
+            headers['Range'] = 'bytes={}-'.format(str(offset))
+        with http_request( 'GET', url, headers=headers, stream=True ) as response:
+            if response.status_code == 416 and offset > 0:
+                # nothing left to send from offset: the .part file is either complete or not a prefix of the remote file
+                total = response.headers.get('Content-Range', '').split('/')[-1]
+                total = int(total) if total.isdigit() else size
+                if offset == total and (md5 == '' or file_md5( part_file ) == md5):
+                    print('{} was already downloaded'.format(outfile))
+                    os.replace(part_file, outfile)
+                    atlas_utils.count('download.files')
+                    return outfile, False
+                os.remove(part_file)
+                return _download_http( url, outfile, chunk_size, size, md5 )
+            response.raise_for_status()
+            if response.status_code == 206:
+                print('Resuming {} from {}'.format(outfile, format_bytes(offset)))
+            else:
+                offset = 0
+            with open(part_file, 'ab' if offset > 0 else 'wb') as fout:
+                receiving = True
+                for chunk in response.iter_content(chunk_size=chunk_size):
+                    fout.write(chunk)
+                    nbytes += len(chunk)
+        os.replace(part_file, outfile)
+    except (requests.RequestException, OSError) as e:
+        print('ERROR: download of {} failed: {}'.format(url, str(e)))
+        atlas_utils.count('http.bytes_downloaded', nbytes)
+        atlas_utils.count('download.failures')
+        return '', receiving and isinstance(e, requests.RequestException)
+    atlas_utils.count('http.bytes_downloaded', nbytes)
+    atlas_utils.count('download.files')
+    elapsed = max(time.monotonic() - start, 1e-6)
+    print('Downloaded {} ({} in {:.1f}s, {}/s)'.format(outfile, format_bytes(nbytes), elapsed, format_bytes(nbytes/elapsed)))
+    return outfile, False
+
+
+def format_bytes( nbytes ):
+    """ Human-readable byte count.
+
+    >>> format_bytes(512)
+    '512 B'
+    >>> format_bytes(3.5*1024*1024)
+    '3.5 MB'
+    """
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if nbytes < 1024 or unit == 'GB':
+            return '{} {}'.format(int(nbytes), unit) if unit == 'B' else '{:.1f} {}'.format(nbytes, unit)
+        nbytes /= 1024.0
+
+
+def file_md5( path, chunk_size=DOWNLOAD_CHUNK_SIZE ):
+    """ Returns the md5 hex digest of a local file, read in chunks.
+    """
+    md5 = hashlib.md5()
+    with open(path,'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def known_md5( d ):
+    """ Returns the md5 of a download (lowercase hex), or '' if it is missing or not an md5
+    (e.g. '.', or NaN from an empty manifest cell).
+
+    d: dict(url=..., outfile=..., md5=...)
+    ---
+    md5: 32 lowercase hex digits, or ''
+
+    >>> known_md5(dict(md5='0123456789ABCDEF0123456789abcdef'))
+    '0123456789abcdef0123456789abcdef'
+    >>> known_md5(dict(md5=float('nan'))), known_md5(dict(md5='.')), known_md5(dict(url='x'))
+    ('', '', '')
+    """
+    md5 = str(d.get('md5', '')).strip().lower()
+    return md5 if len(md5) == 32 and all(c in '0123456789abcdef' for c in md5) else ''
+
+
+def known_size( d ):
+    """ Returns the size in bytes of a download, or None if it is missing or not a number
+    (e.g. NaN from an empty manifest cell).
+
+    d: dict(url=..., outfile=..., size=...)
+    ---
+    size: int, or None
+
+    >>> known_size(dict(size='1024')), known_size(dict(size=2048.0))
+    (1024, 2048)
+    >>> known_size(dict(size=float('nan'))), known_size(dict(size='')), known_size(dict(url='x'))
+    (None, None, None)
+    """
+    try:
+        size = float(d.get('size', ''))
+    except (TypeError, ValueError):
+        return None
+    return int(size) if size == size and size >= 0 else None
+
+
+def unique_outfiles( outfiles, prefixes ):
+    """ Makes the local files of several downloads distinct: a path shared by several
+    downloads (e.g. files with the same name from different experiments) is prefixed
+    with the download's prefix in each of them.
+
+    outfiles: local file paths
+    prefixes: prefix for each path (e.g. file or experiment id) - only used for shared paths
+    ---
+    outfiles: local file paths, <dir>/<prefix>_<name> for the paths that were shared
+
+    >>> unique_outfiles(['out/a.bam', 'out/b.bam', 'out/a.bam'], ['id1', 'id2', 'id3'])
+    ['out/id1_a.bam', 'out/b.bam', 'out/id3_a.bam']
+    """
+    counts = {}
+    for outfile in outfiles:
+        counts[outfile] = counts.get(outfile, 0) + 1
+    return [outfile if counts[outfile] == 1 else os.path.join(os.path.dirname(outfile), '{}_{}'.format(str(prefix), os.path.basename(outfile)))
+            for outfile, prefix in zip(outfiles, prefixes)]
+
+
+def download_http_all( downloads, workers=DEFAULT_WORKERS, per_host=MAX_CONNECTIONS_PER_HOST, retries=DOWNLOAD_RETRIES, backoff=DOWNLOAD_BACKOFF, overwrite='True' ):
+    """ Downloads several HTTP(S) files concurrently.
+
+    downloads: list of dict(url=..., outfile=..., size=..., md5=...) - size (bytes) and md5 are optional
+    workers: maximum number of concurrent transfers
+    per_host: maximum number of concurrent transfers to the same host
+    retries: number of times an interrupted transfer (or a file failing md5 verification) is retried
+    backoff: seconds to wait before the first retry, on average (doubled for each following retry)
+    overwrite: 'False' keeps existing files (after checking their md5, if known) instead of downloading them again
+    ---
+    downloaded_files: local files successfully downloaded, in the same order as downloads
+
+    Transfers are started largest first so that one big file does not finish alone at
+    the end. Files of unknown size are started last, in the order given. Interrupted transfers
+    resume from their .part file (see download_http). Requests that could not connect or
+    got an error status are not retried here: http_request already retries the ones that may
+    succeed later (RETRY_STATUS), and the others (404, 403, ...) fail at once.
+
+    Files with a known md5 are verified in a pool of threads while other transfers
+    continue. Files failing verification are deleted and downloaded again.
+
+    Each download must have its own outfile (see unique_outfiles): when several downloads
+    share one, only the first is downloaded and the others fail with an error.
+
+    Against the benchmark's stand-in server (1000-byte files of zeros):
+    >>> import io, contextlib, tempfile, atlas_benchmark
+    >>> server = atlas_benchmark.start_server( dict(atlas_benchmark.DEFAULT_PARAMS, latency=0, file_size=1000) )
+    >>> outdir = tempfile.mkdtemp()
+    >>> good = dict(url=server.url + '/files/a.bin', outfile=os.path.join(outdir, 'a.bin'), size=1000, md5=atlas_benchmark.served_file_md5( 1000 ))
+    >>> bad = dict(url=server.url + '/files/b.bin', outfile=os.path.join(outdir, 'b.bin'), size=1000, md5='0'*32)
+    >>> with contextlib.redirect_stdout(io.StringIO()) as out:
+    ...     downloaded = download_http_all( [good, bad], retries=1, backoff=0 )
+    >>> [os.path.basename(f) for f in downloaded], os.listdir(outdir)
+    (['a.bin'], ['a.bin'])
+    >>> out.getvalue().count('ERROR: md5 mismatch for ' + bad['outfile'])
+    2
+
+    With overwrite='False', existing files are kept if their md5 matches:
+    >>> requests_before = server.requests
+    >>> download_http_all( [good], overwrite='False' ) == [good['outfile']]  # doctest: +ELLIPSIS
+    Keeping existing file ...
+    True
+    >>> server.requests - requests_before
+    0
+    >>> server.shutdown()
+    """
+    if len(downloads) == 0:
+        return []
+    host_slots = {}
+    for d in downloads:
+        host = urlparse(d['url']).netloc
+        if host not in host_slots:
+            host_slots[host] = threading.BoundedSemaphore(max(1, int(per_host)))
+
+    def _download( i ):
+        d = downloads[i]
+        for attempt in range(int(retries)+1):
+            if attempt > 0:
+                wait = retry_wait( attempt, backoff )
+                print('Retrying {} in {:.1f}s (attempt {} of {})'.format(d['url'], wait, str(attempt), str(retries)))
+                atlas_utils.count('download.retries')
+                time.sleep(wait)
+            with host_slots[urlparse(d['url']).netloc]:
+                print('Downloading {}'.format(d['url']))
+                with atlas_utils.span('download', url=d['url'], attempt=attempt) as attrs:
+                    outfile, retry = _download_http( d['url'], d['outfile'], size=known_size( d ), md5=known_md5( d ) )
+                    attrs['ok'] = outfile != ''
+                if attrs['ok'] or not retry:
+                    return outfile
+        return ''
+
+    results = {}    # download index: local file or ''
+    owners = {}     # local file: index of the download writing it
+    for i, d in enumerate(downloads):
+        outfile = os.path.abspath(d['outfile'])
+        if outfile in owners:
+            print('ERROR: {} is also the output of {} - not downloading {}'.format(d['outfile'], downloads[owners[outfile]]['url'], d['url']))
+            atlas_utils.count('download.failures')
+            results[i] = ''
+        else:
+            owners[outfile] = i
+    pending = [i for i in range(len(downloads)) if i not in results]
+    # threads rather than processes: hashlib releases the GIL while hashing each chunk, and the
+    # pool is first used from the download threads, where forking worker processes is unsafe
+    with ThreadPoolExecutor(max_workers=max(1, min(os.cpu_count() or 1, len(downloads)))) as md5_pool:
+        checks = {}     # download index: md5 future
+        if overwrite == 'False':
+            for i in pending:
+                if os.path.exists(downloads[i]['outfile']):
+                    print('Keeping existing file {}'.format(downloads[i]['outfile']))
+                    results[i] = downloads[i]['outfile']
+                    if known_md5( downloads[i] ) != '':
+                        checks[i] = md5_pool.submit(file_md5, downloads[i]['outfile'])
+            pending = [i for i in pending if i not in results]
+        for verify_round in range(int(retries)+1):
+            sizes = [known_size( downloads[i] ) for i in pending]
+            order = [i for s, i in sorted(zip(sizes, pending), key=lambda x: -1 if x[0] is None else -x[0])]
+
+            def _download_and_check( i ):
+                outfile = _download( i )
+                if outfile != '' and known_md5( downloads[i] ) != '':
+                    checks[i] = md5_pool.submit(file_md5, outfile)
+                return outfile
+            results.update(dict(zip(order, map_concurrent( _download_and_check, order, workers=workers ))))
+
+            # files failing md5 verification are downloaded again
+            pending = []
+            with atlas_utils.span('download.md5_wait', files=len(checks)):
+                for check in checks.values():
+                    check.result()
+            for i, check in checks.items():
+                if check.result() != known_md5( downloads[i] ):
+                    print('ERROR: md5 mismatch for {} - removing file'.format(downloads[i]['outfile']))
+                    atlas_utils.count('download.md5_mismatches')
+                    os.remove(downloads[i]['outfile'])
+                    results[i] = ''
+                    pending.append(i)
+            checks = {}
+            if len(pending) == 0:
+                break
+            elif verify_round < int(retries):
+                print('Downloading {} file(s) again after failed md5 verification'.format(str(len(pending))))
+    return [results[i] for i in range(len(downloads)) if results[i] != '']
@@ -1,16 +1,38 @@
-import os, sys, json
-import pandas as pd
+import os, sys, json, ast, hashlib, pickle, sqlite3
 import gzip
+from concurrent.futures import ProcessPoolExecutor
 SCRIPT_DIR = str(os.path.dirname(os.path.realpath(__file__)))
 sys.path.append(os.path.join(SCRIPT_DIR))
 import atlas_utils
+import atlas_http_utils
 sys.path.append('bioshed_utils/')
-import quick_utils
-import aws_s3_utils
+# heavy dependencies are only imported when first used (keeps --help and term listing fast)
+pd = atlas_utils.lazy_import('pandas')
+np = atlas_utils.lazy_import('numpy')
+quick_utils = atlas_utils.lazy_import('quick_utils')
+aws_s3_utils = atlas_utils.lazy_import('aws_s3_utils')
 
 GENERIC_TERMS = ["cancer", "tumor", "tumour", "dataset"]
 DEFAULT_SEARCH_FILE = "search_gdc.txt"
+DEFAULT_MANIFEST_FILE = os.path.join(SCRIPT_DIR, "files/gdc/manifest-all-gdc.txt.gz")
+DEFAULT_CATEGORIES_FILE = os.path.join(SCRIPT_DIR, 'files/gdc/categories-all-gdc.txt')
+BASE_S3_DIR = "s3://tcga-2-open/"
+BASE_HTTPS_DIR = "https://api.gdc.cancer.gov/data/"
+# manifest columns holding '_'-joined category values (see combine_all), indexed by open_manifest_index()
+INDEX_COLUMNS = ['project', 'assay', 'tissue', 'disease', 'species', 'platform', 'filetype']
+# general search words shorter than this are not matched as prefixes of category words
+MIN_PREFIX_LENGTH = 4
+# manifest store layout (see open_manifest_store) - stores of an older format are rebuilt
+MANIFEST_STORE_FORMAT = '2'
+# columns stored as 16-byte binary when every value is a lowercase UUID / hex digest (see encode_hex_column)
+HEX_COLUMNS = {'id': 'uuid', 'md5': 'hex'}
+HEX_PATTERNS = {'uuid': '^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$', 'hex': '^[0-9a-f]{32}$'}
+_category_index = {}    # {CATEGORIES_FILE: (modification time, index)}, see load_category_index()
+_manifest_cache = {}    # {MANIFEST_FILE: (manifest_signature, manifest, index)}, see load_manifest()
+_text_index_cache = {}  # {MANIFEST_FILE: (manifest_signature, sqlite3 connection)}, see open_manifest_text_index()
 
+@atlas_utils.served('search_gdc')
+@atlas_utils.profiled('search_gdc')
 def search_gdc( args ):
     """ Entrypoint for a TCGA or GDC search.
     In general, we recommend using GDC, as this repository includes TCGA and several other consortiums.
@@ -27,12 +49,30 @@ def search_gdc( args ):
     ---
     search_results: data frame of results
 
-    >>> search_gdc( dict(searchterms='breast cancer variants'))
-    ''
-    >>> search_gdc( dict(searchterms='--tissue heart --assay rna-seq'))
-    ''
-    >>> search_gdc( dict(searchterms='--assay single cell --tissue brain'))
-    ''
+    On a synthetic manifest (atlas_benchmark.start_stand_in):
+    >>> import io, contextlib, tempfile, atlas_benchmark
+    >>> server = atlas_benchmark.start_stand_in( dict(atlas_benchmark.DEFAULT_PARAMS, rows=2000), tempfile.mkdtemp() )
+    >>> def search( searchterms ):
+    ...     with contextlib.redirect_stdout(io.StringIO()):
+    ...         return search_gdc( dict(searchterms=searchterms))
+    >>> results = search('breast cancer variants')
+    >>> len(results) > 0, all('breast' in t.split('_') for t in results['tissue']), all('variants' in a for a in results['assay'])
+    (True, True, True)
+    >>> results = search('--tissue heart --assay rna-seq')
+    >>> len(results) > 0, all('heart' in t.split('_') for t in results['tissue']), all('rnaseq' in a for a in results['assay'])
+    (True, True, True)
+    >>> results = search('--assay single cell --tissue brain')
+    >>> len(results) > 0, all('brain' in t.split('_') for t in results['tissue']), all('single-cell' in a for a in results['assay'])
+    (True, True, True)
+
+    Without FTS5, general words go through the category token index, and find the same files:
+    >>> ranked = search('lung rna-seq')
+    >>> atlas_utils._text_index['fts5'] = False
+    >>> converted = search('lung rna-seq')
+    >>> del atlas_utils._text_index['fts5']
+    >>> len(ranked) > 0, sorted(converted.index) == sorted(ranked.index)
+    (True, True)
+    >>> server.stop()
 
     Prints number of experiment datasets found and where results are output to (search_gdc.txt).
     Outputs search results to search_gdc.txt (tab-delimited text)
@@ -60,19 +100,29 @@ def search_gdc( args ):
     For help with anything, type:
     $ bioshed search gdc --help
     $ bioshed download gdc --help
+
+    --profile [<trace file>] writes timings of the search steps to a JSON trace (default bioshed_profile.json).
+
+    General search words ("breast cancer variants") are looked up in a full-text index of the
+    manifest's category values (see get_manifest_text_rows), and results are ranked by how well they match.
+    If SQLite has no FTS5 (atlas_utils.text_index_available), they are instead matched to category
+    values with the category token index (see convert_general_terms), and results are not ranked.
     """
-    MANIFEST_FILE = os.path.join(SCRIPT_DIR, "files/gdc/manifest-all-gdc.txt.gz")
-    CATEGORIES_FILE = os.path.join(SCRIPT_DIR, 'files/gdc/categories-all-gdc.txt')
+    MANIFEST_FILE = DEFAULT_MANIFEST_FILE
+    CATEGORIES_FILE = DEFAULT_CATEGORIES_FILE
     print('Using manifest file: {}'.format(MANIFEST_FILE))
     print('Using category file: {}'.format(CATEGORIES_FILE))
     search_results = {}
     search_string = args['searchterms'] if 'searchterms' in args else ''
     # dictionary of search terms: {"general": "...", "tissue": "...", "celltype": "..."...}
     search_dict = atlas_utils.parse_search_terms( search_string ) if search_string != '' else {}
+    search_dict.pop('profile', None)
     if search_dict == {} or 'help' in search_dict:
         print_gdc_help()
     else:
-        search_dict = convert_general_terms( search_dict, CATEGORIES_FILE )
+        if not atlas_utils.text_index_available():
+            # no full-text index (see get_manifest_text_rows) - general words are matched to category values
+            search_dict = convert_general_terms( search_dict, CATEGORIES_FILE )
         print('Search dictionary: {}'.format(str(search_dict)))
         search_results = get_manifest_rows( search_dict, search_string, MANIFEST_FILE )
     return search_results
@@ -87,27 +137,98 @@ def convert_general_terms( search_dict, CATEGORIES_FILE ):
     search_dict: updated search dict
 
     Example:
-    {"general": "breast cancer rna-seq"} => {"tissue": "breast", "assay": "rna-seq"}
+    {"general": "breast cancer rna-seq"} => {"tissue": "breast", "assay": "rnaseq"}
+
+    Each general word is looked up in the category token index (see load_category_index),
+    and added to every category it matches, in the form used by that category.
+    This is how search_gdc handles general words when SQLite has no FTS5 (otherwise see get_manifest_text_rows).
     """
-    categories = {}
     if "general" in search_dict:
-        with open(CATEGORIES_FILE,'r') as f:
-            for r in f:
-                rt = r.strip().split('\t')
-                category = rt[0]
-                terms = rt[1]
-                categories[category] = terms
-
+        index = load_category_index( CATEGORIES_FILE )
         general_terms = search_dict["general"]
-        # just use simple word-based search for now
         general_terms_split = quick_utils.format_type(general_terms, 'list')
         for gterm in general_terms_split:
-            for k, v in categories.items():
-                if quick_utils.quick_format(gterm) in v and gterm not in GENERIC_TERMS:
-                    search_dict = atlas_utils.add_term(search_dict, k, gterm)
+            gterm = quick_utils.quick_format(gterm)
+            if gterm not in GENERIC_TERMS:
+                for category, term in match_general_term( gterm, index ):
+                    search_dict = atlas_utils.add_term(search_dict, category, term)
     return search_dict
 
 
+def load_category_index( CATEGORIES_FILE ):
+    """ Loads the token index of category values, cached per process (reloaded if the file changes).
+
+    CATEGORIES_FILE: tab-delimited file with category in 1st column and a list of its values in 2nd column
+    ---
+    index: {"exact": {key: {category: term}}, "prefix": {prefix: {category: term}}}
+
+    "exact" keys are every run of '-'-separated words of a value ("whole-genome" for
+    "WGS-whole-genome-seq"), also with the hyphens removed ("wholegenome"), lowercase.
+    "prefix" keys are prefixes (at least MIN_PREFIX_LENGTH long) of single words, kept only
+    when they complete to a single word within a category.
+    The term is the matching run of words, as it should be searched for in the manifest.
+    """
+    mtime = os.path.getmtime(CATEGORIES_FILE)
+    if CATEGORIES_FILE in _category_index and _category_index[CATEGORIES_FILE][0] == mtime:
+        return _category_index[CATEGORIES_FILE][1]
+    exact = {}
+    completions = {}    # {prefix: {category: set of words}}
+    with open(CATEGORIES_FILE,'r') as f:
+        for r in f:
+            rt = r.strip().split('\t')
+            if len(rt) < 2:
+                continue
+            category = rt[0]
+            for value in ast.literal_eval(rt[1]):
+                words = value.lower().split('-')
+                for i in range(len(words)):
+                    for j in range(i+1, len(words)+1):
+                        term = '-'.join(words[i:j])
+                        exact.setdefault(term, {}).setdefault(category, term)
+                        exact.setdefault(term.replace('-',''), {}).setdefault(category, term)
+                for word in words:
+                    for n in range(MIN_PREFIX_LENGTH, len(word)):
+                        completions.setdefault(word[:n], {}).setdefault(category, set()).add(word)
+    prefix = {}
+    for p, category_words in completions.items():
+        for category, words in category_words.items():
+            if len(words) == 1:
+                prefix.setdefault(p, {})[category] = list(words)[0]
+    index = {"exact": exact, "prefix": prefix}
+    _category_index[CATEGORIES_FILE] = (mtime, index)
+    return index
+
+
+def match_general_term( gterm, index ):
+    """ Matches a general search word against the category token index.
+    Exact matches (including hyphen-insensitive ones) take precedence over prefix matches.
+
+    gterm: lowercase search word
+    index: category token index (see load_category_index)
+    ---
+    matches: list of (category, term), in category file order
+
+    >>> index = load_category_index(os.path.join(SCRIPT_DIR, 'files/gdc/categories-all-gdc.txt'))
+    >>> match_general_term('rna-seq', index)
+    [('assay', 'rnaseq')]
+    >>> match_general_term('lung', index)
+    [('tissue', 'lung')]
+    >>> match_general_term('methyl', index)
+    [('assay', 'methylation'), ('platform', 'methylation')]
+    >>> match_general_term('a', index)
+    []
+    """
+    gterm = gterm.lower().strip()
+    if gterm in index["exact"]:
+        return list(index["exact"][gterm].items())
+    if gterm.replace('-','') in index["exact"]:
+        return list(index["exact"][gterm.replace('-','')].items())
+    if gterm in index["prefix"]:
+        return list(index["prefix"][gterm].items())
+    return []
+
+
+@atlas_utils.traced('get_manifest_rows')
 def get_manifest_rows( search_dict, search_string, MANIFEST_FILE ):
     """
     Gets rows from GDC-formatted manifest file that match search terms.
@@ -119,10 +240,27 @@ def get_manifest_rows( search_dict, search_string, MANIFEST_FILE ):
     ---
     results: data frame of results
     (out): filtered GDC-format manifest file
-    """
 
-    df = pd.read_csv(MANIFEST_FILE, compression='gzip', sep='\t')
-    columns = list(df.columns)
+    Category columns (INDEX_COLUMNS) are searched through the inverted index, so a
+    term matches whole '_'-separated values (or a run of their '-'-separated words)
+    rather than any substring of the cell. Other columns are scanned with str.contains.
+    General words are searched in the full-text index (get_manifest_text_rows), and the
+    results are then ordered best match first.
+    Full rows are only read for the matching row positions at the end (see open_manifest_store).
+    """
+    with atlas_utils.span('get_manifest_rows.open'):
+        manifest, index = load_manifest( MANIFEST_FILE )
+    columns = list(manifest.columns) if isinstance(manifest, pd.DataFrame) else manifest.column_names
+    nrows = int(index['__nrows__'])
+    bits = None  # packed bitmap of rows matching all search terms so far (None = all rows)
+    ranked = None   # rows matching the general search words, best match first
+    if 'general' in search_dict and search_dict['general'].strip() != '':
+        with atlas_utils.span('get_manifest_rows.text', text=search_dict['general']):
+            ranked = get_manifest_text_rows( MANIFEST_FILE, index, search_dict['general'] )
+        if ranked is not None:
+            matches = np.zeros(nrows, dtype=bool)
+            matches[ranked] = True
+            bits = np.packbits(matches)
     # look for each search term within the corresp category column in the manifest data frame
     for k, v in search_dict.items():
         if k == 'celltype' or (k == 'disease' and ('tumor' in v or 'tumour' in v or 'cancer' in v)):
@@ -130,7 +268,10 @@ def get_manifest_rows( search_dict, search_string, MANIFEST_FILE ):
         if k in columns:
             # special case where user wants a list of valid search terms, e.g. search gdc --filetype
             if len(search_dict) == 1 and v.strip() == "":
-                unique_terms = str('_'.join(list(set(list(df[k]))))).split('_')
+                if k in INDEX_COLUMNS:
+                    unique_terms = get_manifest_values( index, k )
+                else:
+                    unique_terms = str('_'.join(list(set(list(get_manifest_column( manifest, k )))))).split('_')
                 print('Valid search terms for category {}'.format(k))
                 for unique_term in unique_terms:
                     if unique_term != '.':
@@ -141,12 +282,26 @@ def get_manifest_rows( search_dict, search_string, MANIFEST_FILE ):
             for t in terms:
                 t = quick_utils.quick_format(t)
                 if t not in GENERIC_TERMS:
-                    df = df.loc[df[k].str.contains(t, case=False)]
+                    with atlas_utils.span('get_manifest_rows.filter', category=k, term=t):
+                        if k in INDEX_COLUMNS:
+                            t_bits = get_manifest_term_bits( index, k, t )
+                        else:
+                            t_bits = np.packbits(get_manifest_column( manifest, k ).str.contains(t, case=False, na=False).values)
+                        bits = t_bits if bits is None else np.bitwise_and(bits, t_bits)
+    with atlas_utils.span('get_manifest_rows.table') as attrs:
+        rows = None if bits is None else np.unpackbits(bits, count=nrows).nonzero()[0]
+        if ranked is not None:
+            rank = np.full(nrows, len(ranked))
+            rank[ranked] = np.arange(len(ranked))
+            rows = rows[np.argsort(rank[rows], kind='stable')]
+        df = get_manifest_table( manifest, rows )
+        attrs['rows'] = len(df)
     # write filtered data frame to output file for download
-    with open(DEFAULT_SEARCH_FILE,'w') as fout:
-        fout.write('# bioshed search gdc {}\n'.format(search_string))
-    df.index.name = 'index'
-    df.to_csv(DEFAULT_SEARCH_FILE, sep='\t', mode='a')
+    with atlas_utils.span('get_manifest_rows.write'):
+        with open(DEFAULT_SEARCH_FILE,'w') as fout:
+            fout.write('# bioshed search gdc {}\n'.format(search_string))
+        df.index.name = 'index'
+        df.to_csv(DEFAULT_SEARCH_FILE, sep='\t', mode='a')
 
     print(df)
     print('')
@@ -158,6 +313,372 @@ def get_manifest_rows( search_dict, search_string, MANIFEST_FILE ):
     print('Type "bioshed download gdc" to download data files or "bioshed download gdc --list" for file info before downloading.')
     return df
 
+
+def load_manifest( MANIFEST_FILE ):
+    """ Opens a GDC manifest and its index, cached per process (reopened if the manifest changes),
+    so that a long-running process (atlas_daemon.py) only loads them once.
+
+    MANIFEST_FILE: gzipped tab-delimited GDC manifest file
+    ---
+    manifest: pyarrow Table (open_manifest_store), or compact data frame (read_manifest) if pyarrow is not installed
+    index: manifest index (open_manifest_index)
+    """
+    signature = manifest_signature( MANIFEST_FILE )
+    if MANIFEST_FILE in _manifest_cache and _manifest_cache[MANIFEST_FILE][0] == signature:
+        return _manifest_cache[MANIFEST_FILE][1], _manifest_cache[MANIFEST_FILE][2]
+    manifest = open_manifest_store( MANIFEST_FILE )
+    if manifest is None:
+        # pyarrow is not available - fall back to parsing the gzipped manifest
+        manifest = read_manifest( MANIFEST_FILE )
+    index = open_manifest_index( MANIFEST_FILE, manifest )
+    _manifest_cache[MANIFEST_FILE] = (signature, manifest, index)
+    return manifest, index
+
+
+def manifest_store_file( MANIFEST_FILE ):
+    """ Returns the path of the columnar store for a gzipped GDC manifest.
+
+    >>> manifest_store_file('files/gdc/manifest-all-gdc.txt.gz')
+    'files/gdc/manifest-all-gdc.arrow'
+    """
+    base = MANIFEST_FILE[:-len('.txt.gz')] if MANIFEST_FILE.endswith('.txt.gz') else MANIFEST_FILE
+    return base + '.arrow'
+
+
+def open_manifest_store( MANIFEST_FILE, df=None ):
+    """ Opens the columnar store (Arrow IPC / feather, memory-mapped) for a GDC manifest.
+    The store is (re)built from the gzipped manifest the first time it is needed
+    and whenever the size or modification time of the .gz file changes.
+    Opening the store does not read any data - columns are paged in as they are used.
+
+    MANIFEST_FILE: gzipped tab-delimited GDC manifest file
+    df: contents of MANIFEST_FILE as a data frame of strings, if already in memory (saves re-reading the .gz)
+    ---
+    table: pyarrow Table, or None if pyarrow is not installed
+
+    The store is compact:
+    - category columns (INDEX_COLUMNS) are dictionary-encoded: one small integer code per row,
+      each distinct (possibly '_'-joined) value stored once
+    - id and md5 are stored as 16-byte binary when possible (see encode_hex_column)
+    Use get_manifest_column / get_manifest_table to read it back as strings.
+
+    [NOTE] If the store cannot be written (e.g. read-only install), the table is
+    built in memory for this run only.
+    """
+    try:
+        import pyarrow as pa
+        import pyarrow.feather as feather
+    except ImportError:
+        return None
+    store_file = manifest_store_file( MANIFEST_FILE )
+    signature = manifest_signature( MANIFEST_FILE ).encode()
+    if os.path.exists(store_file):
+        table = feather.read_table(store_file, memory_map=True)
+        metadata = table.schema.metadata or {}
+        if metadata.get(b'source') == signature and metadata.get(b'format') == MANIFEST_STORE_FORMAT.encode():
+            return table
+    print('Building manifest store {} (one-time)...'.format(store_file))
+    if df is None:
+        df = read_manifest( MANIFEST_FILE )
+    table = pa.Table.from_pandas(compact_manifest( df ), preserve_index=False)
+    for column, encoding in HEX_COLUMNS.items():
+        if column in table.column_names:
+            chunks = [encode_hex_column( chunk, encoding ) for chunk in table.column(column).chunks]
+            if all(chunk is not None for chunk in chunks):
+                field = pa.field(column, pa.binary(16), metadata={'encoding': encoding})
+                table = table.set_column(table.column_names.index(column), field, pa.chunked_array(chunks, type=pa.binary(16)))
+    table = table.replace_schema_metadata({'source': signature, 'format': MANIFEST_STORE_FORMAT})
+    try:
+        # store uncompressed so that columns can be memory-mapped without decoding
+        feather.write_feather(table, store_file+'.tmp', compression='uncompressed')
+        os.replace(store_file+'.tmp', store_file)
+    except OSError as e:
+        print('WARNING: could not write manifest store {}: {}'.format(store_file, str(e)))
+        return table
+    return feather.read_table(store_file, memory_map=True)
+
+
+def read_manifest( MANIFEST_FILE ):
+    """ Reads a gzipped GDC manifest into a compact data frame (see compact_manifest).
+    Used when the manifest store cannot be used (pyarrow not installed) or is being built.
+    """
+    return pd.read_csv(MANIFEST_FILE, compression='gzip', sep='\t', keep_default_na=False,
+                       dtype={column: ('category' if column in INDEX_COLUMNS else str) for column in pd.read_csv(MANIFEST_FILE, compression='gzip', sep='\t', nrows=0).columns})
+
+
+def compact_manifest( df ):
+    """ Converts the category columns (INDEX_COLUMNS) of a manifest data frame to pandas
+    categoricals, so that each distinct value is held once and rows hold integer codes.
+    Other columns are left as strings.
+    """
+    return df.astype({column: 'category' for column in INDEX_COLUMNS if column in df.columns})
+
+
+def encode_hex_column( values, encoding ):
+    """ Packs a column of lowercase hex strings into 16 bytes per value.
+
+    values: pyarrow string array
+    encoding: 'uuid' (6fd3fe64-23ba-4db3-8315-1867bdec277d) or 'hex' (32 hex digits, e.g. an md5)
+    ---
+    packed: pyarrow fixed_size_binary(16) array, or None if some value is not in that form
+
+    >>> import pyarrow as pa
+    >>> packed = encode_hex_column(pa.array(['6fd3fe64-23ba-4db3-8315-1867bdec277d']), 'uuid')
+    >>> packed[0].as_py().hex()
+    '6fd3fe6423ba4db383151867bdec277d'
+    >>> decode_hex_column(packed, 'uuid').to_pylist()
+    ['6fd3fe64-23ba-4db3-8315-1867bdec277d']
+    >>> encode_hex_column(pa.array(['A773004E175527AD668A8DB92F0C4E80']), 'hex') is None
+    True
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    if values.null_count > 0 or (len(values) > 0 and not pc.all(pc.match_substring_regex(values, HEX_PATTERNS[encoding])).as_py()):
+        return None
+    # 32 hex digits per value, back to back in the data buffer
+    digits = pc.replace_substring(values, '-', '') if encoding == 'uuid' else values
+    offsets = np.frombuffer(digits.buffers()[1], dtype=np.int32 if digits.type == pa.string() else np.int64)[digits.offset:digits.offset+len(digits)+1]
+    digits = np.frombuffer(digits.buffers()[2], dtype=np.uint8)[offsets[0]:offsets[-1]] if len(values) > 0 else np.zeros(0, dtype=np.uint8)
+    nibbles = np.zeros(256, dtype=np.uint8)
+    nibbles[np.frombuffer(b'0123456789abcdef', dtype=np.uint8)] = np.arange(16, dtype=np.uint8)
+    pairs = nibbles[digits].reshape(-1, 16, 2)
+    packed = (pairs[:, :, 0] << 4) | pairs[:, :, 1]
+    return pa.FixedSizeBinaryArray.from_buffers(pa.binary(16), len(values), [None, pa.py_buffer(packed.tobytes())])
+
+
+def decode_hex_column( packed, encoding ):
+    """ Unpacks a column packed by encode_hex_column back into strings.
+
+    packed: pyarrow fixed_size_binary(16) array or chunked array
+    encoding: 'uuid' or 'hex'
+    ---
+    values: pyarrow string array (built directly from the digits, without Python strings)
+    """
+    import pyarrow as pa
+    if isinstance(packed, pa.ChunkedArray):
+        packed = packed.combine_chunks() if packed.num_chunks > 0 else pa.array([], type=pa.binary(16))
+    raw = np.frombuffer(packed.buffers()[1], dtype=np.uint8)[packed.offset*16:(packed.offset+len(packed))*16].reshape(-1, 16) if len(packed) > 0 else np.zeros((0, 16), dtype=np.uint8)
+    hex_digits = np.frombuffer(b'0123456789abcdef', dtype=np.uint8)
+    digits = np.empty((len(raw), 32), dtype=np.uint8)
+    digits[:, 0::2] = hex_digits[raw >> 4]
+    digits[:, 1::2] = hex_digits[raw & 15]
+    if encoding == 'uuid':
+        digits = np.insert(digits, [8, 12, 16, 20], ord('-'), axis=1)
+    offsets = np.arange(len(raw)+1, dtype=np.int32) * digits.shape[1]
+    return pa.StringArray.from_buffers(len(raw), pa.py_buffer(offsets.tobytes()), pa.py_buffer(np.ascontiguousarray(digits).tobytes()))
+
+
+def manifest_to_pandas( table ):
+    """ Converts (part of) the manifest store to a pandas data frame: category columns become
+    pandas categoricals and packed id/md5 columns are decoded back to strings.
+    """
+    for i, field in enumerate(table.schema):
+        if field.metadata is not None and b'encoding' in field.metadata:
+            table = table.set_column(i, field.name, decode_hex_column( table.column(i), field.metadata[b'encoding'].decode() ))
+    return table.to_pandas()
+
+
+def manifest_signature( MANIFEST_FILE ):
+    """ Returns a string identifying the current version of a manifest file (size and modification time).
+    Stores and indexes built from the manifest record it, and are rebuilt when it changes.
+    """
+    st = os.stat(MANIFEST_FILE)
+    return '{}:{}'.format(str(st.st_size), str(st.st_mtime_ns))
+
+
+def open_manifest_index( MANIFEST_FILE, manifest ):
+    """ Opens the inverted index of a GDC manifest, building it first if it is
+    missing or out of date. The index maps each (category column, value) to the
+    set of manifest rows having that value, stored as a compressed bitmap:
+
+    files/gdc/manifest-all-gdc.index.npz
+        "assay=transcriptome-rnaseq": packed bitmap (np.packbits) of matching rows
+        ...
+        "__nrows__": number of manifest rows
+        "__source__": manifest_signature() of the manifest it was built from
+
+    Multi-valued cells (e.g. "transcriptome-rnaseq_single-cell-rnaseq") set the row
+    in the bitmap of each of their '_'-separated values.
+
+    MANIFEST_FILE: gzipped tab-delimited GDC manifest file
+    manifest: pyarrow Table (from open_manifest_store) or pandas data frame of the manifest
+    ---
+    index: NpzFile (bitmaps are decompressed on access)
+    """
+    index_file = manifest_store_file( MANIFEST_FILE )[:-len('.arrow')] + '.index.npz'
+    signature = manifest_signature( MANIFEST_FILE )
+    if os.path.exists(index_file):
+        index = np.load(index_file)
+        if str(index['__source__']) == signature:
+            return index
+    print('Building manifest index {} (one-time)...'.format(index_file))
+    columns = list(manifest.columns) if isinstance(manifest, pd.DataFrame) else manifest.column_names
+    arrays = {}
+    for column in INDEX_COLUMNS:
+        if column not in columns:
+            continue
+        # work on the integer codes of the column: each distinct cell is split once, and the rows
+        # having a value are the rows whose code stands for a cell containing it
+        codes, cells = get_manifest_codes( manifest, column )
+        cell_values = [str(cell).split('_') for cell in cells]
+        for value in sorted(set([v for values in cell_values for v in values])):
+            if value not in ['.', '']:
+                # one more entry (False) for missing cells (code -1)
+                code_matches = np.array([value in values for values in cell_values] + [False])
+                arrays['{}={}'.format(column, value)] = np.packbits(code_matches[codes])
+    arrays['__nrows__'] = np.array(len(manifest))
+    arrays['__source__'] = np.array(signature)
+    try:
+        with open(index_file+'.tmp', 'wb') as fout:
+            np.savez_compressed(fout, **arrays)
+        os.replace(index_file+'.tmp', index_file)
+    except OSError as e:
+        print('WARNING: could not write manifest index {}: {}'.format(index_file, str(e)))
+        return arrays
+    return np.load(index_file)
+
+
+def open_manifest_text_index( MANIFEST_FILE, index ):
+    """ Returns a full-text index (SQLite FTS5, in memory) of the distinct category values of a
+    GDC manifest, built from its inverted index and kept per process (rebuilt if the manifest changes):
+
+        terms(text, key): one document per category value - text: atlas_utils.text_index_terms of
+                          the value, key: its bitmap in the inverted index ("tissue=bronchus-lung")
+
+    MANIFEST_FILE: gzipped tab-delimited GDC manifest file
+    index: manifest index (open_manifest_index)
+    ---
+    conn: sqlite3 connection
+    """
+    signature = str(index['__source__'])
+    if MANIFEST_FILE in _text_index_cache and _text_index_cache[MANIFEST_FILE][0] == signature:
+        return _text_index_cache[MANIFEST_FILE][1]
+    conn = sqlite3.connect(':memory:', check_same_thread=False)
+    conn.execute("CREATE VIRTUAL TABLE terms USING fts5(text, key UNINDEXED, tokenize='{}')".format(atlas_utils.TEXT_TOKENIZER))
+    conn.executemany('INSERT INTO terms (text, key) VALUES (?, ?)',
+                     [(atlas_utils.text_index_terms( [value] ), '{}={}'.format(column, value)) for column in INDEX_COLUMNS for value in get_manifest_values( index, column )])
+    _text_index_cache[MANIFEST_FILE] = (signature, conn)
+    return conn
+
+
+def get_manifest_text_rows( MANIFEST_FILE, index, text ):
+    """ Full-text search of a GDC manifest's category values (see open_manifest_text_index).
+
+    Each word is matched against every category value (whole words or runs of '-'-separated
+    words, with or without hyphens, or the start of a word - see atlas_utils.text_match_query),
+    and a file must have a matching value for every word. Files are ranked by the sum, over the
+    words, of the bm25 score of their best matching value, so that files whose values match the
+    words closely ("lung") come before files where they are part of a longer value ("bronchus-lung").
+    Words matching no value, and GENERIC_TERMS, are ignored.
+
+    text: general search words, e.g. "breast cancer variants"
+    ---
+    rows: numpy array of matching row positions, best match first - None if SQLite has no FTS5
+
+    >>> index = {'__source__': 'doctest', '__nrows__': 3, 'tissue=bronchus-lung': np.packbits([1, 0, 0]),
+    ...          'tissue=lung': np.packbits([0, 1, 0]), 'assay=transcriptome-rnaseq': np.packbits([1, 1, 1])}
+    >>> get_manifest_text_rows('doctest.txt.gz', index, 'lung cancer rna-seq').tolist()
+    [1, 0]
+    """
+    if not atlas_utils.text_index_available():
+        return None
+    conn = open_manifest_text_index( MANIFEST_FILE, index )
+    nrows = int(index['__nrows__'])
+    scores = np.zeros(nrows)
+    matches_all = np.ones(nrows, dtype=bool)
+    for word in atlas_utils.text_words( text ):
+        if word in GENERIC_TERMS:
+            continue
+        matches = conn.execute('SELECT key, bm25(terms) FROM terms WHERE terms MATCH ?', (atlas_utils.text_match_query( word ),)).fetchall()
+        if len(matches) == 0:
+            print('No files match "{}" - ignoring it.'.format(word))
+            continue
+        word_scores = np.zeros(nrows)
+        for key, score in matches:
+            # bm25() is negative, lower is better
+            word_scores = np.maximum(word_scores, max(-score, 1e-6) * np.unpackbits(index[key], count=nrows))
+        matches_all &= word_scores > 0
+        scores += word_scores
+    rows = matches_all.nonzero()[0]
+    return rows[np.argsort(-scores[rows], kind='stable')]
+
+
+def get_manifest_values( index, column ):
+    """ Returns the distinct values of a category column, from the manifest index.
+    """
+    prefix = column + '='
+    return [key[len(prefix):] for key in index.keys() if key.startswith(prefix)]
+
+
+def match_manifest_value( term, value ):
+    """ Returns True if a search term matches a single category value: either the
+    whole value, or a run of its '-'-separated words (case-insensitive). Hyphens are
+    ignored, as in load_category_index: "rna-seq" matches the word "rnaseq".
+
+    >>> match_manifest_value('rnaseq', 'transcriptome-rnaseq')
+    True
+    >>> match_manifest_value('whole-genome', 'WGS-whole-genome-seq')
+    True
+    >>> match_manifest_value('wholegenome', 'WGS-whole-genome-seq')
+    True
+    >>> match_manifest_value('rna-seq', 'single-cell-rnaseq')
+    True
+    >>> match_manifest_value('rna', 'transcriptome-rnaseq')
+    False
+    """
+    term = term.lower().replace('-', '')
+    value_words = value.lower().split('-')
+    return any(''.join(value_words[i:j]) == term for i in range(len(value_words)) for j in range(i+1, len(value_words)+1))
+
+
+def get_manifest_term_bits( index, column, term ):
+    """ Returns the packed bitmap of manifest rows where a category column has a value matching term.
+    Rows with several matching values are only counted once (bitmaps are OR-ed).
+    """
+    bits = np.zeros((int(index['__nrows__'])+7)//8, dtype=np.uint8)
+    for value in get_manifest_values( index, column ):
+        if match_manifest_value( term, value ):
+            bits = np.bitwise_or(bits, index['{}={}'.format(column, value)])
+    return bits
+
+
+def get_manifest_column( manifest, column ):
+    """ Returns a single manifest column as a pandas Series (categorical for category columns).
+    manifest: pyarrow Table (from open_manifest_store) or pandas data frame
+    """
+    if isinstance(manifest, pd.DataFrame):
+        return manifest[column]
+    return manifest_to_pandas( manifest.select([column]) )[column]
+
+
+def get_manifest_codes( manifest, column ):
+    """ Returns a manifest column as integer codes, and the distinct values the codes stand for.
+    manifest: pyarrow Table (from open_manifest_store) or pandas data frame
+    ---
+    codes: numpy integer array, one code per row (-1 for missing values)
+    values: list of distinct values (values[code])
+    """
+    series = get_manifest_column( manifest, column )
+    if not isinstance(series.dtype, pd.CategoricalDtype):
+        series = series.astype('category')
+    return series.cat.codes.to_numpy(), list(series.cat.categories)
+
+
+def get_manifest_table( manifest, rows=None ):
+    """ Returns manifest rows as a pandas data frame, indexed by row position in the manifest.
+    manifest: pyarrow Table (from open_manifest_store) or pandas data frame
+    rows: row positions to return (default: all rows)
+    """
+    if isinstance(manifest, pd.DataFrame):
+        return manifest if rows is None else manifest.iloc[rows]
+    if rows is None:
+        return manifest_to_pandas( manifest )
+    df = manifest_to_pandas( manifest.take(rows) )
+    df.index = rows
+    return df
+
+@atlas_utils.served('download_gdc', condition=atlas_utils.list_only)
+@atlas_utils.profiled('download_gdc')
 def download_gdc( args ):
     """ Entrypoint for an GDC download.
     Assumes that search_gdc() has already been run, so that a search_gdc.txt file exists.
@@ -175,6 +696,12 @@ def download_gdc( args ):
     --id <refine by ID>
     --index <refine by index>
     --tissue <refine by tissue of origin>
+    --workers <number of concurrent file transfers (default 8)>
+    --profile <write timings of the download steps to a JSON trace (default bioshed_profile.json)>
+
+    HTTP downloads resume from partial (.part) files left by an interrupted run, and are
+    checked against the md5 column of the manifest (files failing the check are downloaded again).
+    With --update, existing files are kept if their md5 matches.
 
     Multiple ids or indexes can be specified by either comma or space delimiting:
     --id 34005 34006
@@ -183,13 +710,11 @@ def download_gdc( args ):
     [TODO] Clean up documentation and write tests
 
     [NOTE] Current format for search_gdc.txt is:
-    id      filename        md5     project assay   tissue  disease species platform        filetype
-    6fd3fe64-23ba-4db3-8315-1867bdec277d    b7274dab-7650-4de3-91a1-7accf806e870.mirbase21.isoforms.quantification.txt      a773004e175527ad668a8db92f0c4e80        tcga    transcriptome-mirna-seq-small-rnaseq    heart   .       human   .       filetype-txt
+    id      filename        md5     size    project assay   tissue  disease species platform        filetype
+    6fd3fe64-23ba-4db3-8315-1867bdec277d    b7274dab-7650-4de3-91a1-7accf806e870.mirbase21.isoforms.quantification.txt      a773004e175527ad668a8db92f0c4e80        50895   tcga    transcriptome-mirna-seq-small-rnaseq    heart   .       human   .       filetype-txt
     [NOTE] '|'.join learned from:
     https://stackoverflow.com/questions/26577516/how-to-test-if-a-string-contains-one-of-the-substrings-in-a-list-in-pandas
     """
-    BASE_S3_DIR = "s3://tcga-2-open/"
-    BASE_HTTPS_DIR = "https://api.gdc.cancer.gov/data/"
     INFO_COLUMNS = ['id', 'assay', 'tissue']
     dd = atlas_utils.parse_search_terms( args['downloadstr'] if 'downloadstr' in args else '')
     infile = dd['input'] if 'input' in dd else DEFAULT_SEARCH_FILE
@@ -202,6 +727,7 @@ def download_gdc( args ):
     filename = dd['filename'] if 'filename' in dd else ''
     listonly = 'True' if 'list' in dd else ''
     updateonly = 'True' if 'update' in dd else ''
+    workers = int(dd['workers']) if 'workers' in dd and dd['workers'] != '' else atlas_http_utils.DEFAULT_WORKERS
     outfiles = []
     downloaded_files = []
     annotation_info = []
@@ -217,22 +743,23 @@ def download_gdc( args ):
             if r[0] == '#':
                 original_search_command = r.strip()
         # get table                        
-        df = pd.read_csv(infile, sep='\t', comment='#')
-        # print(df)
-        if assay != '':
-            df = df.loc[df['assay'].str.contains(assay, case=False)]
-        if _id != '':
-            _id = quick_utils.format_type(_id, 'list')
-            df = df.loc[df['id'].str.contains('|'.join(_id), case=False)]
-        if index != '':
-            index = quick_utils.format_type(index, 'list')
-            df = df.loc[df['index'].astype(str).str.contains('|'.join(index))]
-        if tissue != '':
-            df = df.loc[df['tissue'].str.contains(tissue, case=False)]
-        if filetype != '':
-            df = df.loc[df['filetype'].str.contains(filetype, case=False)]
-        if filename != '':
-            df = df.loc[df['filename'].str.contains(filename, case=False)]
+        with atlas_utils.span('download_gdc.filter'):
+            df = pd.read_csv(infile, sep='\t', comment='#')
+            # print(df)
+            if assay != '':
+                df = df.loc[df['assay'].str.contains(assay, case=False)]
+            if _id != '':
+                _id = quick_utils.format_type(_id, 'list')
+                df = df.loc[df['id'].str.contains('|'.join(_id), case=False)]
+            if index != '':
+                index = quick_utils.format_type(index, 'list')
+                df = df.loc[df['index'].astype(str).str.contains('|'.join(index))]
+            if tissue != '':
+                df = df.loc[df['tissue'].str.contains(tissue, case=False)]
+            if filetype != '':
+                df = df.loc[df['filetype'].str.contains(filetype, case=False)]
+            if filename != '':
+                df = df.loc[df['filename'].str.contains(filename, case=False)]
 
         # generate list of files
         if quick_utils.cloud_initialized(dict(cloud='aws')):
@@ -255,21 +782,19 @@ def download_gdc( args ):
             # download files
             if outdir.startswith('s3') and len(outfiles) > 0 and outfiles[0].startswith('s3'):
                 # s3 file transfer
-                downloaded_files = aws_s3_utils.transfer_file_s3( dict(path=outfiles, outpath=outdir, overwrite='False' if updateonly=='True' else 'True'))
+                with atlas_utils.span('transfer_file_s3', files=len(outfiles)):
+                    downloaded_files = aws_s3_utils.transfer_file_s3( dict(path=outfiles, outpath=outdir, overwrite='False' if updateonly=='True' else 'True'))
             elif not outdir.startswith('s3') and len(outfiles) > 0 and outfiles[0].startswith('s3'):
-                downloaded_files = aws_s3_utils.download_file_s3( dict(path=outfiles, localdir=outdir, overwrite='False' if updateonly=='True' else 'True'))
+                with atlas_utils.span('download_file_s3', files=len(outfiles)):
+                    downloaded_files = aws_s3_utils.download_file_s3( dict(path=outfiles, localdir=outdir, overwrite='False' if updateonly=='True' else 'True'))
             elif not outdir.startswith('s3') and len(outfiles) > 0 and outfiles[0].startswith('http'):
                 # http download to local
-                for idx, row in df.iterrows():
-                    outfile = row['filepath']
-                    outfile_name = row['filename']
-                    print('Downloading {}'.format(outfile_name))
-                    # get http(s) file
-                    _response = quick_utils.get_request( dict(url=outfile))
-                    # write to local file
-                    open(os.path.join(outdir, quick_utils.get_file_only(outfile_name)), 'wb').write(_response.content)
-                    # save list of downloaded files
-                    downloaded_files.append(os.path.join(outdir, quick_utils.get_file_only(outfile_name)))
+                # files with the same name are saved as <id>_<filename>
+                local_files = atlas_http_utils.unique_outfiles( [os.path.join(outdir, quick_utils.get_file_only(f)) for f in df['filename']], list(df['id']) )
+                downloads = []
+                for (idx, row), local_file in zip(df.iterrows(), local_files):
+                    downloads.append(dict(url=row['filepath'], outfile=local_file, size=row['size'] if 'size' in df.columns else None, md5=row['md5']))
+                downloaded_files = atlas_http_utils.download_http_all( downloads, workers=workers, overwrite='False' if updateonly=='True' else 'True' )
 
 
             # print annotation info
@@ -285,25 +810,69 @@ def download_gdc( args ):
     return downloaded_files
 
 
-def combine_all( base_dir ):
+def combine_all( base_dir, incremental='True', workers=None ):
     """ Combines all manifest files into one tab-delimited manifest.
     See COLS variable for column names and order.
 
     base_dir: base directory where GDC-format manifest files reside
+    incremental: 'True' (default) to only re-parse manifest files that changed since the last build
+    workers: number of processes used to parse manifest files (default: number of CPUs)
     ---
-    (out): full manifest file
+    (out): full manifest file (gzipped), with its columnar store and index (see open_manifest_store)
     (out): category list file
 
+    Manifest files are parsed in parallel, and the parsed contents of each file are
+    cached in <base_dir>/.combine_cache. With incremental='True', a file is only parsed
+    again if its size and modification time changed and its contents (sha1) changed.
+    Category files are read in sorted order, so multi-valued cells are joined in a stable order.
+    If no manifest file changed and the outputs were written from the same files, nothing is rewritten.
+
+    >>> import io, contextlib, tempfile
+    >>> base_dir = tempfile.mkdtemp()
+    >>> def write_manifest( category, value, ids ):
+    ...     os.makedirs(os.path.join(base_dir, category), exist_ok=True)
+    ...     with open(os.path.join(base_dir, category, 'manifest.{}.txt'.format(value)), 'w') as f:
+    ...         f.write('id\\tfilename\\tmd5\\tsize\\tstate\\n')
+    ...         f.writelines(['id{}\\tfile{}.bam\\t{}\\t100\\treleased\\n'.format(i, i, 'a'*32) for i in ids])
+    >>> def combine():
+    ...     with contextlib.redirect_stdout(io.StringIO()) as out:
+    ...         combine_all( base_dir )
+    ...     return [line for line in out.getvalue().splitlines() if line.startswith(('Parsing', 'manifest-all-gdc'))]
+    >>> write_manifest('assay', 'rnaseq', [1, 2])
+    >>> write_manifest('tissue', 'lung', [2, 3])
+    >>> cwd = os.getcwd()
+    >>> os.chdir(base_dir)
+    >>> combine()
+    ['Parsing 2 of 2 manifest files (0 unchanged)']
+    >>> combine()
+    ['Parsing 0 of 2 manifest files (2 unchanged)', 'manifest-all-gdc.txt.gz is up to date']
+    >>> write_manifest('tissue', 'lung', [2, 3, 4])
+    >>> combine()
+    ['Parsing 1 of 2 manifest files (1 unchanged)']
+
+    A truncated cache entry (e.g. from an interrupted run) is parsed again:
+    >>> cache_file = _parsed_manifest_cache( os.path.join(base_dir, 'assay', 'manifest.rnaseq.txt'), os.path.join(base_dir, '.combine_cache') )
+    >>> with open(cache_file, 'r+b') as f:
+    ...     f.truncate(20)
+    20
+    >>> combine()
+    ['Parsing 1 of 2 manifest files (1 unchanged)']
+    >>> list(pd.read_csv('manifest-all-gdc.txt.gz', sep='\\t')['id'])
+    ['id1', 'id2', 'id3', 'id4']
+    >>> os.chdir(cwd)
     """
     DIRS = ['assay', 'disease', 'filetype', 'platform', 'tissue', 'project']
-    COLS = ['filename', 'md5', 'project', 'assay','tissue','disease','species','platform','filetype']
-    _MANIFEST_FILE = 'manifest-all-gdc.txt'
+    COLS = ['filename', 'md5', 'size', 'project', 'assay','tissue','disease','species','platform','filetype']
+    _MANIFEST_FILE = 'manifest-all-gdc.txt.gz'
     _CATEGORIES_FILE = 'categories-all-gdc.txt'
-    manifest_all = {}
+    CACHE_DIR = os.path.join(base_dir, '.combine_cache')
     categories = {}
+    mfiles = []     # (category, value, manifest file path)
 
     for DIR in DIRS:
-        files_all = os.listdir(os.path.join(base_dir, DIR))
+        if not os.path.isdir(os.path.join(base_dir, DIR)):
+            continue
+        files_all = sorted(os.listdir(os.path.join(base_dir, DIR)))
         manifest_files = list(filter(lambda x: x.endswith('.txt'), files_all))
         for mfile in manifest_files:
             category = DIR
@@ -312,53 +881,154 @@ def combine_all( base_dir ):
             if category not in categories:
                 categories[category] = []
             categories[category].append(value)
-            # add to manifest dictionary
-            with open(os.path.join(base_dir, DIR,mfile),'r') as f:
-                for r in f:
-                    rt = r.strip().split('\t')
-                    if rt[0] != 'id':
-                        _id = rt[0]
-                        _fn = rt[1]
-                        _md5 = rt[2]
-                        if _id not in manifest_all:
-                            manifest_all[_id] = {}
-                            manifest_all[_id]['filename'] = _fn
-                            manifest_all[_id]['md5'] = _md5
-                            manifest_all[_id]['species'] = 'human'
-                            manifest_all[_id]['project'] = 'other'
-                        if category not in manifest_all[_id]:
-                            manifest_all[_id][category] = value
-                        else:
-                            manifest_all[_id][category] += '_'+value
-
-    # write to manifest file
-    with open(_MANIFEST_FILE, 'w') as fout:
-        fout.write('id\tfilename\tmd5\tproject\tassay\ttissue\tdisease\tspecies\tplatform\tfiletype\n')
-        for mid in list(manifest_all.keys()):
-            row = mid+'\t'
-            for COL in COLS:
-                row += manifest_all[mid][COL]+'\t' if COL in manifest_all[mid] else '.\t'
-            fout.write(row.rstrip(' \t')+'\n')
+            mfiles.append((category, value, os.path.join(base_dir, DIR, mfile)))
+
+    # parse manifest files (in parallel, skipping unchanged files)
+    parsed = {}
+    to_parse = []
+    for category, value, path in mfiles:
+        cached = load_parsed_manifest( path, CACHE_DIR ) if incremental == 'True' else None
+        if cached is not None:
+            parsed[path] = cached
+        else:
+            to_parse.append(path)
+    print('Parsing {} of {} manifest files ({} unchanged)'.format(str(len(to_parse)), str(len(mfiles)), str(len(mfiles)-len(to_parse))))
+    if len(to_parse) > 0:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for path, rows in zip(to_parse, executor.map(parse_manifest_file, to_parse, chunksize=4)):
+                parsed[path] = rows
+                save_parsed_manifest( path, rows, CACHE_DIR )
+
+    # skip the merge if the outputs were written from the same manifest files and not modified since
+    combined_file = os.path.join(CACHE_DIR, 'combined.json')
+    inputs = [[category, value, path, manifest_signature( path )] for category, value, path in mfiles]
+    if incremental == 'True' and len(to_parse) == 0 and os.path.exists(combined_file) \
+       and os.path.exists(_MANIFEST_FILE) and os.path.exists(_CATEGORIES_FILE):
+        with open(combined_file) as f:
+            combined = json.load(f)
+        if combined.get('inputs') == inputs and combined.get('manifest') == [os.path.abspath(_MANIFEST_FILE), manifest_signature( _MANIFEST_FILE )] \
+           and combined.get('categories') == [os.path.abspath(_CATEGORIES_FILE), manifest_signature( _CATEGORIES_FILE )]:
+            print('{} is up to date'.format(_MANIFEST_FILE))
+            # (re)builds the store and index only if they are missing
+            load_manifest( _MANIFEST_FILE )
+            return _MANIFEST_FILE
+
+    # merge: one row per id (in order of first appearance), '_'-joined values per category
+    if len(mfiles) == 0:
+        print('WARNING: no manifest files found in {}'.format(base_dir))
+        manifest = pd.DataFrame({COL: pd.Series([], dtype=str) for COL in ['id']+COLS})
+    else:
+        records = pd.concat([pd.DataFrame(dict(parsed[path], category=category, value=value)) for category, value, path in mfiles], ignore_index=True)
+        manifest = records.drop_duplicates('id')[['id', 'filename', 'md5', 'size']].set_index('id')
+        cells = records.groupby(['id', 'category'], sort=False)['value'].agg('_'.join).unstack('category')
+        manifest = manifest.join(cells)
+        for COL in COLS:
+            default = 'human' if COL == 'species' else ('other' if COL == 'project' else '.')
+            manifest[COL] = manifest[COL].fillna(default) if COL in manifest.columns else default
+        manifest = manifest[COLS].reset_index()
+
+    # write to manifest file, columnar store and index
+    manifest.to_csv(_MANIFEST_FILE, sep='\t', index=False, compression='gzip')
+    store = open_manifest_store( _MANIFEST_FILE, df=manifest )
+    open_manifest_index( _MANIFEST_FILE, store if store is not None else manifest )
     # write to category file
     with open(_CATEGORIES_FILE,'w') as fout:
         for category in list(categories.keys()):
             fout.write('{}\t{}\n'.format(category, str(categories[category])))
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with open(combined_file,'w') as fout:
+        json.dump(dict(inputs=inputs, manifest=[os.path.abspath(_MANIFEST_FILE), manifest_signature( _MANIFEST_FILE )],
+                       categories=[os.path.abspath(_CATEGORIES_FILE), manifest_signature( _CATEGORIES_FILE )]), fout)
 
     print(str(categories))
     return _MANIFEST_FILE
 
-def gdc_run_all( manifest_list_file ):
-    """ Runs gdc_manifest_full() for all files
+
+def parse_manifest_file( path ):
+    """ Parses a GDC-format manifest file (id, filename, md5, size, ... with a header line).
+    ---
+    rows: {"id": [...], "filename": [...], "md5": [...], "size": [...]} - size is '.' if the file has no size column
+    """
+    rows = {"id": [], "filename": [], "md5": [], "size": []}
+    size_column = -1
+    with open(path,'r') as f:
+        for r in f:
+            rt = r.strip().split('\t')
+            if rt[0] == 'id':
+                size_column = rt.index('size') if 'size' in rt else -1
+            else:
+                rows["id"].append(rt[0])
+                rows["filename"].append(rt[1])
+                rows["md5"].append(rt[2])
+                rows["size"].append(rt[size_column] if 0 <= size_column < len(rt) else '.')
+    return rows
+
+
+def _parsed_manifest_cache( path, CACHE_DIR ):
+    """ Cache file for the parsed contents of a manifest file. """
+    return os.path.join(CACHE_DIR, hashlib.sha1(os.path.abspath(path).encode()).hexdigest()+'.pkl')
+
+
+def _file_sha1( path ):
+    sha1 = hashlib.sha1()
+    with open(path,'rb') as f:
+        for chunk in iter(lambda: f.read(1024*1024), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def load_parsed_manifest( path, CACHE_DIR ):
+    """ Returns the cached parsed contents of a manifest file (see parse_manifest_file),
+    or None if the file changed since it was cached. A file whose size or modification time
+    changed is still considered unchanged if its sha1 is the same.
+    A cache file that cannot be read (e.g. truncated by an interrupted run) is treated as stale.
+    """
+    cache_file = _parsed_manifest_cache( path, CACHE_DIR )
+    if not os.path.exists(cache_file):
+        return None
+    try:
+        with open(cache_file,'rb') as f:
+            cached = pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return None
+    if 'size' not in cached['rows']:
+        # parsed before file sizes were kept
+        return None
+    st = os.stat(path)
+    if cached['size'] == st.st_size and cached['mtime'] == st.st_mtime_ns:
+        return cached['rows']
+    elif cached['size'] == st.st_size and cached['sha1'] == _file_sha1( path ):
+        save_parsed_manifest( path, cached['rows'], CACHE_DIR, sha1=cached['sha1'] )
+        return cached['rows']
+    return None
+
+
+def save_parsed_manifest( path, rows, CACHE_DIR, sha1='' ):
+    """ Caches the parsed contents of a manifest file, with its size, modification time and sha1.
+    """
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    st = os.stat(path)
+    cache_file = _parsed_manifest_cache( path, CACHE_DIR )
+    with open(cache_file+'.tmp','wb') as fout:
+        pickle.dump(dict(size=st.st_size, mtime=st.st_mtime_ns, sha1=sha1 if sha1 != '' else _file_sha1( path ), rows=rows), fout)
+    os.replace(cache_file+'.tmp', cache_file)
+
+def gdc_run_all( manifest_list_file, workers=None ):
+    """ Runs gdc_manifest_full() for all files, in parallel.
+
+    manifest_list_file: tab-delimited file with a GDC manifest file in 1st column and its GDC JSON metadata file in 2nd column
+    workers: number of processes (default: number of CPUs)
     """
     base_dir = quick_utils.get_file_folder(manifest_list_file)
-    manifest_full_files = []
+    json_files = []
+    manifest_files = []
     with open(manifest_list_file,'r') as f:
         for r in f:
             rt = r.strip().split('\t')
-            manifest_file = rt[0]
-            json_file = rt[1]
-            fout = gdc_manifest_full( os.path.join(base_dir, json_file), os.path.join(base_dir, manifest_file) )
-            manifest_full_files.append(fout)
+            manifest_files.append(os.path.join(base_dir, rt[0]))
+            json_files.append(os.path.join(base_dir, rt[1]))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        manifest_full_files = list(executor.map(gdc_manifest_full, json_files, manifest_files))
     print(str(manifest_full_files))
     return
 
@@ -368,11 +1038,12 @@ def gdc_manifest_full( gdc_json_file, gdc_manifest_file ):
     and data type info.
     https://portal.gdc.cancer.gov/repository
     Select a primary site, then click on Manifest and click on JSON.
+
+    The JSON file is read one entry at a time (atlas_utils.iter_json_array), not loaded whole.
     """
-    gdc_json_list = quick_utils.getJSON( gdc_json_file )
     gdc_json_dict = {} # file_name: [data_format, data_category]
     gdc_manifest_out = gdc_manifest_file[:-4]+'.full.txt'
-    for gdc_entry in gdc_json_list:
+    for gdc_entry in atlas_utils.iter_json_array( gdc_json_file ):
         data_format = gdc_entry["data_format"]
         file_name = gdc_entry["file_name"]
         data_category = gdc_entry["data_category"]
@@ -431,8 +1102,8 @@ def gdc_json_to_txt( gdc_json_file ):
     fout_name = gdc_json_file[:-5]+'.csv'
     fout = open(fout_name,'w')
     fout.write('file_name\tdata_category\tdata_format\tcase_ids\tproject_ids\n')
-    gdc_json_list = quick_utils.getJSON( gdc_json_file )
-    for gdc_entry in gdc_json_list:
+    # read one entry at a time rather than loading the whole JSON file
+    for gdc_entry in atlas_utils.iter_json_array( gdc_json_file ):
         data_format = gdc_entry["data_format"]
         if "cases" in gdc_entry and len(gdc_entry["cases"]) > 0:
             case_ids = ','.join(list(map(lambda x: x["case_id"] if "case_id" in x else '', gdc_entry["cases"])))
@@ -488,11 +1159,23 @@ def print_gdc_help():
     
     print('You can list the files before downloading them, by typing:\n')
     print('\t$ bioshed download gdc --list\n')
+
+    print('You can set how many downloads run at once (default 8):\n')
+    print('\t$ bioshed download gdc --workers 4\n')
     
     print('You can specify a different output directory, including an AWS S3 remote folder:\n')
     print('\t$ bioshed download gdc --output s3://my/output/folder\n')
     
     print('By default, existing files in the output directory will be overwritten. To download only new files:\n')
     print('\t$ bioshed download gdc --update\n')
+    print('Interrupted downloads resume where they stopped, and downloaded files are checked against their md5.\n')
     print('Successful download will also generate an associated annotation file "annotation_gdc.txt".\n')
+
+    print('To record where the time goes in a search or download, add --profile (optionally followed by a file name).')
+    print('Timings of the search and download steps are written to "bioshed_profile.json" (JSON trace):\n')
+    print('\t$ bioshed download gdc --profile\n')
+
+    print('To answer searches faster, keep the search data loaded in a background search daemon:\n')
+    print('\t$ python atlas_daemon.py start\n')
+    print('Searches (and download --list) use it automatically while it runs.\n')
     return
@@ -1,3 +1,28 @@
+import os, re, sys, json, time, importlib, subprocess, threading, functools, contextlib
+
+SCRIPT_DIR = str(os.path.dirname(os.path.realpath(__file__)))
+# modules that should not be imported on the startup path (--help, listing search terms...)
+HEAVY_MODULES = ['pandas', 'numpy', 'pyarrow', 'requests', 'boto3', 'botocore', 'quick_utils', 'aws_s3_utils']
+# seconds allowed for "bioshed search encode --help" after interpreter start (see profile_startup)
+STARTUP_BUDGET = 0.25
+
+# hot-path instrumentation (see span, count), written out by --profile (see write_profile)
+DEFAULT_PROFILE_FILE = 'bioshed_profile.json'
+PROFILE_MAX_EVENTS = 100000     # trace events kept per process - timings still go into the histograms beyond this
+HISTOGRAM_BOUNDS = [0.001, 0.01, 0.1, 1.0, 10.0, 100.0]    # upper bounds (seconds) of the span histogram buckets
+_profile = dict(start=time.perf_counter(), events=[], dropped_events=0, counters={}, histograms={})
+_profile_lock = threading.Lock()
+
+# a running search daemon (atlas_daemon.py) is found through this file: {"port", "token", "pid", "script_dir"}
+DAEMON_STATE_FILE = os.path.join(os.path.expanduser('~'), '.bioshed', 'atlas_daemon.json')
+DAEMON_TIMEOUT = 600    # seconds to wait for the daemon to answer a request
+_daemon = dict(serving=False)   # set in the daemon process itself, so that it does not forward requests to itself
+
+# full-text indexes (SQLite FTS5, see text_index_terms and text_match_query)
+TEXT_TOKENIZER = 'unicode61 remove_diacritics 2'
+TEXT_MIN_PREFIX_LENGTH = 4      # query words at least this long also match as prefixes ("methyl" => methylation)
+_text_index = {}    # {"fts5": True/False}, see text_index_available()
+
 def parse_search_terms( search_string ):
     """ Takes string of search terms and returns categorized dictionary.
 
@@ -44,4 +69,376 @@ def add_term( search_dict, search_key, term_to_add ):
     new_terms = existing_terms.strip() + " {}".format(str(term_to_add))
     search_dict[search_key] = new_terms
     return search_dict
-    
+
+
+class LazyModule:
+    """ Stands in for a module until one of its attributes is used, then imports it.
+    See lazy_import().
+    """
+    def __init__( self, name ):
+        self._name = name
+        self._module = None
+
+    def __getattr__( self, attr ):
+        if attr.startswith('__') and attr.endswith('__'):
+            # probes made by doctest, inspect, pickle... (__wrapped__, __file__, __spec__) do not import the module
+            raise AttributeError(attr)
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+
+def lazy_import( name ):
+    """ Returns a module that is only imported when first used, so that heavy
+    dependencies do not slow down code paths that do not need them.
+
+    name: module name, e.g. 'pandas'
+    ---
+    module: LazyModule
+
+    >>> json_module = lazy_import('json')
+    >>> json_module.dumps([1])
+    '[1]'
+    >>> missing = lazy_import('no_such_module')
+    >>> hasattr(missing, '__wrapped__')
+    False
+    """
+    return LazyModule(name)
+
+
+def profile_startup( statement ):
+    """ Runs a python statement in a fresh interpreter (from this folder), and reports
+    how long it took and which heavy modules (HEAVY_MODULES) it imported.
+
+    statement: python code to run
+    ---
+    startup: {"seconds": time taken by the statement, "heavy_modules": [...]}
+
+    Startup budget for the help menu:
+    >>> startup = profile_startup('import atlas_encode_utils; atlas_encode_utils.search_encode(dict(searchterms="--help"))')
+    >>> startup['seconds'] < STARTUP_BUDGET
+    True
+    >>> startup['heavy_modules']
+    []
+    """
+    code = '\n'.join(['import sys, os, time, json',
+                      '_stdout = sys.stdout',
+                      'sys.stdout = open(os.devnull, "w")',
+                      '_start = time.perf_counter()',
+                      statement,
+                      '_seconds = time.perf_counter() - _start',
+                      '_stdout.write(json.dumps(dict(seconds=_seconds, heavy_modules=[m for m in {} if m in sys.modules])))'.format(repr(HEAVY_MODULES))])
+    result = subprocess.run([sys.executable, '-c', code], cwd=SCRIPT_DIR, capture_output=True, text=True, check=True)
+    return json.loads(result.stdout)
+
+
+def iter_json_array( json_file, chunk_size=1024*1024 ):
+    """ Yields the entries of a JSON array one at a time, reading the file in chunks,
+    so memory use is bounded by the size of one entry rather than the whole file.
+
+    json_file: path to a file holding a JSON array (or an open text file)
+    chunk_size: characters read at a time
+    ---
+    yields: decoded array entries, in order
+
+    >>> import io
+    >>> list(iter_json_array(io.StringIO('[{"a": 1}, {"b": [2, 3]}, 45]'), chunk_size=4))
+    [{'a': 1}, {'b': [2, 3]}, 45]
+    >>> entries = [{"id": i, "name": "f{}".format(i)} for i in range(1000)]
+    >>> list(iter_json_array(io.StringIO(json.dumps(entries)), chunk_size=4096)) == entries
+    True
+    >>> list(iter_json_array(io.StringIO(' [ ] ')))
+    []
+    """
+    decoder = json.JSONDecoder()
+    whitespace = ' \t\r\n'
+    f = open(json_file, 'r') if isinstance(json_file, str) else json_file
+    try:
+        buf = ''
+        pos = 0         # start of the unread part of buf - the read part is only cut off when a chunk is added
+        eof = False
+        started = False
+        while True:
+            # skip separators between entries
+            while pos < len(buf) and (buf[pos] in whitespace or (started and buf[pos] == ',')):
+                pos += 1
+            if not started and pos < len(buf):
+                if buf[pos] != '[':
+                    raise ValueError('{} does not hold a JSON array'.format(str(json_file)))
+                pos += 1
+                started = True
+                continue
+            if started and pos < len(buf) and buf[pos] == ']':
+                return
+            end = -1
+            if pos < len(buf):
+                try:
+                    entry, end = decoder.raw_decode(buf, pos)
+                except json.JSONDecodeError:
+                    end = -1
+            # only accept an entry once the following ',' or ']' has been read - until then
+            # it may be cut short (e.g. 1 from 1.5)
+            if end != -1:
+                after = end
+                while after < len(buf) and buf[after] in whitespace:
+                    after += 1
+                if after < len(buf) and buf[after] in ',]':
+                    yield entry
+                    pos = end
+                    continue
+            if eof:
+                raise ValueError('{} ends before the end of its JSON array'.format(str(json_file)))
+            chunk = f.read(chunk_size)
+            eof = (chunk == '')
+            buf = buf[pos:] + chunk
+            pos = 0
+    finally:
+        if isinstance(json_file, str):
+            f.close()
+
+
+def text_index_available():
+    """ True if the SQLite library has FTS5 (full-text indexes), checked once per process. """
+    if 'fts5' not in _text_index:
+        import sqlite3
+        try:
+            sqlite3.connect(':memory:').execute('CREATE VIRTUAL TABLE t USING fts5(text)')
+            _text_index['fts5'] = True
+        except sqlite3.Error:
+            _text_index['fts5'] = False
+    return _text_index['fts5']
+
+
+def text_words( text ):
+    """ Splits text into lowercase words, keeping hyphenated words together.
+
+    >>> text_words('Histone ChIP-seq, WGS-whole-genome-seq_H3K4me3')
+    ['histone', 'chip-seq', 'wgs-whole-genome-seq', 'h3k4me3']
+    """
+    return re.findall(r'[0-9a-z]+(?:-[0-9a-z]+)*', str(text).lower().replace('_', ' '))
+
+
+def text_index_terms( values ):
+    """ Text to put in a full-text index (FTS5 with TEXT_TOKENIZER) for a list of values.
+    The tokenizer splits hyphenated words ("chip-seq" => chip, seq), so each run of words of a
+    hyphenated word is also added with its hyphens removed ("chipseq"): queries for "chip-seq",
+    "chip seq" and "chipseq" then all match (see text_match_query).
+
+    >>> text_index_terms(['transcriptome-rnaseq', 'breast'])
+    'transcriptome-rnaseq transcriptomernaseq breast'
+    >>> text_index_terms(['WGS-whole-genome-seq'])
+    'wgs-whole-genome-seq wgswhole wgswholegenome wgswholegenomeseq wholegenome wholegenomeseq genomeseq'
+    """
+    terms = []
+    for word in text_words( ' '.join(str(v) for v in values) ):
+        terms.append(word)
+        parts = word.split('-')
+        terms += [''.join(parts[i:j]) for i in range(len(parts)) for j in range(i+2, len(parts)+1)]
+    return ' '.join(terms)
+
+
+def text_match_query( text, operator='AND' ):
+    """ FTS5 query (MATCH expression) for free text, against text indexed with text_index_terms.
+    A hyphenated word matches as a phrase or with its hyphens removed, and words of at least
+    TEXT_MIN_PREFIX_LENGTH characters also match as prefixes.
+
+    text: free-text query, e.g. "breast cancer rna-seq"
+    operator: 'AND' (every word must match) or 'OR' (any word - ranking favours rows matching more words)
+    ---
+    query: MATCH expression ('' if text has no words)
+
+    >>> text_match_query('rna-seq of lung')
+    '("rna seq" OR "rnaseq"*) AND ("of") AND ("lung"*)'
+    >>> text_match_query('methyl', 'OR')
+    '("methyl"*)'
+    """
+    groups = []
+    for word in text_words( text ):
+        joined = word.replace('-', '')
+        alternatives = ['"{}"'.format(word.replace('-', ' '))] if '-' in word else []
+        alternatives.append('"{}"'.format(joined) + ('*' if len(joined) >= TEXT_MIN_PREFIX_LENGTH else ''))
+        groups.append('({})'.format(' OR '.join(alternatives)))
+    return ' {} '.format(operator).join(groups)
+
+
+@contextlib.contextmanager
+def span( name, **attrs ):
+    """ Times a block of code. The duration is added to the histogram for name, and
+    recorded as a trace event with attrs (see write_profile).
+
+    name: span name, e.g. 'encode_search_url'
+    attrs: extra info stored with the trace event - the block can add to it
+    ---
+    yields: attrs
+
+    >>> with span('doctest.span', step=1) as attrs:
+    ...     attrs['rows'] = 10
+    >>> get_profile()['histograms']['doctest.span']['count'] >= 1
+    True
+    """
+    start = time.perf_counter()
+    try:
+        yield attrs
+    finally:
+        seconds = time.perf_counter() - start
+        with _profile_lock:
+            _observe( name, seconds )
+            if len(_profile['events']) < PROFILE_MAX_EVENTS:
+                _profile['events'].append(dict(name=name, start=start, seconds=seconds, thread=threading.get_ident(), attrs=attrs))
+            else:
+                _profile['dropped_events'] += 1
+
+
+def traced( name ):
+    """ Decorator running every call of a function inside span(name). """
+    def _decorator( func ):
+        @functools.wraps(func)
+        def _wrapper( *args, **kwargs ):
+            with span( name ):
+                return func( *args, **kwargs )
+        return _wrapper
+    return _decorator
+
+
+def profiled( name ):
+    """ Decorator for the search/download entry points, which take an args dict holding
+    'searchterms' or 'downloadstr'. Runs the call inside span(name), then writes the
+    profile (write_profile) if the user passed --profile [<trace file>].
+    """
+    def _decorator( func ):
+        @functools.wraps(func)
+        def _wrapper( args ):
+            terms = parse_search_terms( args['searchterms'] if 'searchterms' in args else (args['downloadstr'] if 'downloadstr' in args else ''))
+            profile_file = terms['profile'] if 'profile' in terms else (args['profile'] if 'profile' in args else None)
+            with span( name ):
+                results = func( args )
+            if profile_file is not None:
+                write_profile( profile_file if profile_file not in ['', 'True'] else DEFAULT_PROFILE_FILE )
+            return results
+        return _wrapper
+    return _decorator
+
+
+def reset_profile():
+    """ Clears the spans, counters and histograms recorded so far (e.g. between daemon requests). """
+    with _profile_lock:
+        _profile.update(start=time.perf_counter(), events=[], dropped_events=0, counters={}, histograms={})
+
+
+def count( name, n=1 ):
+    """ Adds n to the counter name (e.g. count('http.requests')).
+
+    >>> count('doctest.counter', 2)
+    >>> get_profile()['counters']['doctest.counter'] >= 2
+    True
+    """
+    with _profile_lock:
+        _profile['counters'][name] = _profile['counters'].get(name, 0) + n
+
+
+def _observe( name, seconds ):
+    """ Adds a duration to the histogram for name (call with _profile_lock held). """
+    if name not in _profile['histograms']:
+        _profile['histograms'][name] = dict(count=0, total=0.0, min=seconds, max=seconds, buckets=[0]*(len(HISTOGRAM_BOUNDS)+1))
+    h = _profile['histograms'][name]
+    h['count'] += 1
+    h['total'] += seconds
+    h['min'] = min(h['min'], seconds)
+    h['max'] = max(h['max'], seconds)
+    h['buckets'][sum(1 for bound in HISTOGRAM_BOUNDS if seconds > bound)] += 1
+
+
+def get_profile():
+    """ Returns the counters and span histograms recorded so far in this process.
+    ---
+    profile: {"counters": {name: n}, "histograms": {name: {"count", "total", "min", "max", "buckets"}},
+              "histogram_bounds": HISTOGRAM_BOUNDS, "dropped_events": n}
+    """
+    with _profile_lock:
+        return dict(counters=dict(_profile['counters']), histograms={k: dict(v, buckets=list(v['buckets'])) for k, v in _profile['histograms'].items()},
+                    histogram_bounds=list(HISTOGRAM_BOUNDS), dropped_events=_profile['dropped_events'])
+
+
+def write_profile( profile_file=DEFAULT_PROFILE_FILE ):
+    """ Writes the spans, counters and histograms recorded in this process to a JSON trace.
+    The trace events follow the Chrome trace event format, so the file can be opened in
+    chrome://tracing or https://ui.perfetto.dev, and counters and histograms are added alongside.
+
+    profile_file: output JSON file
+    ---
+    profile_file
+    """
+    profile = get_profile()
+    with _profile_lock:
+        events = list(_profile['events'])
+    profile['traceEvents'] = [dict(name=e['name'], ph='X', ts=round((e['start'] - _profile['start'])*1e6, 1), dur=round(e['seconds']*1e6, 1),
+                                   pid=os.getpid(), tid=e['thread'], args={k: str(v) for k, v in e['attrs'].items()}) for e in events]
+    with open(profile_file,'w') as fout:
+        json.dump(profile, fout, indent=1)
+    print('Profile written to {}'.format(profile_file))
+    return profile_file
+
+
+def served( command, condition=None ):
+    """ Decorator for entry points that a running search daemon (atlas_daemon.py) can answer.
+    If the daemon is running, the call is sent to it (with the current folder, where it writes
+    its output files) and its printed output is shown here. Otherwise, or if the daemon
+    cannot answer, the function runs in this process as usual.
+
+    command: name the daemon knows the entry point by (atlas_daemon.COMMANDS)
+    condition: function of args - only calls for which it returns True are sent to the daemon
+    ---
+    Results returned by the daemon are JSON: search tables are not sent back, but summarized
+    as {"results_file": ..., "rows": ...} (the table is in the results file).
+    Set BIOSHED_ATLAS_DAEMON=off to never use the daemon.
+    """
+    def _decorator( func ):
+        @functools.wraps(func)
+        def _wrapper( args ):
+            if not _daemon['serving'] and (condition is None or condition( args )):
+                response = daemon_request( dict(command=command, args=args, cwd=os.getcwd()) )
+                if response is not None and 'error' not in response:
+                    sys.stdout.write(response['output'])
+                    return response['result']
+                elif response is not None:
+                    print('WARNING: search daemon failed ({}) - running here instead'.format(response['error']))
+            return func( args )
+        return _wrapper
+    return _decorator
+
+
+def daemon_request( request, path='/run' ):
+    """ Sends a request to the search daemon, if one is running for this installation.
+
+    request: JSON-serializable request
+    path: '/run' (run a command), '/status' or '/stop'
+    ---
+    response: decoded JSON response, or None if no daemon is running (or it could not be reached)
+    """
+    if os.environ.get('BIOSHED_ATLAS_DAEMON', '').lower() in ['off', '0', 'false'] or not os.path.exists(DAEMON_STATE_FILE):
+        return None
+    try:
+        with open(DAEMON_STATE_FILE,'r') as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if state.get('script_dir') != SCRIPT_DIR:
+        # daemon of another installation
+        return None
+    import urllib.request
+    http_request = urllib.request.Request('http://127.0.0.1:{}{}'.format(str(state['port']), path), data=json.dumps(request).encode(),
+                                          headers={'Content-Type': 'application/json', 'X-Atlas-Token': state['token']})
+    try:
+        with urllib.request.urlopen(http_request, timeout=DAEMON_TIMEOUT) as response:
+            return json.loads(response.read())
+    except (OSError, ValueError):
+        return None
+
+
+def list_only( args ):
+    """ Returns True if a download entry point is only asked to list files (--list), not download them.
+
+    >>> list_only( dict(downloadstr='--filetype fastq --list'))
+    True
+    """
+    return 'list' in parse_search_terms( args['downloadstr'] if 'downloadstr' in args else '' )